@@ -1,6 +1,3 @@
-import os
-
-
 def record_place_action(state, place_tile_result):
     action_text = _generate_place_action_text(state, place_tile_result)
     _append_action_text(state, action_text)
@@ -24,12 +21,6 @@ def _generate_place_action_text(state, place_tile_result):
     return f'{basic_info} {extra_info}'
 
 
-def record_buy_action(state, brand, amount, price_per_stock):
-    action_text = _generate_buy_action_text(state, brand, amount, price_per_stock)
-    _append_action_text(state, action_text)
-    return state
-
-
 def _generate_buy_action_text(state, brand, amount, price_per_stock):
     player_name = _get_current_action_player_name(state)
 
@@ -39,6 +30,26 @@ def _generate_buy_action_text(state, brand, amount, price_per_stock):
     return f'{player_name} bought {amount} {brand.name} stock @ ${price_per_stock} each.'
 
 
+def record_purchase_order(state, amount_by_brand, price_by_brand):
+    action_text = _generate_purchase_order_text(state, amount_by_brand, price_by_brand)
+    _append_action_text(state, action_text)
+    return state
+
+
+def _generate_purchase_order_text(state, amount_by_brand, price_by_brand):
+    if len(amount_by_brand) == 1:
+        ((brand, amount),) = amount_by_brand.items()
+        return _generate_buy_action_text(state, brand, amount, price_by_brand[brand])
+
+    player_name = _get_current_action_player_name(state)
+    purchases_string = ' and '.join(
+        f'{amount} {brand.name} @ ${price_by_brand[brand]}'
+        for brand, amount
+        in amount_by_brand.items()
+    )
+    return f'{player_name} bought {purchases_string} each.'
+
+
 def record_sell_action(state, player_id, brand, amount, price_per_stock):
     action_text = _generate_sell_action_text(state, player_id, brand, amount, price_per_stock)
     _append_action_text(state, action_text)
@@ -97,9 +108,9 @@ def _generate_place_string(place_number):
 
 
 def _append_action_text(state, text):
-    max_count = int(os.environ['RECENT_ACTION_DISPLAY_COUNT'])
-    state.most_recent_actions.append(text)
-    state.most_recent_actions = state.most_recent_actions[-max_count:]
+    max_count = state.ruleset.recent_action_display_count
+    # build a new list rather than appending so an undo can put the old one back
+    state.most_recent_actions = (state.most_recent_actions + [text])[-max_count:]
     return state
 
 
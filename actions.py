@@ -0,0 +1,235 @@
+import models
+import grid
+import stock
+import tiles
+import turns
+
+
+# Every accepted action goes through one of the functions below. Each one validates
+# the action, applies it to the state, and records it on the unit of work as an
+# event, so replaying a game's events through apply_event rebuilds its state.
+
+
+def join_game(state, unit_of_work, player_id, user_data):
+    if player_id in state.player_order:
+        raise models.RuleViolation('Player is already in this game!')
+
+    if state.is_started:
+        raise models.RuleViolation('Cannot join a game in progress!')
+
+    state.player_order.append(player_id)
+    state.money_by_player[player_id] = 6000
+    state.stock_by_player[player_id] = {brand: 0 for brand in models.Brand}
+    state.user_data_by_id[player_id] = user_data
+
+    _record_event(state, unit_of_work, {'type': 'join_game', 'player_id': player_id, 'user_data': user_data})
+
+
+def start_game(state, unit_of_work, player_order, deck_seed):
+    if state.is_started:
+        raise models.RuleViolation('Cannot start already started game!')
+
+    ruleset = state.ruleset
+    player_count = len(state.player_order)
+
+    if not ruleset.player_count_min <= player_count <= ruleset.player_count_max:
+        raise models.RuleViolation(f'Cannot start game with {player_count} players!')
+
+    if sorted(player_order) != sorted(state.player_order):
+        raise Exception('The player order must contain exactly the players in the game!')
+
+    state.player_order = list(player_order)
+    starting_player = state.player_order[0]
+
+    deck = tiles.generate_initial_tiles(ruleset, deck_seed)
+
+    board_starting_tiles = tiles.draw_tiles(deck, player_count)
+    for tile in board_starting_tiles:
+        grid.place_starting_tile(state, tile)
+
+    state.is_started = True
+    state.current_turn_player = starting_player
+    state.current_action_player = starting_player
+
+    tiles_by_player_id = {
+        player_id: tiles.draw_tiles(deck, ruleset.tile_hand_size)
+        for player_id
+        in state.player_order
+    }
+
+    state.tiles_remaining = deck.remaining()
+
+    unit_of_work.initialize_deck(deck)
+    unit_of_work.initialize_player_tiles(tiles_by_player_id)
+
+    _record_event(state, unit_of_work, {'type': 'start_game', 'player_order': state.player_order, 'deck_seed': deck_seed})
+
+
+def place_tile(state, unit_of_work, player_id, tile, brand):
+    if state.current_action_player != player_id:
+        raise models.RuleViolation("Stop trying to take other player's turns! You cheat!")
+
+    if state.current_action_type != models.ActionType.PLACE_TILE:
+        raise models.RuleViolation('It is your turn, but it is not time to place a tile!')
+
+    if not state.is_started:
+        raise models.RuleViolation('Cannot take turn until game has begun!')
+
+    # the hand is not tracked while replaying
+    if unit_of_work.player_tiles is not None and tile not in unit_of_work.player_tiles:
+        raise models.RuleViolation('You do not have that tile! Stop trying to cheat!')
+
+    place_tile_result = grid.place_tile(state, tile, brand)
+    stock.apply_majority_bonuses(state, place_tile_result.acquired_chains)
+    stock.award_founder_share(state, player_id, place_tile_result.new_brand)
+    grid.set_brand_lists(state)
+    stock.set_price_table(state)
+    turns.transition_from_place(state, place_tile_result, unit_of_work)
+
+    unit_of_work.delete_player_tile(player_id, tile)
+
+    _record_event(state, unit_of_work, {
+        'type': 'place_tile',
+        'player_id': player_id,
+        'x': tile.x,
+        'y': tile.y,
+        'brand': None if brand is None else brand.value
+    })
+
+
+def resolve_acquisition(state, unit_of_work, player_id, sell_count, trade_count):
+    if state.current_action_player != player_id:
+        raise models.RuleViolation("Stop trying to take other player's turns! You cheat!")
+
+    if state.current_action_type != models.ActionType.RESOLVE_ACQUISITION:
+        raise models.RuleViolation('It is your turn, but it is not time to resolve an acquisition!')
+
+    if not state.is_started:
+        raise models.RuleViolation('Cannot take turn until game has begun!')
+
+    acquiree = models.Brand(state.current_action_details['acquiree'])
+    player_acquiree_stock_count = state.stock_by_player[player_id][acquiree]
+
+    if sell_count + trade_count > player_acquiree_stock_count:
+        raise models.RuleViolation('Cannot trade and sell more stock than you current have!')
+
+    acquirer = models.Brand(state.current_action_details['acquirer'])
+    cost_at_acquisition_time = state.current_action_details['acquiree_cost_at_acquisition_time']
+
+    stock.sell_stock(state, player_id, acquiree, cost_at_acquisition_time, sell_count)
+    stock.trade_stock(state, player_id, acquiree, acquirer, trade_count)
+
+    turns.transition_from_resolve(state, unit_of_work)
+
+    _record_event(state, unit_of_work, {
+        'type': 'resolve_acquisition',
+        'player_id': player_id,
+        'sell_count': sell_count,
+        'trade_count': trade_count
+    })
+
+
+def buy_stock(state, unit_of_work, player_id, purchase_order):
+    if state.current_action_player != player_id:
+        raise models.RuleViolation("Stop trying to take other player's turns! You cheat!")
+
+    if state.current_action_type != models.ActionType.BUY_STOCK:
+        raise models.RuleViolation('It is your turn, but it is not time to buy stock!')
+
+    if not state.is_started:
+        raise models.RuleViolation('Cannot take turn until game has begun!')
+
+    amount_by_brand = {models.Brand(raw_brand): int(raw_amount) for raw_brand, raw_amount in purchase_order.items()}
+
+    stock.execute_purchase_order(state, player_id, amount_by_brand)
+    turns.transition_from_buy(state, unit_of_work)
+
+    _record_event(state, unit_of_work, {
+        'type': 'buy_stock',
+        'player_id': player_id,
+        'purchase_order': {brand.value: amount for brand, amount in amount_by_brand.items()}
+    })
+
+
+_TURN_ACTION_TYPES = {
+    'place_tile': models.ActionType.PLACE_TILE,
+    'resolve_acquisition': models.ActionType.RESOLVE_ACQUISITION,
+    'buy_stock': models.ActionType.BUY_STOCK,
+}
+
+
+def take_turn(state, unit_of_work, player_id, turn_actions):
+    # Applies a player's actions in order, stopping before the first one that is no
+    # longer theirs to take, e.g. once a placement leaves an acquisition to resolve
+    # before the stock they meant to buy. Returns how many actions were applied.
+    applied_action_count = 0
+
+    for turn_action in turn_actions:
+        if turn_action['type'] not in _TURN_ACTION_TYPES:
+            raise models.RuleViolation(f"{turn_action['type']} is not part of a turn!")
+
+        is_players_action = state.current_action_player == player_id
+        is_applicable = is_players_action and state.current_action_type == _TURN_ACTION_TYPES[turn_action['type']]
+
+        if applied_action_count and not is_applicable:
+            break
+
+        apply_event(state, unit_of_work, {**turn_action, 'player_id': player_id})
+        applied_action_count += 1
+
+    return applied_action_count
+
+
+def apply_event(state, unit_of_work, event):
+    event_type = event['type']
+
+    if event_type == 'join_game':
+        join_game(state, unit_of_work, event['player_id'], event['user_data'])
+    elif event_type == 'start_game':
+        start_game(state, unit_of_work, event['player_order'], event['deck_seed'])
+    elif event_type == 'place_tile':
+        brand = None if event['brand'] is None else models.Brand(event['brand'])
+        place_tile(state, unit_of_work, event['player_id'], models.Tile(event['x'], event['y']), brand)
+    elif event_type == 'resolve_acquisition':
+        resolve_acquisition(state, unit_of_work, event['player_id'], event['sell_count'], event['trade_count'])
+    elif event_type == 'buy_stock':
+        buy_stock(state, unit_of_work, event['player_id'], event['purchase_order'])
+    else:
+        raise Exception(f'Unknown event type {event_type}!')
+
+
+def replay(state, deck, events):
+    unit_of_work = _ReplayUnitOfWork(deck)
+
+    for event in events:
+        apply_event(state, unit_of_work, event)
+
+    return state
+
+
+def _record_event(state, unit_of_work, event):
+    state.version += 1
+    unit_of_work.record_event(state.version, event)
+
+
+class _ReplayUnitOfWork:
+    # Stands in for persistance.UnitOfWork while replaying. Only the deck matters
+    # for rebuilding a state, so hands and events are not tracked.
+    def __init__(self, deck):
+        self.deck = deck
+        self.player_tiles = None
+
+    def initialize_deck(self, deck):
+        self.deck = deck
+
+    def initialize_player_tiles(self, tiles_by_player_id):
+        pass
+
+    def deal_tile_to_player(self, player_id, tile):
+        pass
+
+    def delete_player_tile(self, player_id, tile):
+        pass
+
+    def record_event(self, version, event):
+        pass
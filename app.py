@@ -1,25 +1,82 @@
 import os
+import json
+import threading
 import traceback
+import functools
 from random import shuffle
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
-import firebase_admin
-import firebase_admin.auth
 
+import auth
 import persistance
 import models
 import grid
 import tiles
-import turns
-import stock
-import action_display
+import deltas
+import ledger
+import actions
+import metrics
 
 
-firebase_admin.initialize_app()
 app = Flask(__name__, static_folder='ui')
 CORS(app, max_age=3600, supports_credentials=True)  
 
+# each stream holds one of the worker's threads for as long as it is open, so
+# only some of them may be used for streams and the rest are left for actions.
+# Viewers beyond that poll instead, see stream_game_state.
+_stream_slots = threading.BoundedSemaphore(int(os.environ.get('STREAM_LIMIT', '4')))
+
+# fails here, when the worker starts, if the dense ledger is asked for but missing
+ledger.is_enabled()
+
+
+def _game_action(view):
+    # Actions on a game run one at a time in this process. Another process may still
+    # have committed to the game after this one cached it, in which case the cache
+    # entry is dropped and the action is run again from a fresh read. A cached state
+    # that is behind can also break a rule before it gets to commit, e.g. by showing
+    # the wrong player's turn, so those actions are also run again once.
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        game_id = request.json['game_id']
+
+        with persistance.lock_game(game_id):
+            is_game_cached = persistance.is_game_cached(game_id)
+
+            try:
+                return view(*args, **kwargs)
+            except persistance.StaleGameState:
+                return view(*args, **kwargs)
+            except models.RuleViolation:
+                if not is_game_cached:
+                    raise
+
+                persistance.evict_cached_game(game_id)
+                return view(*args, **kwargs)
+
+    return wrapper
+
+
+@app.before_request
+def begin_request_timing():
+    metrics.begin_request(request.endpoint or 'unknown')
+
+
+@app.after_request
+def add_server_timing_header(response):
+    server_timing = metrics.end_request(response.status_code)
+
+    if server_timing:
+        response.headers['Server-Timing'] = server_timing
+
+    return response
+
+
+@app.route('/metrics')
+def get_metrics():
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
 
 @app.route('/')
 def root():
@@ -36,7 +93,90 @@ def send_img(path):
     return app.send_static_file(f'img/{path}')
 
 
+@app.route('/games')
+def list_games():
+    status = request.args.get('status') or None
+
+    try:
+        page_size = min(max(int(request.args.get('page_size', '20')), 1), 100)
+    except ValueError as e:
+        raise models.RuleViolation('The page size must be a number!') from e
+
+    cursor = request.args.get('cursor') or None
+
+    game_summaries, next_cursor = persistance.list_games(status, page_size, cursor)
+
+    response = jsonify(games=game_summaries, next_cursor=next_cursor)
+    response.headers['Cache-Control'] = f"private, max-age={int(float(os.environ.get('GAME_LIST_CACHE_SECONDS', '5')))}"
+    return response
+
+
+@app.route('/games/<game_id>/stream')
+def stream_game_state(game_id):
+    # Server-sent events: a 'state' event with the whole game state, then a 'delta'
+    # event per change. Event ids are versions, so a reconnecting EventSource resumes
+    # from Last-Event-ID with deltas alone when this process still has them. When
+    # every stream slot is taken, the response ends once the viewer has caught up,
+    # and its retry field has the EventSource reconnect for more a few seconds later.
+    raw_version = request.headers.get('Last-Event-ID') or request.args.get('version')
+    known_version = int(raw_version) if raw_version else None
+    heartbeat_seconds = int(os.environ.get('STREAM_HEARTBEAT_SECONDS', '15'))
+    stored_state_dict = persistance.get_game_state_dict(game_id)
+
+    if stored_state_dict is None:
+        return (jsonify(error='The game does not exist!'), 404)
+
+    is_polling = not _stream_slots.acquire(blocking=False)
+    poll_milliseconds = int(float(os.environ.get('STREAM_POLL_SECONDS', '5')) * 1000)
+
+    def generate_events():
+        version = known_version
+        pending_deltas = None if version is None else deltas.get_deltas_since(game_id, version)
+
+        if pending_deltas == [] and stored_state_dict.get('version', 0) != version:
+            pending_deltas = None
+
+        if is_polling:
+            yield f'retry: {poll_milliseconds}\n\n'
+
+        while True:
+            if pending_deltas is None:
+                state_dict = persistance.get_game_state_dict(game_id)
+                version = state_dict.get('version', 0)
+                yield _format_server_sent_event('state', version, state_dict)
+                pending_deltas = deltas.get_deltas_since(game_id, version) or []
+
+            for delta in pending_deltas:
+                version = delta['version']
+                yield _format_server_sent_event('delta', version, delta)
+
+            if is_polling:
+                return
+
+            pending_deltas = deltas.wait_for_deltas(game_id, version, heartbeat_seconds)
+
+            if pending_deltas == []:
+                # another process may have committed to the game, which only shows in storage
+                if persistance.get_game_state_dict(game_id).get('version', 0) != version:
+                    pending_deltas = None
+                else:
+                    yield ': heartbeat\n\n'
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    response = Response(generate_events(), mimetype='text/event-stream', headers=headers)
+
+    if not is_polling:
+        response.call_on_close(_stream_slots.release)
+
+    return response
+
+
+def _format_server_sent_event(event_name, version, data):
+    return f'id: {version}\nevent: {event_name}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
+
+
 @app.route('/place_tile', methods=['POST'])
+@_game_action
 def place_tile():
     game_id = request.json['game_id']
     id_token = request.json['id_token']
@@ -45,119 +185,141 @@ def place_tile():
     raw_brand = request.json['brand']
     brand = None if raw_brand == '' else models.Brand(raw_brand)
 
-    player_id = firebase_admin.auth.verify_id_token(id_token)['uid']
-    state = persistance.get_game_state(game_id)
-    
-    if state.current_action_player != player_id:
-        raise models.RuleViolation("Stop trying to take other player's turns! You cheat!")
+    player_id = auth.get_user_id(id_token)
+    unit_of_work = persistance.begin_action(game_id, player_id)
 
-    if state.current_action_type != models.ActionType.PLACE_TILE:
-        raise models.RuleViolation('It is your turn, but it is not time to place a tile!')
+    with metrics.phase('rules'):
+        actions.place_tile(unit_of_work.state, unit_of_work, player_id, models.Tile(x, y), brand)
 
-    player_tiles = persistance.get_player_tiles(game_id, player_id)
+    unit_of_work.commit()
 
-    if not any(tile.x == x and tile.y == y for tile in player_tiles):
-        raise models.RuleViolation('You do not have that tile! Stop trying to cheat!')
+    return 'OK'
 
-    if not state.is_started:
-        raise models.RuleViolation('Cannot take turn until game has begun!')
 
-    tile = models.Tile(x, y)
-    place_tile_result = grid.place_tile(state, tile, brand)
-    stock.apply_majority_bonuses(state, place_tile_result.acquired_chains)
-    stock.award_founder_share(state, player_id, place_tile_result.new_brand)
-    grid.set_brand_lists(state)
-    stock.set_price_table(state)
-    turns.transition_from_place(state, place_tile_result, game_id)
-    
-    persistance.delete_player_tile(game_id, player_id, models.Tile(x, y))
-    # this should all happen atomically, but as a stopgap make sure this happens last
-    persistance.update_game_state(game_id, state.to_dict())
+@app.route('/legal_moves', methods=['POST'])
+@_game_action
+def legal_moves():
+    game_id = request.json['game_id']
+    id_token = request.json['id_token']
 
-    return 'OK'
+    player_id = auth.get_user_id(id_token)
+    unit_of_work = persistance.begin_action(game_id, player_id, is_read_only=True)
+
+    with metrics.phase('rules'):
+        moves = grid.legal_moves(unit_of_work.state, unit_of_work.player_tiles)
+
+    unit_of_work.release()
+
+    return jsonify(moves=[move.to_dict() for move in moves])
 
 
 @app.route('/resolve_acquisition', methods=['POST'])
+@_game_action
 def resolve_acquisition():
     game_id = request.json['game_id']
     id_token = request.json['id_token']
     sell_count = int(request.json['sell_count'])
     trade_count = int(request.json['trade_count'])
 
-    user_id = firebase_admin.auth.verify_id_token(id_token)['uid']
-    state = persistance.get_game_state(game_id)
+    user_id = auth.get_user_id(id_token)
+    unit_of_work = persistance.begin_action(game_id)
 
-    if state.current_action_player != user_id:
-        raise models.RuleViolation("Stop trying to take other player's turns! You cheat!")
+    with metrics.phase('rules'):
+        actions.resolve_acquisition(unit_of_work.state, unit_of_work, user_id, sell_count, trade_count)
 
-    if state.current_action_type != models.ActionType.RESOLVE_ACQUISITION:
-        raise models.RuleViolation('It is your turn, but it is not time to resolve an acquisition!')
+    unit_of_work.commit()
 
-    if not state.is_started:
-        raise models.RuleViolation('Cannot take turn until game has begun!')
+    return 'OK'
 
-    acquiree = models.Brand(state.current_action_details['acquiree'])
-    player_acquiree_stock_count = state.stock_by_player[user_id][acquiree]
 
-    if sell_count + trade_count > player_acquiree_stock_count:
-        raise models.RuleViolation('Cannot trade and sell more stock than you current have!')
+@app.route('/buy_stock', methods=['POST'])
+@_game_action
+def buy_stock():
+    game_id = request.json['game_id']
+    id_token = request.json['id_token']
+    purchase_order = request.json['purchase_order']
 
-    acquirer = models.Brand(state.current_action_details['acquirer'])
-    cost_at_acquisition_time = state.current_action_details['acquiree_cost_at_acquisition_time']
-    
-    stock.sell_stock(state, user_id, acquiree, cost_at_acquisition_time, sell_count)
-    stock.trade_stock(state, user_id, acquiree, acquirer, trade_count)
+    user_id = auth.get_user_id(id_token)
+    unit_of_work = persistance.begin_action(game_id)
 
-    turns.transition_from_resolve(state, game_id)
+    with metrics.phase('rules'):
+        actions.buy_stock(unit_of_work.state, unit_of_work, user_id, purchase_order)
 
-    persistance.update_game_state(game_id, state.to_dict())
+    unit_of_work.commit()
 
     return 'OK'
 
 
-@app.route('/buy_stock', methods=['POST'])
-def buy_stock():
-    max_purchase_amount = int(os.environ['MAX_STOCK_PURCHASE_AMOUNT'])
-    
+@app.route('/take_turn', methods=['POST'])
+@_game_action
+def take_turn():
     game_id = request.json['game_id']
     id_token = request.json['id_token']
-    purchase_order = request.json['purchase_order']
+    raw_actions = request.json.get('actions')
 
-    user_id = firebase_admin.auth.verify_id_token(id_token)['uid']
-    state = persistance.get_game_state(game_id)
+    if not isinstance(raw_actions, list):
+        raise models.RuleViolation('A turn must be a list of actions!')
 
-    if state.current_action_player != user_id:
-        raise models.RuleViolation("Stop trying to take other player's turns! You cheat!")
+    turn_actions = [_parse_turn_action(raw_action) for raw_action in raw_actions]
 
-    if state.current_action_type != models.ActionType.BUY_STOCK:
-        raise models.RuleViolation('It is your turn, but it is not time to buy stock!')
+    player_id = auth.get_user_id(id_token)
+    unit_of_work = persistance.begin_action(game_id, player_id)
 
-    if not state.is_started:
-        raise models.RuleViolation('Cannot take turn until game has begun!')
+    with metrics.phase('rules'):
+        applied_action_count = actions.take_turn(unit_of_work.state, unit_of_work, player_id, turn_actions)
 
-    total_stock_purchased = 0
+    unit_of_work.commit()
 
-    for raw_brand, raw_amount in purchase_order.items():
-        parsed_amount = int(raw_amount)
-        total_stock_purchased += parsed_amount
-        brand = models.Brand(raw_brand)
-        stock.buy_stock(state, user_id, brand, parsed_amount)
+    return jsonify(applied_action_count=applied_action_count)
 
-    if total_stock_purchased > max_purchase_amount:
-        raise models.RuleViolation('Too many stock in purchase order!')
 
-    turn_transitioned_state = turns.transition_from_buy(state, game_id)
+def _parse_turn_action(raw_action):
+    try:
+        return _read_turn_action(raw_action)
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        raise models.RuleViolation('A turn action is malformed!') from e
 
-    persistance.update_game_state(game_id, turn_transitioned_state.to_dict())
 
-    return 'OK'
+def _read_turn_action(raw_action):
+    action_type = raw_action['type']
+
+    if action_type == 'place_tile':
+        return {
+            'type': action_type,
+            'x': int(raw_action['x']),
+            'y': int(raw_action['y']),
+            'brand': models.Brand(raw_action['brand']).value if raw_action.get('brand') else None
+        }
+
+    if action_type == 'resolve_acquisition':
+        return {
+            'type': action_type,
+            'sell_count': int(raw_action.get('sell_count') or 0),
+            'trade_count': int(raw_action.get('trade_count') or 0)
+        }
+
+    if action_type == 'buy_stock':
+        return {
+            'type': action_type,
+            'purchase_order': {models.Brand(raw_brand).value: int(raw_amount or 0) for raw_brand, raw_amount in raw_action['purchase_order'].items()}
+        }
+
+    raise models.RuleViolation(f'{action_type} is not part of a turn!')
 
 
 @app.route('/create_game', methods=['POST'])
 def create_game():
     title = request.json['title']
+    id_token = request.json.get('id_token')
+    ruleset_overrides = request.json.get('ruleset') or {}
+
+    auth.get_user_id(id_token)
+
+    if not isinstance(ruleset_overrides, dict):
+        raise models.RuleViolation('Rules must be given by name!')
 
-    initial_state = models.GameState(title)
+    ruleset = models.Ruleset.from_dict({**models.default_ruleset().to_dict(), **ruleset_overrides})
+    initial_state = models.GameState(title, ruleset)
 
     game_id = persistance.create_game(title)
     persistance.create_game_state(game_id, initial_state)
@@ -166,90 +328,90 @@ def create_game():
 
 
 @app.route('/join_game', methods=['POST'])
+@_game_action
 def join_game():
     game_id = request.json['game_id']
     user_id = request.json['user_id']
 
-    game_state = persistance.get_game_state(game_id)
-
-    if user_id in game_state.player_order:
-        raise models.RuleViolation('Player is already in this game!')
-
-    if game_state.is_started:
-        raise models.RuleViolation('Cannot join a game in progress!')
-
+    unit_of_work = persistance.begin_action(game_id)
     user_data = persistance.get_user_data(user_id)
 
-    game_state.player_order.append(user_id)
-    game_state.money_by_player[user_id] = 6000
-    game_state.stock_by_player[user_id] = {brand: 0 for brand in models.Brand}
-    game_state.user_data_by_id[user_id] = user_data
+    with metrics.phase('rules'):
+        actions.join_game(unit_of_work.state, unit_of_work, user_id, user_data)
 
-    persistance.update_game_state(game_id, game_state.to_dict())
+    unit_of_work.commit()
 
     return 'OK'
 
 
 @app.route('/start_game', methods=['POST'])
+@_game_action
 def start_game():
     game_id = request.json['game_id']
 
-    game_state = persistance.get_game_state(game_id)
-    
-    if game_state.is_started:
-        raise models.RuleViolation('Cannot start already started game!')
+    unit_of_work = persistance.begin_action(game_id)
+    player_order = list(unit_of_work.state.player_order)
+    shuffle(player_order)
 
-    player_count_min = int(os.environ['PLAYER_COUNT_MIN'])
-    player_count_max = int(os.environ['PLAYER_COUNT_MAX'])
-    tile_hand_size = int(os.environ['TILE_HAND_SIZE'])
+    with metrics.phase('rules'):
+        actions.start_game(unit_of_work.state, unit_of_work, player_order, tiles.generate_deck_seed())
 
-    player_count = len(game_state.player_order)
+    unit_of_work.commit()
 
-    if not player_count_min <= player_count <= player_count_max:
-        raise models.RuleViolation(f'Cannot start game with {player_count} players!')
+    return 'OK'
 
-    shuffle(game_state.player_order)
-    starting_player = game_state.player_order[0]
 
-    initial_tiles = tiles.generate_initial_tiles()
+@app.errorhandler(models.RuleViolation)
+def handle_rule_violation(e):
+    return (jsonify(error=str(e)), 400)
 
-    board_starting_tiles = tiles.draw_tiles(initial_tiles, player_count)
-    for tile in board_starting_tiles:
-        grid.place_tile(game_state, tile)
 
-    game_state.is_started = True
-    game_state.current_turn_player = starting_player
-    game_state.current_action_player = starting_player
+@app.errorhandler(auth.InvalidIdToken)
+def handle_invalid_id_token(e):
+    return (jsonify(error=str(e)), 401)
 
-    tiles_by_player_id = { 
-        player_id: tiles.draw_tiles(initial_tiles, tile_hand_size) 
-        for player_id
-        in game_state.player_order
-    }
 
-    game_state.tiles_remaining = len(initial_tiles)
+@app.errorhandler(persistance.StaleGameState)
+def handle_stale_game_state(e):
+    return (jsonify(error='The game changed while your action was being processed! Please try again.'), 409)
 
-    persistance.initialize_global_tiles(game_id, initial_tiles)
-    persistance.initialize_player_tiles(game_id, tiles_by_player_id)
-    persistance.update_game_state(game_id, game_state.to_dict())
 
-    return 'OK'
 
+def warm_up():
+    # Primes what the first requests would otherwise pay for: the SDK imports and
+    # clients, the signing certificates and the default ruleset's board tables.
+    models.default_ruleset()
+    backend = persistance.get_backend()
 
-@app.errorhandler(models.RuleViolation)
-def handle_rule_violation(e):
-    return (jsonify(error=str(e)), 400)
+    if isinstance(backend, persistance.FirestoreBackend):
+        persistance.get_firestore_client()
 
+    auth.warm_up()
+
+
+@app.route('/_ah/warmup')
+def handle_warm_up():
+    warm_up()
+    return 'OK'
 
 
 @app.after_request
 def add_header(r):
-    if bool(int(os.environ.get('FORCE_REFRESH', '0'))):
+    # the game list sets its own short max-age, which is what keeps the lobby cheap
+    if bool(int(os.environ.get('FORCE_REFRESH', '0'))) and request.endpoint != 'list_games':
         r.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
         r.headers['Pragma'] = 'no-cache'
         r.headers['Expires'] = '0'
     return r
 
 
+if bool(int(os.environ.get('WARM_UP_ON_START', '0'))):
+    try:
+        warm_up()
+    except Exception:
+        # a failed warm-up only means the first requests do the work instead
+        traceback.print_exc()
+
+
 if __name__ == '__main__':
     app.run()
@@ -0,0 +1,215 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import collections
+
+import metrics
+
+
+# Firebase ID tokens are checked the way firebase_admin.auth.verify_id_token checks
+# them, with two caches in front. Google's signing certificates are kept until the
+# max-age they were served with, and refreshed in the background shortly before
+# that. They are fetched at most once a minute, one fetch at a time. Verified
+# claims are kept by token hash until the token's exp, so a player only pays for
+# verification on the first request made with each token.
+
+_CERTIFICATES_URL = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
+_CERTIFICATE_REFRESH_MARGIN = 300
+_CERTIFICATE_MIN_REFRESH_INTERVAL = 60
+_CLOCK_SKEW_IN_SECONDS = 10
+
+_fetch_certificates = None
+_certificates = None
+_certificates_expire_at = 0
+_certificates_fetched_at = 0
+_is_refreshing_certificates = False
+_certificates_lock = threading.Lock()
+_certificates_fetch_lock = threading.Lock()
+
+_claims_by_token_hash = collections.OrderedDict()
+_claims_lock = threading.Lock()
+
+_firebase_app = None
+_firebase_app_lock = threading.Lock()
+
+
+class InvalidIdToken(Exception):
+    pass
+
+
+def get_user_id(id_token):
+    with metrics.phase('auth'):
+        return verify_id_token(id_token)['uid']
+
+
+def verify_id_token(id_token):
+    if not isinstance(id_token, str) or not id_token:
+        raise InvalidIdToken('An ID token is required!')
+
+    token_hash = hashlib.sha256(id_token.encode('utf-8')).digest()
+
+    with _claims_lock:
+        claims = _claims_by_token_hash.get(token_hash)
+
+        if claims is not None and claims['exp'] > time.time():
+            _claims_by_token_hash.move_to_end(token_hash)
+            return claims
+
+    claims = _verify_id_token(id_token)
+    cache_size = int(os.environ.get('ID_TOKEN_CACHE_SIZE', '1024'))
+
+    with _claims_lock:
+        _claims_by_token_hash[token_hash] = claims
+
+        while len(_claims_by_token_hash) > cache_size:
+            _claims_by_token_hash.popitem(last=False)
+
+    return claims
+
+
+def get_firebase_app():
+    # the SDK is imported and initialized on first use rather than at startup, by one
+    # request while any others arriving at the same time wait for it
+    global _firebase_app
+
+    with _firebase_app_lock:
+        if _firebase_app is None:
+            import firebase_admin
+
+            try:
+                _firebase_app = firebase_admin.get_app()
+            except ValueError:
+                _firebase_app = firebase_admin.initialize_app()
+
+        return _firebase_app
+
+
+def prefetch_certificates():
+    _refresh_certificates()
+
+
+def warm_up():
+    get_firebase_app()
+    prefetch_certificates()
+
+
+def set_certificate_fetcher(fetch_certificates):
+    # fetch_certificates returns ({key id: PEM certificate}, max age in seconds)
+    global _fetch_certificates, _certificates, _certificates_expire_at, _certificates_fetched_at
+
+    with _certificates_lock:
+        _fetch_certificates = fetch_certificates or _fetch_google_certificates
+        _certificates = None
+        _certificates_expire_at = 0
+        _certificates_fetched_at = 0
+
+    with _claims_lock:
+        _claims_by_token_hash.clear()
+
+
+def _verify_id_token(id_token):
+    import google.auth.jwt
+
+    project_id = _get_project_id()
+
+    try:
+        header = google.auth.jwt.decode_header(id_token)
+    except ValueError as e:
+        raise InvalidIdToken('The ID token is malformed!') from e
+
+    if header.get('alg') != 'RS256' or not header.get('kid'):
+        raise InvalidIdToken('The ID token was not signed by Firebase!')
+
+    certificates = _get_certificates(header['kid'])
+
+    try:
+        claims = google.auth.jwt.decode(
+            id_token, certs=certificates, audience=project_id, clock_skew_in_seconds=_CLOCK_SKEW_IN_SECONDS)
+    except ValueError as e:
+        raise InvalidIdToken(f'The ID token is invalid: {e}') from e
+
+    if claims.get('iss') != f'https://securetoken.google.com/{project_id}':
+        raise InvalidIdToken('The ID token was issued for another project!')
+
+    subject = claims.get('sub')
+
+    if not isinstance(subject, str) or not subject or len(subject) > 128:
+        raise InvalidIdToken('The ID token has an invalid subject!')
+
+    return {**claims, 'uid': subject}
+
+
+def _get_project_id():
+    project_id = os.environ.get('FIREBASE_PROJECT_ID') or os.environ.get('GOOGLE_CLOUD_PROJECT')
+    return project_id or get_firebase_app().project_id
+
+
+def _get_certificates(key_id):
+    global _is_refreshing_certificates
+
+    with _certificates_lock:
+        certificates = _certificates
+        now = time.time()
+        is_usable = certificates is not None and key_id in certificates and now < _certificates_expire_at
+        is_expiring = now > _certificates_expire_at - _CERTIFICATE_REFRESH_MARGIN
+        should_refresh = is_usable and is_expiring and not _is_refreshing_certificates
+
+        if should_refresh:
+            _is_refreshing_certificates = True
+
+    # an unknown key id may mean the keys rotated early, so that fetch is waited on,
+    # unless the certificates were fetched too recently to have rotated since
+    if not is_usable:
+        certificates = _refresh_certificates()
+
+        if key_id not in certificates:
+            raise InvalidIdToken('The ID token was signed with an unknown key!')
+
+        return certificates
+
+    if should_refresh:
+        threading.Thread(target=_refresh_certificates, daemon=True).start()
+
+    return certificates
+
+
+def _refresh_certificates():
+    global _certificates, _certificates_expire_at, _certificates_fetched_at, _is_refreshing_certificates
+
+    try:
+        # requests that waited on a fetch in flight use what it fetched
+        with _certificates_fetch_lock:
+            with _certificates_lock:
+                is_recent = time.time() < _certificates_fetched_at + _CERTIFICATE_MIN_REFRESH_INTERVAL
+
+                if _certificates is not None and is_recent:
+                    return _certificates
+
+            certificates, max_age = (_fetch_certificates or _fetch_google_certificates)()
+
+            with _certificates_lock:
+                _certificates = certificates
+                _certificates_fetched_at = time.time()
+                _certificates_expire_at = _certificates_fetched_at + max(max_age, _CERTIFICATE_MIN_REFRESH_INTERVAL)
+    finally:
+        with _certificates_lock:
+            _is_refreshing_certificates = False
+
+    return certificates
+
+
+def _fetch_google_certificates():
+    import google.auth.transport.requests
+
+    response = google.auth.transport.requests.Request()(_CERTIFICATES_URL, method='GET')
+
+    if response.status != 200:
+        raise Exception(f'Could not fetch ID token certificates: {response.status}!')
+
+    max_age_match = re.search(r'max-age=(\d+)', response.headers.get('cache-control', ''))
+    max_age = int(max_age_match.group(1)) if max_age_match else 0
+
+    return json.loads(response.data.decode('utf-8')), max_age
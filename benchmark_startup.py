@@ -0,0 +1,80 @@
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+
+# Times a cold start: importing the app in a fresh interpreter, then serving its
+# first request. The in-memory backend is used so that only our own startup is
+# measured, not the network. Pass limits to fail when a change makes startup slower.
+
+_MEASURE_COLD_START = '''
+import json
+import time
+
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+
+import models
+import persistance
+
+persistance.create_game_state('benchmark', models.GameState('benchmark'))
+client = app.app.test_client()
+
+before_request = time.perf_counter()
+response = client.post('/join_game', json={'game_id': 'benchmark', 'user_id': 'benchmark'})
+after_request = time.perf_counter()
+
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'first_request_ms': (after_request - before_request) * 1000,
+    'status': response.status_code,
+}))
+'''
+
+
+def measure_cold_start():
+    result = subprocess.run(
+        [sys.executable, '-c', _MEASURE_COLD_START],
+        env={**os.environ, 'PERSISTANCE_BACKEND': 'memory', 'WARM_UP_ON_START': '0'},
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    timings = json.loads(result.stdout.decode('utf-8').strip().splitlines()[-1])
+
+    if timings['status'] != 200:
+        raise Exception(f"The first request failed with {timings['status']}!")
+
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure app import and first request latency.')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-import-ms', type=float)
+    parser.add_argument('--max-first-request-ms', type=float)
+    args = parser.parse_args()
+
+    runs = [measure_cold_start() for _ in range(args.runs)]
+    summary = {
+        'runs': args.runs,
+        'import_ms': statistics.median(run['import_ms'] for run in runs),
+        'first_request_ms': statistics.median(run['first_request_ms'] for run in runs),
+    }
+
+    print(json.dumps(summary, indent=2))
+
+    is_too_slow = (
+        (args.max_import_ms is not None and summary['import_ms'] > args.max_import_ms)
+        or (args.max_first_request_ms is not None and summary['first_request_ms'] > args.max_first_request_ms)
+    )
+
+    sys.exit(1 if is_too_slow else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import os
+import collections
+import threading
+
+
+# Deltas committed in this process, kept per game so that streams can send each
+# one as it happens and clients that reconnect can catch up from their version.
+# Each delta carries the version it was applied to as from_version, so a run of
+# buffered deltas can only be sent to a client whose version it starts from.
+
+_MAX_GAME_COUNT = 1024
+
+_deltas_by_game_id = collections.OrderedDict()
+_condition = threading.Condition()
+
+
+def publish(game_id, delta):
+    with _condition:
+        game_deltas = _deltas_by_game_id.get(game_id)
+
+        if game_deltas is None:
+            game_deltas = collections.deque(maxlen=int(os.environ.get('DELTA_HISTORY_SIZE', '64')))
+            _deltas_by_game_id[game_id] = game_deltas
+
+            if len(_deltas_by_game_id) > _MAX_GAME_COUNT:
+                _deltas_by_game_id.popitem(last=False)
+
+        _deltas_by_game_id.move_to_end(game_id)
+        game_deltas.append(delta)
+        _condition.notify_all()
+
+
+def clear():
+    with _condition:
+        _deltas_by_game_id.clear()
+
+
+def get_deltas_since(game_id, version):
+    # None when the buffered deltas cannot bring a client at version up to date
+    with _condition:
+        return _get_deltas_since(game_id, version)
+
+
+def wait_for_deltas(game_id, version, timeout):
+    with _condition:
+        _condition.wait_for(lambda: _get_deltas_since(game_id, version) != [], timeout)
+        return _get_deltas_since(game_id, version)
+
+
+def _get_deltas_since(game_id, version):
+    game_deltas = _deltas_by_game_id.get(game_id)
+
+    if not game_deltas or game_deltas[-1]['version'] <= version:
+        return []
+
+    if game_deltas[0]['from_version'] > version:
+        return None
+
+    return [delta for delta in game_deltas if delta['from_version'] >= version]
@@ -1,5 +1,3 @@
-import os
-
 import models
 import action_display
 
@@ -13,14 +11,27 @@ def place_tile(state, tile, brand=None):
     return place_tile_result
 
 
+def place_starting_tile(state, tile):
+    # starting tiles are dealt before anyone can brand a chain, so any that touch are
+    # joined into one unbranded chain
+    neighbors = get_unique_neighbors(state.grid, tile)
+
+    if neighbors:
+        _combine_chains(state, neighbors, None, tile)
+    else:
+        _create_chain(state, tile)
+
+    return state
+
+
 def _place_tile(state, tile, brand): 
-    if not 0 <= tile.x < int(os.environ['WIDTH']):
+    if not 0 <= tile.x < state.ruleset.width:
         raise models.RuleViolation('x coordinate is off the board!')
     
-    if not 0 <= tile.y < int(os.environ['HEIGHT']):
+    if not 0 <= tile.y < state.ruleset.height:
         raise models.RuleViolation('y coordinate is off the board!')
 
-    if state.grid[tile.x][tile.y] is not None:
+    if state.grid.find(tile.x, tile.y) is not None:
         raise models.RuleViolation('Space already has tile on it!')
 
     neighbors = get_unique_neighbors(state.grid, tile)
@@ -45,33 +56,62 @@ def _place_tile(state, tile, brand):
     return models.PlaceTileResult(state, acquired_chains, acquiree, new_brand, tile)
 
 
+def legal_moves(state, hand):
+    moves = []
+
+    for tile in hand:
+        move = _describe_placement(state, tile)
+
+        if move:
+            moves.append(move)
+
+    return moves
+
+
 def get_unique_neighbors(grid, tile):
-    return list({chain for chain in _get_nonunique_neighbors_with_nulls(grid, tile) if chain})
+    cell = tile.x * grid.height + tile.y
 
+    if not grid.ruleset.neighbor_masks[cell] & grid.occupied:
+        return []
 
-def get_branded_chains(state):
-    branded_chains = set()
+    # in board order rather than set order, so that ties between merging chains are
+    # broken the same way when a game is replayed
+    neighbors = dict.fromkeys(grid.find_cell(neighbor_cell) for neighbor_cell in grid.ruleset.neighbor_cells[cell])
+    neighbors.pop(None, None)
+    return list(neighbors)
 
-    for column in state.grid:
-        for chain in column:
-            if chain and chain.brand:
-                branded_chains.add(chain)
 
-    return list(branded_chains)
+def get_tiles_touching_chain(state, tiles, chain):
+    chain_neighbor_mask = state.grid.neighbor_mask(state.grid.chain_mask(chain))
+    return state.grid.tiles_from_mask(state.grid.tiles_mask(tiles) & chain_neighbor_mask)
 
 
-def find_chain(grid, brand):
-    for column in grid:
-        for chain in column:
-            if chain and chain.brand == brand:
-                return chain
+def get_tiles_touching_locked_chains(state, tiles):
+    locked_neighbor_mask = state.grid.neighbor_mask(get_locked_mask(state))
+    return state.grid.tiles_from_mask(state.grid.tiles_mask(tiles) & locked_neighbor_mask)
 
-    return None
+
+def get_locked_mask(state):
+    locked_mask = 0
+
+    for chain in state.chain_by_brand.values():
+        if chain.is_locked():
+            locked_mask |= state.grid.chain_mask(chain)
+
+    return locked_mask
+
+
+def get_branded_chains(state):
+    # in brand order, so a state loaded from storage settles like the live one
+    return [state.chain_by_brand[brand] for brand in sorted(state.chain_by_brand, key=models.Brand.order_helper)]
+
+
+def find_chain(state, brand):
+    return state.chain_by_brand.get(brand)
 
 
 def set_brand_lists(state):
-    branded_chains = get_branded_chains(state)
-    active_brands = [chain.brand for chain in branded_chains]
+    active_brands = list(state.chain_by_brand)
     inactive_brands = [brand for brand in models.Brand if brand not in active_brands]
 
     state.active_brands = sorted(active_brands, key=models.Brand.order_helper)
@@ -79,14 +119,58 @@ def set_brand_lists(state):
     return state
 
 
+def _describe_placement(state, tile):
+    # mirrors the rules enforced by _place_tile without touching state
+    if not (0 <= tile.x < state.ruleset.width and 0 <= tile.y < state.ruleset.height):
+        return None
+
+    if state.grid.find(tile.x, tile.y) is not None:
+        return None
+
+    neighbors = get_unique_neighbors(state.grid, tile)
+
+    if not neighbors:
+        return models.LegalMove(tile, models.PlacementType.PLACE, [None], [])
+
+    if len([neighbor for neighbor in neighbors if neighbor.is_locked()]) > 1:
+        return None
+
+    inactive_brands = [brand for brand in models.Brand if brand not in state.chain_by_brand]
+
+    if len(neighbors) == 1:
+        (chain,) = neighbors
+
+        if chain.brand:
+            return models.LegalMove(tile, models.PlacementType.GROW, [None], [])
+
+        if not inactive_brands:
+            return None
+
+        return models.LegalMove(tile, models.PlacementType.FOUND, inactive_brands, [])
+
+    branded_chains = [chain for chain in neighbors if chain.brand]
+
+    if not branded_chains:
+        return models.LegalMove(tile, models.PlacementType.MERGE, [None] + inactive_brands, [])
+
+    max_branded_chain_length = max(chain.size for chain in branded_chains)
+    largest_brands = sorted(
+        (chain.brand for chain in branded_chains if chain.size == max_branded_chain_length),
+        key=models.Brand.order_helper)
+
+    if len(largest_brands) == 1:
+        return models.LegalMove(tile, models.PlacementType.MERGE, [None], largest_brands)
+
+    return models.LegalMove(tile, models.PlacementType.MERGE, largest_brands, largest_brands)
+
+
 def _create_chain(state, tile):
-    chain = models.Chain([tile])
-    state.grid[tile.x][tile.y] = chain
+    state.grid.add(tile, models.Chain(state.ruleset))
     return state
 
 
 def _grow_chain(state, chain, brand, tile):
-    if brand in state.cost_by_brand:
+    if brand in state.chain_by_brand:
         raise models.RuleViolation('Cannot use brand already in use!')
     
     if brand is not None and chain.brand is not None:
@@ -96,26 +180,24 @@ def _grow_chain(state, chain, brand, tile):
         raise models.RuleViolation('Cannot grow chain without branding it!')
 
     if brand:
-        chain.brand = brand
+        state.set_attribute(chain, 'brand', brand)
+        state.set_item(state.chain_by_brand, brand, chain)
 
-    chain.tiles.append(tile)
-    
-    state.grid[tile.x][tile.y] = chain
+    state.grid.add(tile, chain)
     return state
 
 
-def _merge_chains(state, current_chains, brand, tile):
-    new_chain = models.Chain([tile])
-    chains = current_chains + [new_chain]
-
+def _merge_chains(state, chains, brand, tile):
     branded_chains = [chain for chain in chains if chain.brand]
 
     if not any(branded_chains):
-        return _combine_chains(state, chains, brand)
+        if brand in state.chain_by_brand:
+            raise models.RuleViolation('Cannot use brand already in use!')
 
-    max_branded_chain_length_example = max(branded_chains, key=lambda c: len(c.tiles))
-    max_branded_chain_length = len(max_branded_chain_length_example.tiles)
-    largest_brands = [chain.brand for chain in branded_chains if len(chain.tiles) == max_branded_chain_length]
+        return _combine_chains(state, chains, brand, tile)
+
+    max_branded_chain_length = max(chain.size for chain in branded_chains)
+    largest_brands = [chain.brand for chain in branded_chains if chain.size == max_branded_chain_length]
 
     largest_brand_count = len(largest_brands)
 
@@ -123,7 +205,7 @@ def _merge_chains(state, current_chains, brand, tile):
         if brand:
             raise models.RuleViolation('Cannot choose a brand when there is uniquely one largest!')
 
-        return _combine_chains(state, chains, largest_brands[0])
+        return _combine_chains(state, chains, largest_brands[0], tile)
 
     if not brand:
         raise models.RuleViolation('Must choose a brand!')
@@ -131,21 +213,29 @@ def _merge_chains(state, current_chains, brand, tile):
     if brand not in largest_brands:
         raise models.RuleViolation('Must choose one of the largest brands!')
 
-    return _combine_chains(state, chains, brand)
-
+    return _combine_chains(state, chains, brand, tile)
 
-def _combine_chains(state, chains, brand):
-    tiles = [tile for chain in chains for tile in chain.tiles]
-    new_chain = models.Chain(tiles, brand)
-
-    for tile in tiles:
-        state.grid[tile.x][tile.y] = new_chain
 
+def _combine_chains(state, chains, brand, tile):
     acquired_chains = [chain for chain in chains if chain.brand not in [None, brand]]
 
     any_branded_chains = any(chain.brand for chain in chains)
     new_brand = brand if not any_branded_chains else None
 
+    # the acquirer's chain object survives the merge, so the acquired chains are left
+    # untouched and still report their size from before the acquisition
+    survivor = next((chain for chain in chains if chain.brand == brand), chains[0])
+    state.set_attribute(survivor, 'brand', brand)
+
+    for chain in acquired_chains:
+        state.delete_item(state.chain_by_brand, chain.brand)
+
+    if brand:
+        state.set_item(state.chain_by_brand, brand, survivor)
+
+    state.grid.merge(chains, survivor)
+    state.grid.add(tile, survivor)
+
     return (acquired_chains, brand, new_brand)
 
 
@@ -159,17 +249,3 @@ def _partition(source, pred):
             negative.append(elem)
 
     return positive, negative
-
-
-def _get_nonunique_neighbors_with_nulls(grid, tile):
-    x = tile.x
-    y = tile.y
-    
-    if x > 0:
-        yield grid[x - 1][y]
-    if x < int(os.environ['WIDTH']) - 1:
-        yield grid[x + 1][y]
-    if y > 0:
-        yield grid[x][y - 1]
-    if y < int(os.environ['HEIGHT']) - 1:
-        yield grid[x][y + 1]
@@ -0,0 +1,71 @@
+import os
+import functools
+
+import models
+
+
+# A dense copy of the players' stock and cash for settling many chains at once:
+# stock is a players x brands integer array and cash a vector, both in the order of
+# stock_by_player, with brands in Brand order. It is used when DENSE_LEDGER=1, and
+# needs NumPy, which is optional. Otherwise stock is settled through the dicts.
+
+BRAND_COLUMNS = {brand: column for column, brand in enumerate(models.Brand)}
+
+
+def is_enabled():
+    if not bool(int(os.environ.get('DENSE_LEDGER', '0'))):
+        return False
+
+    if get_numpy() is None:
+        raise Exception('DENSE_LEDGER is set, but NumPy is not installed!')
+
+    return True
+
+
+@functools.lru_cache(maxsize=None)
+def get_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+
+    return numpy
+
+
+class Ledger:
+    __slots__ = ('player_ids', 'row_by_player_id', 'stock', 'cash')
+
+    def __init__(self, player_ids, stock, cash):
+        self.player_ids = player_ids
+        self.row_by_player_id = {player_id: row for row, player_id in enumerate(player_ids)}
+        self.stock = stock
+        self.cash = cash
+
+    @staticmethod
+    def from_state(state):
+        numpy = get_numpy()
+        player_ids = list(state.stock_by_player)
+
+        stock = numpy.array(
+            [[state.stock_by_player[player_id][brand] for brand in models.Brand] for player_id in player_ids],
+            dtype=numpy.int64
+        ).reshape(len(player_ids), len(BRAND_COLUMNS))
+        cash = numpy.array([state.money_by_player[player_id] for player_id in player_ids], dtype=numpy.int64)
+
+        return Ledger(player_ids, stock, cash)
+
+    def write_to_state(self, state):
+        # back to the dicts as plain ints, through set_item so the changes are journaled
+        for row, player_id in enumerate(self.player_ids):
+            stock_by_brand = state.stock_by_player[player_id]
+
+            for brand, stock_count in zip(models.Brand, self.stock[row].tolist()):
+                if stock_by_brand[brand] != stock_count:
+                    state.set_item(stock_by_brand, brand, stock_count)
+
+            money = int(self.cash[row])
+
+            if state.money_by_player[player_id] != money:
+                state.set_item(state.money_by_player, player_id, money)
+
+        return state
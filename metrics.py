@@ -0,0 +1,167 @@
+import os
+import io
+import sys
+import time
+import cProfile
+import pstats
+import itertools
+import threading
+import contextlib
+import collections
+
+
+# Timings for the phases of each request: auth, the read from storage, decoding the
+# state, the rules, encoding the changes and the write. The phases of a request are
+# sent back in its Server-Timing header, and every request's timings are added to
+# per endpoint latency histograms which, with the count of Firestore calls each
+# endpoint makes, are served in Prometheus' text format. The histograms belong to
+# this process, so each app process behind the router reports its own.
+#
+# With PROFILE_SAMPLE_RATE=N, one request in N is also run under cProfile and its
+# busiest functions are printed to stderr.
+
+_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_PROFILE_LINE_COUNT = 30
+
+_request_timings = threading.local()
+_request_numbers = itertools.count(1)
+
+_histograms = {}
+_request_counts = collections.Counter()
+_firestore_call_counts = collections.Counter()
+_metrics_lock = threading.Lock()
+
+
+def begin_request(endpoint):
+    profile = None
+    profile_sample_rate = int(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+
+    if profile_sample_rate and next(_request_numbers) % profile_sample_rate == 0:
+        profile = cProfile.Profile()
+
+        try:
+            profile.enable()
+        except ValueError:
+            # only one profiler can run at a time, so this sample is skipped
+            profile = None
+
+    _request_timings.current = {
+        'endpoint': endpoint,
+        'started_at': time.perf_counter(),
+        'seconds_by_phase': collections.OrderedDict(),
+        'profile': profile,
+    }
+
+
+def end_request(status_code):
+    # returns the value of the request's Server-Timing header
+    timings = getattr(_request_timings, 'current', None)
+
+    if timings is None:
+        return None
+
+    _request_timings.current = None
+    seconds_by_phase = timings['seconds_by_phase']
+    seconds_by_phase['total'] = time.perf_counter() - timings['started_at']
+    endpoint = timings['endpoint']
+
+    if timings['profile'] is not None:
+        timings['profile'].disable()
+        _print_profile(endpoint, timings['profile'])
+
+    with _metrics_lock:
+        _request_counts[(endpoint, str(status_code))] += 1
+
+        for phase_name, seconds in seconds_by_phase.items():
+            _observe(endpoint, phase_name, seconds)
+
+    return ', '.join(
+        f'{phase_name};dur={seconds * 1000:.2f}'
+        for phase_name, seconds
+        in seconds_by_phase.items()
+    )
+
+
+@contextlib.contextmanager
+def phase(phase_name):
+    timings = getattr(_request_timings, 'current', None)
+    started_at = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        if timings is not None:
+            seconds_by_phase = timings['seconds_by_phase']
+            seconds_by_phase[phase_name] = seconds_by_phase.get(phase_name, 0) + time.perf_counter() - started_at
+
+
+def count_firestore_call(operation):
+    timings = getattr(_request_timings, 'current', None)
+    endpoint = 'none' if timings is None else timings['endpoint']
+
+    with _metrics_lock:
+        _firestore_call_counts[(endpoint, operation)] += 1
+
+
+def reset():
+    with _metrics_lock:
+        _histograms.clear()
+        _request_counts.clear()
+        _firestore_call_counts.clear()
+
+
+def render_prometheus():
+    with _metrics_lock:
+        lines = [
+            '# HELP acquire_requests_total Requests served, by endpoint and status.',
+            '# TYPE acquire_requests_total counter',
+        ]
+
+        for (endpoint, status), count in sorted(_request_counts.items()):
+            lines.append(f'acquire_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+
+        lines.append('# HELP acquire_request_phase_seconds Time spent in each phase of a request.')
+        lines.append('# TYPE acquire_request_phase_seconds histogram')
+
+        for (endpoint, phase_name), histogram in sorted(_histograms.items()):
+            labels = f'endpoint="{endpoint}",phase="{phase_name}"'
+            cumulative_count = 0
+
+            for bucket, bucket_count in zip(_LATENCY_BUCKETS, histogram['bucket_counts']):
+                cumulative_count += bucket_count
+                lines.append(f'acquire_request_phase_seconds_bucket{{{labels},le="{bucket}"}} {cumulative_count}')
+
+            lines.append(f'acquire_request_phase_seconds_bucket{{{labels},le="+Inf"}} {histogram["count"]}')
+            lines.append(f'acquire_request_phase_seconds_sum{{{labels}}} {histogram["sum"]}')
+            lines.append(f'acquire_request_phase_seconds_count{{{labels}}} {histogram["count"]}')
+
+        lines.append('# HELP acquire_firestore_calls_total Firestore calls made, by endpoint and operation.')
+        lines.append('# TYPE acquire_firestore_calls_total counter')
+
+        for (endpoint, operation), count in sorted(_firestore_call_counts.items()):
+            lines.append(f'acquire_firestore_calls_total{{endpoint="{endpoint}",operation="{operation}"}} {count}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def _observe(endpoint, phase_name, seconds):
+    histogram = _histograms.get((endpoint, phase_name))
+
+    if histogram is None:
+        histogram = {'bucket_counts': [0] * len(_LATENCY_BUCKETS), 'sum': 0.0, 'count': 0}
+        _histograms[(endpoint, phase_name)] = histogram
+
+    # counts are kept per bucket and summed when rendered
+    for index, bucket in enumerate(_LATENCY_BUCKETS):
+        if seconds <= bucket:
+            histogram['bucket_counts'][index] += 1
+            break
+
+    histogram['sum'] += seconds
+    histogram['count'] += 1
+
+
+def _print_profile(endpoint, profile):
+    output = io.StringIO()
+    pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(_PROFILE_LINE_COUNT)
+    print(f'Profile of a request to {endpoint}:\n{output.getvalue()}', file=sys.stderr)
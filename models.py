@@ -1,11 +1,32 @@
 import os
+import re
+import json
 import enum
+import bisect
+import functools
+import threading
+import collections
 
 import toolz
 
 import grid
 
 
+_MISSING = object()
+DELETE_FIELD = object()
+_EMPTY_CELL = '.'
+_FIRST_CHAIN_CODE_POINT = 0x30
+_SIMPLE_FIELD_NAME = re.compile(r'^[_a-zA-Z][_a-zA-Z0-9]*$')
+
+# no ruleset's board is wider or taller than this
+MAX_BOARD_DIMENSION = 32
+_MAX_TILE_HAND_SIZE = 12
+_MAX_STOCK_PURCHASE_AMOUNT = 25
+_MAX_PLAYER_COUNT = 8
+_MAX_RECENT_ACTION_DISPLAY_COUNT = 500
+_MAX_CACHED_RULESET_COUNT = 64
+
+
 class Brand(enum.Enum):
     TOWER = 'T'
     LUXOR = 'L'
@@ -28,10 +49,42 @@ class ActionType(enum.Enum):
     GAME_OVER = 'GAME_OVER'
 
 
+class PlacementType(enum.Enum):
+    PLACE = 'PLACE'
+    FOUND = 'FOUND'
+    GROW = 'GROW'
+    MERGE = 'MERGE'
+
+
 class Tile:
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
+    # Tiles are interned: Tile(x, y) always hands back the same object for the same
+    # space, so tiles compare and hash by identity and are never mutated. Positions
+    # off every board are not interned, so clients cannot grow the table; such tiles
+    # are rejected by the rules anyway.
+    __slots__ = ('x', 'y')
+
+    _tiles_by_position = {}
+
+    def __new__(cls, x, y):
+        if not (0 <= x < MAX_BOARD_DIMENSION and 0 <= y < MAX_BOARD_DIMENSION):
+            tile = object.__new__(cls)
+            tile.x = x
+            tile.y = y
+            return tile
+
+        position = (x, y)
+        tile = cls._tiles_by_position.get(position)
+
+        if tile is None:
+            tile = object.__new__(cls)
+            tile.x = x
+            tile.y = y
+            cls._tiles_by_position[position] = tile
+
+        return tile
+
+    def __reduce__(self):
+        return (Tile, (self.x, self.y))
 
     def to_dict(self):
         return {
@@ -40,27 +93,480 @@ class Tile:
         }
 
 
-class Chain:
-    def __init__(self, tiles, brand=None):
+# A price schedule gives a branded chain a value tier: the index of the largest
+# entry of size_tiers its size reaches, plus the tier of its brand. Each value tier
+# has a stock price and first and second majority bonuses. More schedules can be
+# loaded by name from the JSON file at PRICE_SCHEDULES_PATH.
+PRICE_SCHEDULES = {
+    'classic': {
+        'size_tiers': [2, 3, 4, 5, 6, 11, 21, 31, 41],
+        'brand_tiers': {'T': 0, 'L': 0, 'W': 1, 'A': 1, 'F': 1, 'I': 2, 'C': 2},
+        'prices': [200, 300, 400, 500, 600, 700, 800, 900, 1000, 1100, 1200],
+        'first_bonuses': [2000, 3000, 4000, 5000, 6000, 7000, 8000, 9000, 10000, 11000, 12000],
+        'second_bonuses': [1000, 1500, 2000, 2500, 3000, 3500, 4000, 4500, 5000, 5500, 6000],
+    },
+}
+
+
+def get_price_schedule(name):
+    price_schedule = PRICE_SCHEDULES.get(name) or _load_price_schedules().get(name)
+
+    if price_schedule is None:
+        raise RuleViolation(f'Unknown price schedule {name}!')
+
+    return price_schedule
+
+
+@functools.lru_cache(maxsize=None)
+def _load_price_schedules():
+    price_schedules_path = os.environ.get('PRICE_SCHEDULES_PATH')
+
+    if not price_schedules_path:
+        return {}
+
+    with open(price_schedules_path) as price_schedules_file:
+        return json.load(price_schedules_file)
+
+
+def _build_pricing_by_brand(price_schedule, cell_count):
+    # pricing_by_brand[brand][size] is (price, first bonus, second bonus), or None
+    # for sizes too small to be branded
+    size_tiers = price_schedule['size_tiers']
+    brand_tiers = price_schedule['brand_tiers']
+    pricing_by_tier = list(zip(price_schedule['prices'], price_schedule['first_bonuses'], price_schedule['second_bonuses']))
+
+    if any(brand.value not in brand_tiers for brand in Brand):
+        raise RuleViolation('The price schedule must give every brand a tier!')
+
+    if len(size_tiers) + max(brand_tiers.values()) > len(pricing_by_tier):
+        raise RuleViolation('The price schedule must price every value tier!')
+
+    return {
+        brand: tuple(
+            pricing_by_tier[bisect.bisect_right(size_tiers, size) - 1 + brand_tiers[brand.value]] if size >= size_tiers[0] else None
+            for size
+            in range(cell_count + 1)
+        )
+        for brand
+        in Brand
+    }
+
+
+class Ruleset:
+    # The settings a game is played under, parsed and validated once. Rulesets with
+    # the same settings are shared, along with the tables precomputed for their
+    # board size, while they are among the most recently used. Cells are numbered
+    # x * height + y throughout.
+    _FIELDS = (
+        'width',
+        'height',
+        'lock_minimum',
+        'win_size',
+        'tile_hand_size',
+        'max_stock_purchase_amount',
+        'player_count_min',
+        'player_count_max',
+        'recent_action_display_count',
+    )
+
+    __slots__ = _FIELDS + (
+        'price_schedule',
+        'pricing_by_brand',
+        'tiles',
+        'neighbor_cells',
+        'neighbor_masks',
+        'board_mask',
+        'not_first_row_mask',
+        'not_last_row_mask',
+    )
+
+    _rulesets_by_settings = collections.OrderedDict()
+    _rulesets_lock = threading.Lock()
+
+    def __init__(self, width, height, lock_minimum, win_size, tile_hand_size,
+                 max_stock_purchase_amount, player_count_min, player_count_max, recent_action_display_count,
+                 price_schedule='classic'):
+        if width < 1 or height < 1:
+            raise RuleViolation('The board must have at least one space!')
+
+        if width > MAX_BOARD_DIMENSION or height > MAX_BOARD_DIMENSION:
+            raise RuleViolation(f'The board cannot be more than {MAX_BOARD_DIMENSION} spaces across!')
+
+        if lock_minimum < 2 or win_size < 2:
+            raise RuleViolation('Chains cannot lock or win below two tiles!')
+
+        if lock_minimum > width * height or win_size > width * height:
+            raise RuleViolation('Chains cannot lock or win above the size of the board!')
+
+        if not 1 <= tile_hand_size <= _MAX_TILE_HAND_SIZE:
+            raise RuleViolation(f'Players must hold between 1 and {_MAX_TILE_HAND_SIZE} tiles!')
+
+        if not 0 <= max_stock_purchase_amount <= _MAX_STOCK_PURCHASE_AMOUNT:
+            raise RuleViolation(f'Stock purchases must be capped between 0 and {_MAX_STOCK_PURCHASE_AMOUNT}!')
+
+        if not 1 <= player_count_min <= player_count_max <= _MAX_PLAYER_COUNT:
+            raise RuleViolation('Invalid player count range!')
+
+        if player_count_max * (tile_hand_size + 1) > width * height:
+            raise RuleViolation('The board is too small to deal every player a hand!')
+
+        if not 1 <= recent_action_display_count <= _MAX_RECENT_ACTION_DISPLAY_COUNT:
+            raise RuleViolation(f'Must display between 1 and {_MAX_RECENT_ACTION_DISPLAY_COUNT} recent actions!')
+
+        self.width = width
+        self.height = height
+        self.lock_minimum = lock_minimum
+        self.win_size = win_size
+        self.tile_hand_size = tile_hand_size
+        self.max_stock_purchase_amount = max_stock_purchase_amount
+        self.player_count_min = player_count_min
+        self.player_count_max = player_count_max
+        self.recent_action_display_count = recent_action_display_count
+        self.price_schedule = price_schedule
+        self.pricing_by_brand = _build_pricing_by_brand(get_price_schedule(price_schedule), width * height)
+
+        self.tiles = tuple(Tile(x, y) for x in range(width) for y in range(height))
+        self.neighbor_cells = tuple(
+            tuple(
+                nx * height + ny
+                for nx, ny in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1))
+                if 0 <= nx < width and 0 <= ny < height
+            )
+            for x in range(width)
+            for y in range(height)
+        )
+        self.neighbor_masks = tuple(sum(1 << cell for cell in cells) for cells in self.neighbor_cells)
+
+        column_mask = (1 << height) - 1
+        self.board_mask = (1 << (width * height)) - 1
+        self.not_last_row_mask = sum((column_mask >> 1) << (x * height) for x in range(width))
+        self.not_first_row_mask = self.not_last_row_mask << 1
+
+    def to_dict(self):
+        return { **{ field: getattr(self, field) for field in Ruleset._FIELDS }, 'price_schedule': self.price_schedule }
+
+    @staticmethod
+    def from_dict(ruleset_data):
+        unknown_fields = ruleset_data.keys() - set(Ruleset._FIELDS) - {'price_schedule'}
+
+        if unknown_fields:
+            raise RuleViolation(f'Unknown rules: {", ".join(sorted(unknown_fields))}')
+
+        missing_fields = set(Ruleset._FIELDS) - ruleset_data.keys()
+
+        if missing_fields:
+            raise RuleViolation(f'Missing rules: {", ".join(sorted(missing_fields))}')
+
+        try:
+            settings = tuple(int(ruleset_data[field]) for field in Ruleset._FIELDS)
+        except (TypeError, ValueError):
+            raise RuleViolation('Rules must be whole numbers!')
+
+        # rulesets stored before price schedules were added use the classic one
+        settings += (str(ruleset_data.get('price_schedule') or 'classic'),)
+
+        with Ruleset._rulesets_lock:
+            ruleset = Ruleset._rulesets_by_settings.get(settings)
+
+            if ruleset is not None:
+                Ruleset._rulesets_by_settings.move_to_end(settings)
+                return ruleset
+
+        ruleset = Ruleset(*settings)
+
+        with Ruleset._rulesets_lock:
+            ruleset = Ruleset._rulesets_by_settings.setdefault(settings, ruleset)
+            Ruleset._rulesets_by_settings.move_to_end(settings)
+
+            while len(Ruleset._rulesets_by_settings) > _MAX_CACHED_RULESET_COUNT:
+                Ruleset._rulesets_by_settings.popitem(last=False)
+
+        return ruleset
+
+    @staticmethod
+    def from_env():
+        return Ruleset.from_dict({
+            **{ field: os.environ[field.upper()] for field in Ruleset._FIELDS },
+            'price_schedule': os.environ.get('PRICE_SCHEDULE', 'classic'),
+        })
+
+
+@functools.lru_cache(maxsize=None)
+def default_ruleset():
+    return Ruleset.from_env()
+
+
+class Deck:
+    # A fixed tile order plus a cursor at the next tile to draw. The order is derived
+    # from seed, which is None for decks stored as a plain tile array.
+    __slots__ = ('tiles', 'cursor', 'seed')
+
+    def __init__(self, tiles, cursor=0, seed=None):
         self.tiles = tiles
+        self.cursor = cursor
+        self.seed = seed
+
+    def remaining(self):
+        return len(self.tiles) - self.cursor
+
+
+class Chain:
+    __slots__ = ('ruleset', 'brand', 'size')
+
+    def __init__(self, ruleset, brand=None):
+        self.ruleset = ruleset
         self.brand = brand
+        self.size = 0
 
     def is_locked(self):
-        return (self.brand is not None) and (len(self.tiles) >= int(os.environ['LOCK_MINIMUM']))
+        return (self.brand is not None) and (self.size >= self.ruleset.lock_minimum)
 
     def to_dict(self):
         return {
             'brand': self.brand.value if self.brand else None,
             'is_locked': self.is_locked(),
-            'count': len(self.tiles)
+            'count': self.size
         }
 
 
+class ChainIndex:
+    # Disjoint-set over board cells. Each cell points towards a root cell, and each
+    # root cell owns the Chain object for its set. Indexing as grid[x][y] resolves
+    # the chain at that cell, so it can be read like the old list of columns.
+    #
+    # Alongside the sets it keeps bitboards: bit x * height + y of `occupied` is set
+    # for every placed tile, and each root also owns the mask of its chain's cells.
+    def __init__(self, ruleset):
+        self.ruleset = ruleset
+        self.width = ruleset.width
+        self.height = ruleset.height
+        self.occupied = 0
+        self.undo_log = None
+        self._parents = [None] * (ruleset.width * ruleset.height)
+        self._chain_by_root = {}
+        self._root_by_chain = {}
+        self._mask_by_root = {}
+
+    def __len__(self):
+        return self.width
+
+    def __getitem__(self, x):
+        if not 0 <= x < self.width:
+            raise IndexError('x coordinate is off the board!')
+
+        return _ChainIndexColumn(self, x)
+
+    def __iter__(self):
+        return (_ChainIndexColumn(self, x) for x in range(self.width))
+
+    def find(self, x, y):
+        return self.find_cell(x * self.height + y)
+
+    def find_cell(self, cell):
+        root = self._find_root(cell)
+
+        if root is None:
+            return None
+
+        return self._chain_by_root[root]
+
+    def find_chain_id(self, x, y):
+        # the root cell of the chain, which stays the same until that chain is merged
+        return self._find_root(x * self.height + y)
+
+    def add(self, tile, chain):
+        cell = tile.x * self.height + tile.y
+        bit = 1 << cell
+        root = self._root_by_chain.get(chain)
+        is_new_root = root is None
+
+        if is_new_root:
+            root = cell
+            self._chain_by_root[root] = chain
+            self._root_by_chain[chain] = root
+            self._mask_by_root[root] = 0
+
+        if self.undo_log is not None:
+            self.undo_log.append((self._undo_add, (cell, root, is_new_root)))
+
+        self._parents[cell] = root
+        self._mask_by_root[root] |= bit
+        self.occupied |= bit
+        chain.size += 1
+
+        return chain
+
+    def merge(self, chains, survivor):
+        # union by size: the root of the largest set adopts the other roots. The
+        # merged away chains keep their old size so callers can still price them.
+        largest_chain = max(chains, key=lambda c: c.size)
+        new_root = self._root_by_chain[largest_chain]
+        total_size = 0
+        total_mask = 0
+
+        if self.undo_log is not None:
+            merged = [(chain, self._root_by_chain[chain], self.chain_mask(chain)) for chain in chains]
+            self.undo_log.append((self._undo_merge, (new_root, survivor, survivor.size, merged)))
+
+        for chain in chains:
+            root = self._root_by_chain.pop(chain)
+            del self._chain_by_root[root]
+            total_mask |= self._mask_by_root.pop(root)
+            self._parents[root] = new_root
+            total_size += chain.size
+
+        survivor.size = total_size
+        self._chain_by_root[new_root] = survivor
+        self._root_by_chain[survivor] = new_root
+        self._mask_by_root[new_root] = total_mask
+
+        return survivor
+
+    def chain_mask(self, chain):
+        root = self._root_by_chain.get(chain)
+
+        if root is None:
+            return 0
+
+        return self._mask_by_root[root]
+
+    def tiles_mask(self, tiles):
+        mask = 0
+
+        for tile in tiles:
+            mask |= 1 << (tile.x * self.height + tile.y)
+
+        return mask
+
+    def neighbor_mask(self, mask):
+        # every cell orthogonally adjacent to some cell of mask, excluding mask itself
+        ruleset = self.ruleset
+        height = self.height
+        neighbors = (
+            (mask << height)
+            | (mask >> height)
+            | ((mask & ruleset.not_last_row_mask) << 1)
+            | ((mask & ruleset.not_first_row_mask) >> 1)
+        )
+
+        return neighbors & ruleset.board_mask & ~mask
+
+    def tiles_from_mask(self, mask):
+        tiles = []
+        tiles_by_cell = self.ruleset.tiles
+
+        while mask:
+            low_bit = mask & -mask
+            tiles.append(tiles_by_cell[low_bit.bit_length() - 1])
+            mask ^= low_bit
+
+        return tiles
+
+    def _find_root(self, cell):
+        parents = self._parents
+        root = parents[cell]
+
+        if root is None:
+            return None
+
+        while parents[root] != root:
+            root = parents[root]
+
+        # path compression would outlive an undone merge, so skip it while recording
+        if self.undo_log is not None:
+            return root
+
+        while cell != root:
+            next_cell = parents[cell]
+            parents[cell] = root
+            cell = next_cell
+
+        return root
+
+    def _undo_add(self, cell, root, is_new_root):
+        bit = 1 << cell
+        chain = self._chain_by_root[root]
+
+        self._parents[cell] = None
+        self._mask_by_root[root] &= ~bit
+        self.occupied &= ~bit
+        chain.size -= 1
+
+        if is_new_root:
+            del self._chain_by_root[root]
+            del self._root_by_chain[chain]
+            del self._mask_by_root[root]
+
+    def _undo_merge(self, new_root, survivor, survivor_size, merged):
+        del self._chain_by_root[new_root]
+        del self._root_by_chain[survivor]
+        del self._mask_by_root[new_root]
+
+        for chain, root, mask in merged:
+            self._parents[root] = root
+            self._chain_by_root[root] = chain
+            self._root_by_chain[chain] = root
+            self._mask_by_root[root] = mask
+
+        survivor.size = survivor_size
+
+
+class _ChainIndexColumn:
+    __slots__ = ('_index', '_x')
+
+    def __init__(self, index, x):
+        self._index = index
+        self._x = x
+
+    def __len__(self):
+        return self._index.height
+
+    def __getitem__(self, y):
+        if not 0 <= y < self._index.height:
+            raise IndexError('y coordinate is off the board!')
+
+        return self._index.find(self._x, y)
+
+    def __iter__(self):
+        return (self._index.find(self._x, y) for y in range(self._index.height))
+
+
 class GameState:
-    def __init__(self, title):
+    __slots__ = (
+        '_undo_log',
+        '_persisted_dict',
+        'ruleset',
+        'is_started',
+        'title',
+        'grid',
+        'chain_by_brand',
+        'player_order',
+        'current_turn_player',
+        'current_action_player',
+        'current_action_type',
+        'current_action_details',
+        'stock_availability',
+        'stock_by_player',
+        'money_by_player',
+        'user_data_by_id',
+        'tiles_remaining',
+        'cost_by_brand',
+        'inactive_brands',
+        'active_brands',
+        'most_recently_placed_tile',
+        'most_recent_actions',
+        'acquisition_resolution_queue',
+        'version',
+    )
+
+    def __init__(self, title, ruleset=None):
+        object.__setattr__(self, '_undo_log', None)
+        self._persisted_dict = None
+        self.ruleset = ruleset or default_ruleset()
         self.is_started = False
         self.title = title
-        self.grid = GameState._generate_initial_grid()
+        self.grid = GameState._generate_initial_grid(self.ruleset)
+        self.chain_by_brand = {}
         self.player_order = []
         self.current_turn_player = None
         self.current_action_player = None
@@ -77,13 +583,76 @@ class GameState:
         self.most_recently_placed_tile = None
         self.most_recent_actions = []
         self.acquisition_resolution_queue = []
+        self.version = 0
+
+
+    def __setattr__(self, name, value):
+        undo_log = getattr(self, '_undo_log', None)
+
+        if undo_log is not None:
+            undo_log.append((_restore_attribute, (self, name, getattr(self, name, _MISSING))))
+
+        object.__setattr__(self, name, value)
+
+
+    def set_attribute(self, target, name, value):
+        if self._undo_log is not None:
+            self._undo_log.append((_restore_attribute, (target, name, getattr(target, name, _MISSING))))
+
+        setattr(target, name, value)
+
+
+    def set_item(self, container, key, value):
+        if self._undo_log is not None:
+            self._undo_log.append((_restore_item, (container, key, container.get(key, _MISSING))))
+
+        container[key] = value
+
+
+    def delete_item(self, container, key):
+        if self._undo_log is not None:
+            self._undo_log.append((_restore_item, (container, key, container[key])))
+
+        del container[key]
+
+
+    def checkpoint(self):
+        # Starts recording undo records. Every change made through grid, stock and
+        # turns after this point is reverted by the matching call to undo.
+        if self._undo_log is None:
+            object.__setattr__(self, '_undo_log', [])
+            self.grid.undo_log = self._undo_log
+
+        self._undo_log.append(None)
+        return self
+
+
+    def undo(self):
+        undo_log = self._undo_log
+
+        if not undo_log:
+            raise Exception('There is no checkpoint to undo to!')
+
+        record = undo_log.pop()
+
+        while record is not None:
+            undo_function, args = record
+            undo_function(*args)
+            record = undo_log.pop()
+
+        if not undo_log:
+            object.__setattr__(self, '_undo_log', None)
+            self.grid.undo_log = None
+
+        return self
 
 
     def to_dict(self):
         return {
             'is_started': self.is_started,
             'title': self.title,
-            'grid': { str(i): [chain.to_dict() if chain else None for chain in column] for i, column in enumerate(self.grid) },
+            'ruleset': self.ruleset.to_dict(),
+            **self._board_fields(),
             'player_order': self.player_order,
             'current_turn_player': self.current_turn_player,
             'current_action_player': self.current_action_player,
@@ -108,31 +677,91 @@ class GameState:
                 }
                 for details
                 in self.acquisition_resolution_queue
-            ]
+            ],
+            'version': self.version
         }
 
 
+    def to_update_dict(self, state_dict=None):
+        # Only the fields that differ from the document this state was loaded from,
+        # keyed by Firestore field path. Maps are diffed key by key (e.g.
+        # money_by_player.<uid>) unless a key was removed, in which case the whole
+        # map is rewritten. Lists are always rewritten whole.
+        if state_dict is None:
+            state_dict = self.to_dict()
+
+        if self._persisted_dict is None:
+            return state_dict
+
+        update_dict = {}
+        _collect_changed_fields(update_dict, [], state_dict, self._persisted_dict)
+
+        for field in self._persisted_dict.keys() - state_dict.keys():
+            update_dict[_quote_field_name(field)] = DELETE_FIELD
+
+        return update_dict
+
+
+    def to_delta_dict(self, update_dict=None):
+        # The changes since the persisted document, for clients that already hold it.
+        # Board cells are sent by index and the action log as the entries added and
+        # the number dropped from its start, everything else as in to_update_dict.
+        if update_dict is None:
+            update_dict = self.to_update_dict()
+
+        persisted_dict = self._persisted_dict or {}
+        delta = {'from_version': persisted_dict.get('version', 0), 'version': self.version, 'fields': {}, 'deleted_fields': []}
+
+        for field_path, value in update_dict.items():
+            if value is DELETE_FIELD:
+                delta['deleted_fields'].append(field_path)
+            elif field_path == 'board.cells' and 'board' in persisted_dict:
+                persisted_cells = persisted_dict['board']['cells']
+                delta['cells'] = {
+                    str(index): cell
+                    for index, cell
+                    in enumerate(value)
+                    if index >= len(persisted_cells) or cell != persisted_cells[index]
+                }
+            elif field_path == 'most_recent_actions' and 'most_recent_actions' in persisted_dict:
+                delta['actions'] = _diff_appended_list(persisted_dict['most_recent_actions'], value)
+            else:
+                delta['fields'][field_path] = value
+
+        return delta
+
+
+    def mark_persisted(self, state_dict):
+        # state_dict must not share containers with this state, as to_dict's do
+        self._persisted_dict = state_dict
+
+
     @staticmethod
     def from_dict(state_data):
-        new_state = GameState(state_data['title'])
+        ruleset = Ruleset.from_dict(state_data['ruleset']) if 'ruleset' in state_data else default_ruleset()
+        new_state = GameState(state_data['title'], ruleset)
+        new_state._persisted_dict = state_data
 
         new_state.is_started = state_data['is_started']
-        new_state.grid = GameState._build_grid_from_firestore_map(state_data['grid'])
-        new_state.player_order = state_data['player_order']
+        if 'board' in state_data:
+            new_state.grid, new_state.chain_by_brand = GameState._build_grid_from_compact_board(state_data['board'], ruleset)
+        else:
+            new_state.grid, new_state.chain_by_brand = GameState._build_grid_from_firestore_map(state_data['grid'], ruleset)
+        new_state.player_order = list(state_data['player_order'])
         new_state.current_turn_player = state_data['current_turn_player']
         new_state.current_action_player = state_data['current_action_player']
         new_state.current_action_type = ActionType(state_data['current_action_type'])
         new_state.current_action_details = state_data['current_action_details']
         new_state.stock_availability = { Brand(brand): stock_count for brand, stock_count in state_data['stock_availability'].items() }
-        new_state.money_by_player = state_data['money_by_player']
+        new_state.money_by_player = dict(state_data['money_by_player'])
         new_state.stock_by_player = { player: { Brand(brand_value): amount for brand_value, amount in stock_map.items() } for player, stock_map in state_data['stock_by_player'].items() }
-        new_state.user_data_by_id = state_data['user_data_by_id']
+        new_state.user_data_by_id = dict(state_data['user_data_by_id'])
         new_state.tiles_remaining = state_data['tiles_remaining']
         new_state.cost_by_brand = toolz.keymap(Brand, state_data['cost_by_brand'])
         new_state.inactive_brands = [Brand(brand_value) for brand_value in state_data['inactive_brands']]
         new_state.active_brands = [Brand(brand_value) for brand_value in state_data['active_brands']]
         new_state.most_recently_placed_tile = None if not state_data['most_recently_placed_tile'] else Tile(**state_data['most_recently_placed_tile'])
-        new_state.most_recent_actions = state_data['most_recent_actions']
+        new_state.most_recent_actions = list(state_data['most_recent_actions'])
         new_state.acquisition_resolution_queue = [
             {
                 'player_id': details['player_id'], 
@@ -143,14 +772,105 @@ class GameState:
             for details
             in state_data['acquisition_resolution_queue']
         ]
+        new_state.version = state_data.get('version', 0)
 
         return new_state
 
 
+    def _board_fields(self):
+        if bool(int(os.environ.get('COMPACT_BOARD', '0'))):
+            return {'board': self._build_compact_board_from_grid()}
+
+        return {'grid': self._build_firestore_map_from_grid()}
+
+
+    def _build_compact_board_from_grid(self):
+        # Each chain is written once to a table, and cells is a string with one
+        # character per space (x * height + y): '.' for an empty space, otherwise
+        # the chain's table position offset from _FIRST_CHAIN_CODE_POINT.
+        chains = []
+        chain_number_by_id = {}
+        cells = []
+
+        for x in range(self.grid.width):
+            for y in range(self.grid.height):
+                chain_id = self.grid.find_chain_id(x, y)
+
+                if chain_id is None:
+                    cells.append(_EMPTY_CELL)
+                    continue
+
+                chain_number = chain_number_by_id.get(chain_id)
+
+                if chain_number is None:
+                    chain_number = len(chains)
+                    chain_number_by_id[chain_id] = chain_number
+                    chains.append(self.grid.find(x, y).to_dict())
+
+                cells.append(chr(_FIRST_CHAIN_CODE_POINT + chain_number))
+
+        return {
+            'width': self.grid.width,
+            'height': self.grid.height,
+            'chains': chains,
+            'cells': ''.join(cells)
+        }
+
+
     @staticmethod
-    def _build_grid_from_firestore_map(firestore_grid):
-        board = GameState._generate_initial_grid()
-        branded_chains_by_brand = {brand: Chain([], brand) for brand in Brand}
+    def _build_grid_from_compact_board(compact_board, ruleset):
+        board = GameState._generate_initial_grid(ruleset)
+        chains = [
+            Chain(ruleset, Brand(chain_data['brand']) if chain_data['brand'] else None)
+            for chain_data
+            in compact_board['chains']
+        ]
+
+        for cell, code in enumerate(compact_board['cells']):
+            if code == _EMPTY_CELL:
+                continue
+
+            board.add(ruleset.tiles[cell], chains[ord(code) - _FIRST_CHAIN_CODE_POINT])
+
+        chain_by_brand = { chain.brand: chain for chain in chains if chain.brand }
+
+        return board, chain_by_brand
+
+
+    def _build_firestore_map_from_grid(self):
+        firestore_grid = {}
+        firestore_space_by_chain_id = {}
+
+        for x in range(self.grid.width):
+            firestore_column = []
+
+            for y in range(self.grid.height):
+                chain_id = self.grid.find_chain_id(x, y)
+
+                if chain_id is None:
+                    firestore_column.append(None)
+                    continue
+
+                firestore_space = firestore_space_by_chain_id.get(chain_id)
+
+                if firestore_space is None:
+                    # the chain's first cell in x-major order, which is also how
+                    # from_dict numbers it, so a reloaded grid writes the same ids
+                    firestore_space = {**self.grid.find(x, y).to_dict(), 'chain_id': x * self.grid.height + y}
+                    firestore_space_by_chain_id[chain_id] = firestore_space
+
+                firestore_column.append(firestore_space)
+
+            firestore_grid[str(x)] = firestore_column
+
+        return firestore_grid
+
+
+    @staticmethod
+    def _build_grid_from_firestore_map(firestore_grid, ruleset):
+        board = GameState._generate_initial_grid(ruleset)
+        branded_chains_by_brand = {brand: Chain(ruleset, brand) for brand in Brand}
+        chains_by_id = {}
 
         for x_string, firestore_column in firestore_grid.items():
             x = int(x_string)
@@ -161,43 +881,101 @@ class GameState:
                 brand_letter = firestore_space['brand']
                 brand = Brand(brand_letter) if brand_letter else None 
                 
+                tile = Tile(x, y)
+                chain_id = firestore_space.get('chain_id')
+
+                if chain_id is not None:
+                    chain = chains_by_id.get(chain_id)
+
+                    if chain is None:
+                        chain = branded_chains_by_brand[brand] if brand else Chain(ruleset)
+                        chains_by_id[chain_id] = chain
+
+                    board.add(tile, chain)
+                    continue
+
+                # documents written before chain ids were stored have to rediscover
+                # unbranded chains from their neighbors
                 if brand:
-                    chain = branded_chains_by_brand[brand]
-                    chain.tiles.append(Tile(x, y))
-                    board[x][y] = chain
+                    board.add(tile, branded_chains_by_brand[brand])
                     continue
 
-                tile = Tile(x, y)
                 neighbors = grid.get_unique_neighbors(board, tile)
 
                 if not neighbors:
-                    board[x][y] = Chain([tile])
+                    board.add(tile, Chain(ruleset))
                     continue
 
                 if len(neighbors) == 1:
                     (chain,) = neighbors
-                    chain.tiles.append(tile)
-                    board[x][y] = chain
+                    board.add(tile, chain)
                     continue
-                
-                merged_chain = Chain([tile for chain in neighbors for tile in chain.tiles] + [tile])
-                board[x][y] = merged_chain
 
-                for chain in neighbors:
-                    for tile in chain.tiles:
-                        board[tile.x][tile.y] = merged_chain
+                merged_chain = board.merge(neighbors, neighbors[0])
+                board.add(tile, merged_chain)
+
+        chain_by_brand = { brand: chain for brand, chain in branded_chains_by_brand.items() if chain.size }
 
-        return board
+        return board, chain_by_brand
 
 
     @staticmethod
-    def _generate_initial_grid():
-        height = int(os.environ['HEIGHT'])
-        width = int(os.environ['WIDTH'])
-        return [[None for _ in range(height)] for x in range(width)]
+    def _generate_initial_grid(ruleset):
+        return ChainIndex(ruleset)
+
+
+def _collect_changed_fields(update_dict, path, value, persisted_value):
+    if value == persisted_value:
+        return
+
+    is_diffable_map = (
+        isinstance(value, dict)
+        and isinstance(persisted_value, dict)
+        and (not path or persisted_value.keys() <= value.keys())
+    )
+
+    if not is_diffable_map:
+        update_dict['.'.join(_quote_field_name(name) for name in path)] = value
+        return
+
+    for key, child_value in value.items():
+        _collect_changed_fields(update_dict, path + [key], child_value, persisted_value.get(key, _MISSING))
+
+
+def _diff_appended_list(persisted_list, new_list):
+    # new_list is persisted_list with entries dropped from the start and added to the end
+    for dropped_count in range(len(persisted_list) + 1):
+        kept_count = len(persisted_list) - dropped_count
+
+        if kept_count <= len(new_list) and persisted_list[dropped_count:] == new_list[:kept_count]:
+            return {'dropped_count': dropped_count, 'added': new_list[kept_count:]}
+
+
+def _quote_field_name(name):
+    if _SIMPLE_FIELD_NAME.match(name):
+        return name
+
+    escaped_name = name.replace('\\', '\\\\').replace('`', '\\`')
+    return f'`{escaped_name}`'
+
+
+def _restore_attribute(target, name, value):
+    if value is _MISSING:
+        object.__delattr__(target, name)
+    else:
+        object.__setattr__(target, name, value)
+
+
+def _restore_item(container, key, value):
+    if value is _MISSING:
+        del container[key]
+    else:
+        container[key] = value
 
 
 class PlaceTileResult():
+    __slots__ = ('state', 'acquired_chains', 'acquirer', 'new_brand', 'tile')
+
     def __init__(self, state, acquired_chains, acquirer, new_brand, tile):
         self.state = state
         self.acquired_chains = acquired_chains
@@ -206,5 +984,25 @@ class PlaceTileResult():
         self.tile = tile
 
 
+class LegalMove():
+    # brands holds every value that may be passed as the brand for this tile, where
+    # None means no brand. acquirers holds the brands that could survive a merge.
+    __slots__ = ('tile', 'placement_type', 'brands', 'acquirers')
+
+    def __init__(self, tile, placement_type, brands, acquirers):
+        self.tile = tile
+        self.placement_type = placement_type
+        self.brands = brands
+        self.acquirers = acquirers
+
+    def to_dict(self):
+        return {
+            'tile': self.tile.to_dict(),
+            'placement_type': self.placement_type.value,
+            'brands': [brand.value if brand else None for brand in self.brands],
+            'acquirers': [brand.value for brand in self.acquirers]
+        }
+
+
 class RuleViolation(Exception):
     pass
@@ -1,90 +1,989 @@
-from google.cloud import firestore
+import os
+import copy
+import json
+import time
+import uuid
+import sqlite3
+import functools
+import weakref
+import threading
+import collections
 
 import models
+import tiles
+import deltas
+import actions
+import metrics
+
+
+# The functions below are the persistence API used by the rest of the app. They
+# delegate to a backend chosen by PERSISTANCE_BACKEND: 'firestore' (the default),
+# 'memory' or 'sqlite' (stored at SQLITE_PATH). Backends deal in plain dicts laid out
+# like the Firestore documents, and this module converts them to and from models.
 
 
 # games
+GAME_STATUSES = ('open', 'in_progress', 'finished')
+_MAX_CACHED_GAME_LIST_COUNT = 256
+
+_cached_game_lists = collections.OrderedDict()
+_cached_game_lists_lock = threading.Lock()
+
+
 def create_game(title):
-    client = firestore.Client()
-    
-    (_, doc) = client.collection('games').add({ 'title': title })
+    return get_backend().create_game(title)
+
+
+def list_games(status=None, page_size=20, cursor=None):
+    # The lobby reads a page of game summaries, most recently active first, and pages
+    # are cached for GAME_LIST_CACHE_SECONDS, so polling lobbies cost one query per
+    # page per interval however many games there are. Returns the summaries and the
+    # cursor of the next page, or None on the last page.
+    if status is not None and status not in GAME_STATUSES:
+        raise models.RuleViolation(f'Unknown game status {status}!')
+
+    key = (status, page_size, cursor)
+    now = time.monotonic()
+
+    with _cached_game_lists_lock:
+        cached_game_list = _cached_game_lists.get(key)
+
+        if cached_game_list is not None and cached_game_list[0] > now:
+            return cached_game_list[1]
+
+    with metrics.phase('read'):
+        game_list = get_backend().list_games(status, page_size, cursor)
+
+    with _cached_game_lists_lock:
+        _cached_game_lists[key] = (now + float(os.environ.get('GAME_LIST_CACHE_SECONDS', '5')), game_list)
+
+        while len(_cached_game_lists) > _MAX_CACHED_GAME_LIST_COUNT:
+            _cached_game_lists.popitem(last=False)
+
+    return game_list
+
 
-    return doc.id
+def _build_game_summary(game_id, state):
+    if not state.is_started:
+        status = 'open'
+    elif state.current_action_type == models.ActionType.GAME_OVER:
+        status = 'finished'
+    else:
+        status = 'in_progress'
+
+    return {
+        'id': game_id,
+        'title': state.title,
+        'player_count': len(state.player_order),
+        'player_count_max': state.ruleset.player_count_max,
+        'status': status,
+    }
+
+
+def _clear_cached_game_lists():
+    with _cached_game_lists_lock:
+        _cached_game_lists.clear()
 
 
 # users
 def get_user_data(user_id):
-    client = firestore.Client()
-    return client.document(f'users/{user_id}').get().to_dict()
+    with metrics.phase('read'):
+        return get_backend().get_user_data(user_id)
+
+
+def set_user_data(user_id, user_data):
+    get_backend().set_user_data(user_id, user_data)
 
 
 # game_states
 def create_game_state(game_id, state):
-    client = firestore.Client()
-    client.collection('game_states').add(state.to_dict(), document_id=game_id)
+    backend = get_backend()
+    backend.create_game_state(game_id, state.to_dict())
+    backend.write_snapshot(game_id, state.version, _build_snapshot(state, None))
+    backend.set_game_summary(game_id, {**_build_game_summary(game_id, state), 'last_activity': time.time()})
+    _clear_cached_game_lists()
 
 
 def get_game_state(game_id):
-    client = firestore.Client()
-    response = client.collection('game_states').document(game_id).get().to_dict()
-    return models.GameState.from_dict(response)
+    return models.GameState.from_dict(get_backend().get_game_state(game_id))
+
+
+def get_game_state_dict(game_id):
+    with metrics.phase('read'):
+        return get_backend().get_game_state(game_id)
 
 
 def update_game_state(game_id, state):
-    client = firestore.Client() 
-    client.collection('game_states').document(game_id).update(state)
+    if not state:
+        return
+
+    evict_cached_game(game_id)
+    get_backend().update_game_state(game_id, state)
 
 
 # game_state_secrets
-def get_global_tiles(game_id):
-    client = firestore.Client()
-    raw_data = client.collection('game_state_secrets').document(game_id).get().to_dict()
-    return [models.Tile(tile['x'], tile['y']) for tile in raw_data['tiles']]
+def get_player_tiles(game_id, player_id):
+    return [models.Tile(tile['x'], tile['y']) for tile in get_backend().get_player_tiles(game_id, player_id)]
 
 
-def get_player_tiles(game_id, player_id):
-    client = firestore.Client()
-    raw_data = client.document(f'game_state_secrets/{game_id}/player_secrets/{player_id}').get().to_dict()
-    return [models.Tile(tile['x'], tile['y']) for tile in raw_data['tiles']]
+def initialize_player_tiles(game_id, tiles_by_player_id):
+    tile_dicts_by_player_id = {
+        player_id: [tile.to_dict() for tile in tiles]
+        for player_id, tiles
+        in tiles_by_player_id.items()
+    }
 
+    get_backend().initialize_player_tiles(game_id, tile_dicts_by_player_id)
 
-def initialize_global_tiles(game_id, tiles):
-    client = firestore.Client()
-    tile_dict_list = [tile.to_dict() for tile in tiles]
-    client.collection('game_state_secrets').add({'tiles': tile_dict_list}, document_id=game_id)
 
+def add_player_tile(game_id, player_id, tile):
+    evict_cached_game(game_id)
+    get_backend().add_player_tile(game_id, player_id, tile.to_dict())
 
-def initialize_player_tiles(game_id, tiles_by_player_id):
-    client = firestore.Client()
-    batch = client.batch()
 
-    player_secrets = client.collection(f'game_state_secrets/{game_id}/player_secrets')
+def delete_player_tile(game_id, player_id, tile):
+    evict_cached_game(game_id)
+    get_backend().delete_player_tile(game_id, player_id, tile.to_dict())
 
-    for player_id, tiles in tiles_by_player_id.items():
-        tile_dict_list = [tile.to_dict() for tile in tiles]
-        doc = player_secrets.document(player_id)
-        batch.set(doc, {'tiles': tile_dict_list})
 
-    batch.commit()
+# history
+# Each accepted action is appended to game_state_secrets/{game_id}/events with the
+# state version it produced, and every SNAPSHOT_INTERVAL versions the whole state
+# and deck are written to game_state_secrets/{game_id}/snapshots. Any version of a
+# game can be rebuilt from the snapshot at or before it plus the events after that.
+def get_game_events(game_id, after_version=0, up_to_version=None):
+    return [event_dict['event'] for event_dict in get_backend().get_events(game_id, after_version, up_to_version)]
 
 
-def deal_tile_to_player(game_id, player_id, tile):
-    client = firestore.Client()
-    batch = client.batch()
-    tile_dict_list = [tile.to_dict()]
-    
-    game_secrets = client.document(f'game_state_secrets/{game_id}')
-    player_secrets = client.document(f'game_state_secrets/{game_id}/player_secrets/{player_id}')
+def load_game_state_from_history(game_id, version=None):
+    backend = get_backend()
+    snapshot = backend.get_latest_snapshot(game_id, version)
 
-    batch.update(game_secrets, {'tiles': firestore.ArrayRemove(tile_dict_list)})
-    batch.update(player_secrets, {'tiles': firestore.ArrayUnion(tile_dict_list)})
+    if snapshot is None:
+        raise Exception(f'There is no snapshot of {game_id} to replay from!')
 
-    batch.commit()
+    state = models.GameState.from_dict(snapshot['state'])
+    deck = _build_deck_from_secrets(state.ruleset, snapshot['deck'])
+    events = get_game_events(game_id, snapshot['version'], version)
 
+    return actions.replay(state, deck, events)
 
-def delete_player_tile(game_id, player_id, tile):
-    client = firestore.Client()
-    tile_dict_list = [tile.to_dict()]
 
-    player_secrets = client.document(f'game_state_secrets/{game_id}/player_secrets/{player_id}')
-    player_secrets.update({'tiles': firestore.ArrayRemove(tile_dict_list)})
+def _build_snapshot(state, deck, state_dict=None):
+    return {'version': state.version, 'state': state_dict or state.to_dict(), 'deck': _build_secrets_from_deck(deck)}
+
+
+def _get_snapshot_interval():
+    return int(os.environ.get('SNAPSHOT_INTERVAL', '50'))
+
+
+# per-game locks
+# Actions on one game run one at a time in this process, so they apply in order and
+# never race for the game's cached unit of work. Locks are dropped once unused.
+_game_locks = weakref.WeakValueDictionary()
+_game_locks_lock = threading.Lock()
+
+
+def lock_game(game_id):
+    with _game_locks_lock:
+        game_lock = _game_locks.get(game_id)
+
+        if game_lock is None:
+            game_lock = threading.RLock()
+            _game_locks[game_id] = game_lock
+
+    return game_lock
+
+
+# actions
+# A unit of work that committed is kept in an LRU cache keyed by game id, so the
+# next action on that game in this process skips the read and the parse. Commits
+# carry the revision their state was read at, and if the stored game has moved on
+# since, the backend raises StaleGameState instead of overwriting it. Actions that
+# only read never commit, so they check the cached revision against storage first.
+class StaleGameState(Exception):
+    pass
+
+
+_cached_units_of_work = collections.OrderedDict()
+_cached_units_of_work_lock = threading.Lock()
+
+
+def begin_action(game_id, player_id=None, is_read_only=False):
+    with _cached_units_of_work_lock:
+        unit_of_work = _cached_units_of_work.pop(game_id, None)
+
+    if unit_of_work is None or (player_id is not None and player_id not in unit_of_work._player_tiles_by_id):
+        return UnitOfWork(get_backend(), game_id, player_id)
+
+    if is_read_only:
+        with metrics.phase('read'):
+            revision = get_backend().get_revision(game_id)
+
+        if revision != unit_of_work._revision:
+            return UnitOfWork(get_backend(), game_id, player_id)
+
+    unit_of_work.player_id = player_id
+    return unit_of_work
+
+
+def is_game_cached(game_id):
+    with _cached_units_of_work_lock:
+        return game_id in _cached_units_of_work
+
+
+def evict_cached_game(game_id):
+    with _cached_units_of_work_lock:
+        _cached_units_of_work.pop(game_id, None)
+
+
+def _cache_unit_of_work(unit_of_work):
+    cache_size = int(os.environ.get('STATE_CACHE_SIZE', '256'))
+
+    with _cached_units_of_work_lock:
+        _cached_units_of_work[unit_of_work.game_id] = unit_of_work
+        _cached_units_of_work.move_to_end(unit_of_work.game_id)
+
+        while len(_cached_units_of_work) > cache_size:
+            _cached_units_of_work.popitem(last=False)
+
+
+class UnitOfWork:
+    # Everything one request reads and writes for a game. The state, the acting
+    # player's hand and the deck arrive in a single read, writes are buffered, and
+    # commit sends them to the backend as one atomic batch.
+    def __init__(self, backend, game_id, player_id=None):
+        self.game_id = game_id
+        self.player_id = player_id
+        self._backend = backend
+        self._operations = []
+
+        with metrics.phase('read'):
+            state_dict, player_tile_dicts, deck_dict, self._revision = backend.load_action(game_id, player_id)
+
+        with metrics.phase('decode'):
+            self.state = models.GameState.from_dict(state_dict)
+            self.deck = _build_deck_from_secrets(self.state.ruleset, deck_dict)
+
+        self._is_legacy_deck = deck_dict is not None and 'seed' not in deck_dict
+        self._initial_deck_cursor = None if self.deck is None else self.deck.cursor
+        self._initial_version = self.state.version
+        self._game_summary = _build_game_summary(game_id, self.state)
+        self._game_summary_written_at = 0
+        self._player_tiles_by_id = {}
+
+        if player_id is not None and player_tile_dicts is not None:
+            self._player_tiles_by_id[player_id] = [models.Tile(tile['x'], tile['y']) for tile in player_tile_dicts]
+        elif player_id is not None:
+            self._player_tiles_by_id[player_id] = None
+
+    @property
+    def player_tiles(self):
+        return self._player_tiles_by_id.get(self.player_id)
+
+    def initialize_deck(self, deck):
+        self.deck = deck
+        self._is_legacy_deck = False
+        self._initial_deck_cursor = deck.cursor
+        self._operations.append(('initialize_deck', _build_secrets_from_deck(deck)))
+
+    def initialize_player_tiles(self, tiles_by_player_id):
+        tile_dicts_by_player_id = {
+            player_id: [tile.to_dict() for tile in tiles]
+            for player_id, tiles
+            in tiles_by_player_id.items()
+        }
+
+        self._operations.append(('initialize_player_tiles', tile_dicts_by_player_id))
+        self._player_tiles_by_id.update((player_id, list(tiles)) for player_id, tiles in tiles_by_player_id.items())
+
+    def deal_tile_to_player(self, player_id, tile):
+        self._operations.append(('add_player_tile', player_id, tile.to_dict()))
+        player_tiles = self._player_tiles_by_id.get(player_id)
+
+        if player_tiles is not None and tile not in player_tiles:
+            player_tiles.append(tile)
+
+    def delete_player_tile(self, player_id, tile):
+        self._operations.append(('delete_player_tile', player_id, tile.to_dict()))
+        player_tiles = self._player_tiles_by_id.get(player_id)
+
+        if player_tiles is not None and tile in player_tiles:
+            player_tiles.remove(tile)
+
+    def record_event(self, version, event):
+        self._operations.append(('append_event', version, event))
+
+    def commit(self):
+        with metrics.phase('encode'):
+            state_dict = self.state.to_dict()
+            update_dict = self.state.to_update_dict(state_dict)
+            operations = self._operations + self._deck_operations() + [('update_game_state', update_dict)]
+            version = self.state.version
+            snapshot_interval = _get_snapshot_interval()
+
+            if version // snapshot_interval != self._initial_version // snapshot_interval:
+                operations.append(('write_snapshot', version, _build_snapshot(self.state, self.deck, state_dict)))
+
+            game_summary_operations = self._game_summary_operations()
+            operations += game_summary_operations
+
+        self._operations = []
+
+        try:
+            with metrics.phase('write'):
+                self._revision = self._backend.commit_action(self.game_id, operations, self._revision)
+        except StaleGameState:
+            evict_cached_game(self.game_id)
+            raise
+
+        with metrics.phase('encode'):
+            if update_dict:
+                deltas.publish(self.game_id, self.state.to_delta_dict(update_dict))
+
+            self.state.mark_persisted(copy.deepcopy(state_dict))
+        self._initial_version = version
+
+        if game_summary_operations:
+            _clear_cached_game_lists()
+
+        if self.deck is not None:
+            self._initial_deck_cursor = self.deck.cursor
+
+        _cache_unit_of_work(self)
+
+    def release(self):
+        # for actions that only read: hands the unchanged unit of work back to the cache
+        if not self._operations:
+            _cache_unit_of_work(self)
+
+    def _game_summary_operations(self):
+        # The summary changes when players join, the game starts and the game ends.
+        # Its last_activity is also refreshed, at most every GAME_ACTIVITY_INTERVAL
+        # seconds, so that busy games are not a write to the lobby on every action.
+        game_summary = _build_game_summary(self.game_id, self.state)
+        now = time.time()
+        activity_interval = float(os.environ.get('GAME_ACTIVITY_INTERVAL', '60'))
+
+        if game_summary == self._game_summary and now - self._game_summary_written_at < activity_interval:
+            return []
+
+        self._game_summary = game_summary
+        self._game_summary_written_at = now
+        return [('set_game_summary', {**game_summary, 'last_activity': now})]
+
+    def _deck_operations(self):
+        if self.deck is None or self.deck.cursor == self._initial_deck_cursor:
+            return []
+
+        if self._is_legacy_deck:
+            drawn_tiles = self.deck.tiles[self._initial_deck_cursor:self.deck.cursor]
+            return [('remove_global_tiles', [tile.to_dict() for tile in drawn_tiles])]
+
+        return [('set_deck_cursor', self.deck.cursor)]
+
+
+def _build_deck_from_secrets(ruleset, deck_dict):
+    if deck_dict is None:
+        return None
+
+    if 'seed' in deck_dict:
+        return tiles.generate_initial_tiles(ruleset, deck_dict['seed'], deck_dict['cursor'])
+
+    # games started before seeded decks keep the remaining tiles as an array that
+    # is drawn from the end
+    return models.Deck(tuple(models.Tile(tile['x'], tile['y']) for tile in reversed(deck_dict['tiles'])))
+
+
+def _build_secrets_from_deck(deck):
+    if deck is None:
+        return None
+
+    if deck.seed is not None:
+        return {'seed': deck.seed, 'cursor': deck.cursor}
+
+    return {'tiles': [tile.to_dict() for tile in reversed(deck.tiles[deck.cursor:])]}
+
+
+# backends
+_backend = None
+
+
+def get_backend():
+    global _backend
+
+    if _backend is None:
+        _backend = _create_backend_from_env()
+
+    return _backend
+
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
+
+    with _cached_units_of_work_lock:
+        _cached_units_of_work.clear()
+
+    _clear_cached_game_lists()
+    deltas.clear()
+
+
+def _create_backend_from_env():
+    backend_name = os.environ.get('PERSISTANCE_BACKEND', 'firestore')
+
+    if backend_name == 'firestore':
+        return FirestoreBackend()
+
+    if backend_name == 'memory':
+        return InMemoryBackend()
+
+    if backend_name == 'sqlite':
+        return SqliteBackend(os.environ.get('SQLITE_PATH', 'acquire.sqlite3'))
+
+    raise Exception(f'Unknown persistance backend {backend_name}!')
+
+
+@functools.lru_cache(maxsize=None)
+def get_firestore_client():
+    # one client, and so one gRPC channel and set of credentials, per process
+    from google.cloud import firestore
+
+    return firestore.Client()
+
+
+class FirestoreBackend:
+    # the SDK is imported when the backend is first used, not with this module
+    def __init__(self):
+        from google.api_core import exceptions
+        from google.cloud import firestore
+
+        self._exceptions = exceptions
+        self._firestore = firestore
+
+    def create_game(self, title):
+        metrics.count_firestore_call('add')
+        (_, doc) = get_firestore_client().collection('games').add({ 'title': title })
+        return doc.id
+
+    def set_game_summary(self, game_id, game_summary):
+        metrics.count_firestore_call('set')
+        get_firestore_client().document(f'games/{game_id}').set(game_summary, merge=True)
+
+    def list_games(self, status, page_size, cursor):
+        # filtering by status needs a composite index on status and last_activity
+        client = get_firestore_client()
+        query = client.collection('games')
+
+        if status is not None:
+            query = query.where('status', '==', status)
+
+        query = query.order_by('last_activity', direction=self._firestore.Query.DESCENDING)
+
+        if cursor is not None:
+            metrics.count_firestore_call('get')
+            cursor_snapshot = client.document(f'games/{cursor}').get()
+
+            if cursor_snapshot.exists:
+                query = query.start_after(cursor_snapshot)
+
+        metrics.count_firestore_call('query')
+        game_summaries = [snapshot.to_dict() for snapshot in query.limit(page_size + 1).stream()]
+
+        if len(game_summaries) > page_size:
+            return game_summaries[:page_size], game_summaries[page_size - 1]['id']
+
+        return game_summaries, None
+
+    def get_user_data(self, user_id):
+        metrics.count_firestore_call('get')
+        return get_firestore_client().document(f'users/{user_id}').get().to_dict()
+
+    def set_user_data(self, user_id, user_data):
+        metrics.count_firestore_call('set')
+        get_firestore_client().document(f'users/{user_id}').set(user_data)
+
+    def create_game_state(self, game_id, state_dict):
+        metrics.count_firestore_call('add')
+        get_firestore_client().collection('game_states').add(state_dict, document_id=game_id)
+
+    def get_game_state(self, game_id):
+        metrics.count_firestore_call('get')
+        return get_firestore_client().collection('game_states').document(game_id).get().to_dict()
+
+    def update_game_state(self, game_id, update_dict):
+        firestore_update = {
+            field_path: self._firestore.DELETE_FIELD if value is models.DELETE_FIELD else value
+            for field_path, value
+            in update_dict.items()
+        }
+        metrics.count_firestore_call('update')
+        get_firestore_client().collection('game_states').document(game_id).update(firestore_update)
+
+    def get_player_tiles(self, game_id, player_id):
+        metrics.count_firestore_call('get')
+        return get_firestore_client().document(f'game_state_secrets/{game_id}/player_secrets/{player_id}').get().to_dict()['tiles']
+
+    def initialize_player_tiles(self, game_id, tile_dicts_by_player_id):
+        client = get_firestore_client()
+        batch = client.batch()
+
+        player_secrets = client.collection(f'game_state_secrets/{game_id}/player_secrets')
+
+        for player_id, tile_dicts in tile_dicts_by_player_id.items():
+            doc = player_secrets.document(player_id)
+            batch.set(doc, {'tiles': tile_dicts})
+
+        metrics.count_firestore_call('commit')
+        batch.commit()
+
+    def add_player_tile(self, game_id, player_id, tile_dict):
+        player_secrets = get_firestore_client().document(f'game_state_secrets/{game_id}/player_secrets/{player_id}')
+        metrics.count_firestore_call('update')
+        player_secrets.update({'tiles': self._firestore.ArrayUnion([tile_dict])})
+
+    def delete_player_tile(self, game_id, player_id, tile_dict):
+        player_secrets = get_firestore_client().document(f'game_state_secrets/{game_id}/player_secrets/{player_id}')
+        metrics.count_firestore_call('update')
+        player_secrets.update({'tiles': self._firestore.ArrayRemove([tile_dict])})
+
+    def write_snapshot(self, game_id, version, snapshot):
+        metrics.count_firestore_call('set')
+        get_firestore_client().document(f'game_state_secrets/{game_id}/snapshots/{version:010d}').set(snapshot)
+
+    def get_latest_snapshot(self, game_id, version):
+        query = get_firestore_client().collection(f'game_state_secrets/{game_id}/snapshots')
+
+        if version is not None:
+            query = query.where('version', '<=', version)
+
+        metrics.count_firestore_call('query')
+        snapshots = list(query.order_by('version', direction=self._firestore.Query.DESCENDING).limit(1).stream())
+        return snapshots[0].to_dict() if snapshots else None
+
+    def get_events(self, game_id, after_version, up_to_version):
+        query = get_firestore_client().collection(f'game_state_secrets/{game_id}/events').where('version', '>', after_version)
+
+        if up_to_version is not None:
+            query = query.where('version', '<=', up_to_version)
+
+        metrics.count_firestore_call('query')
+        return [snapshot.to_dict() for snapshot in query.order_by('version').stream()]
+
+    def load_action(self, game_id, player_id):
+        client = get_firestore_client()
+        state_ref = client.document(f'game_states/{game_id}')
+        game_secrets_ref = client.document(f'game_state_secrets/{game_id}')
+        refs = [state_ref, game_secrets_ref]
+
+        if player_id is not None:
+            player_secrets_ref = client.document(f'game_state_secrets/{game_id}/player_secrets/{player_id}')
+            refs.append(player_secrets_ref)
+
+        metrics.count_firestore_call('batch_get')
+        snapshots_by_path = {snapshot.reference.path: snapshot for snapshot in client.get_all(refs)}
+        state_snapshot = snapshots_by_path[state_ref.path]
+        deck_dict = snapshots_by_path[game_secrets_ref.path].to_dict()
+
+        if player_id is None:
+            return state_snapshot.to_dict(), None, deck_dict, state_snapshot.update_time
+
+        player_secrets = snapshots_by_path[player_secrets_ref.path].to_dict()
+        return state_snapshot.to_dict(), player_secrets['tiles'] if player_secrets else None, deck_dict, state_snapshot.update_time
+
+    def get_revision(self, game_id):
+        metrics.count_firestore_call('get')
+        return get_firestore_client().document(f'game_states/{game_id}').get(field_paths=['version']).update_time
+
+    def commit_action(self, game_id, operations, revision):
+        # the revision is the update time of the game state document
+        client = get_firestore_client()
+        batch = client.batch()
+        game_secrets = client.document(f'game_state_secrets/{game_id}')
+        state_write_index = None
+
+        def player_secrets(player_id):
+            return client.document(f'game_state_secrets/{game_id}/player_secrets/{player_id}')
+
+        for operation, *args in operations:
+            if operation == 'update_game_state':
+                (update_dict,) = args
+
+                if not update_dict:
+                    continue
+
+                firestore_update = {
+                    field_path: self._firestore.DELETE_FIELD if value is models.DELETE_FIELD else value
+                    for field_path, value
+                    in update_dict.items()
+                }
+                state_write_index = len(batch)
+                precondition = None if revision is None else client.write_option(last_update_time=revision)
+                batch.update(client.document(f'game_states/{game_id}'), firestore_update, option=precondition)
+            elif operation == 'initialize_deck':
+                (deck_dict,) = args
+                batch.create(game_secrets, deck_dict)
+            elif operation == 'set_deck_cursor':
+                (cursor,) = args
+                batch.update(game_secrets, {'cursor': cursor})
+            elif operation == 'remove_global_tiles':
+                (tile_dicts,) = args
+                batch.update(game_secrets, {'tiles': self._firestore.ArrayRemove(tile_dicts)})
+            elif operation == 'initialize_player_tiles':
+                (tile_dicts_by_player_id,) = args
+                for player_id, tile_dicts in tile_dicts_by_player_id.items():
+                    batch.set(player_secrets(player_id), {'tiles': tile_dicts})
+            elif operation == 'add_player_tile':
+                player_id, tile_dict = args
+                batch.update(player_secrets(player_id), {'tiles': self._firestore.ArrayUnion([tile_dict])})
+            elif operation == 'delete_player_tile':
+                player_id, tile_dict = args
+                batch.update(player_secrets(player_id), {'tiles': self._firestore.ArrayRemove([tile_dict])})
+            elif operation == 'append_event':
+                # create fails if the version exists, so concurrent actions cannot both commit
+                version, event = args
+                batch.create(client.document(f'game_state_secrets/{game_id}/events/{version:010d}'), {'version': version, 'event': event})
+            elif operation == 'write_snapshot':
+                version, snapshot = args
+                batch.set(client.document(f'game_state_secrets/{game_id}/snapshots/{version:010d}'), snapshot)
+            elif operation == 'set_game_summary':
+                (game_summary,) = args
+                batch.set(client.document(f'games/{game_id}'), game_summary, merge=True)
+            else:
+                raise Exception(f'Unknown operation {operation}!')
+
+        if not len(batch):
+            return revision
+
+        try:
+            metrics.count_firestore_call('commit')
+            write_results = batch.commit()
+        except (self._exceptions.FailedPrecondition, self._exceptions.Conflict) as e:
+            raise StaleGameState(f'Game {game_id} was changed by another action!') from e
+
+        return revision if state_write_index is None else write_results[state_write_index].update_time
+
+
+class _DocumentBackend:
+    # Implements the backend API on top of a store of whole documents keyed by their
+    # Firestore path. Subclasses provide _read, _write, _list (the documents directly
+    # in a collection, ordered by path) and _transaction, and get the
+    # same update, ArrayRemove and ArrayUnion semantics as Firestore.
+    def create_game(self, title):
+        game_id = uuid.uuid4().hex[:20]
+        self._write(f'games/{game_id}', { 'title': title })
+        return game_id
+
+    def set_game_summary(self, game_id, game_summary):
+        with self._transaction():
+            self._write(f'games/{game_id}', {**(self._read(f'games/{game_id}') or {}), **game_summary})
+
+    def list_games(self, status, page_size, cursor):
+        # newest activity first, ties broken by id, as Firestore orders them
+        game_summaries = sorted(
+            (
+                game_summary
+                for game_summary
+                in self._list('games')
+                if 'last_activity' in game_summary and (status is None or game_summary['status'] == status)
+            ),
+            key=lambda game_summary: (game_summary['last_activity'], game_summary['id']),
+            reverse=True
+        )
+
+        if cursor is not None:
+            cursor_summary = self._read(f'games/{cursor}')
+
+            if cursor_summary is not None and 'last_activity' in cursor_summary:
+                cursor_key = (cursor_summary['last_activity'], cursor)
+                game_summaries = [
+                    game_summary
+                    for game_summary
+                    in game_summaries
+                    if (game_summary['last_activity'], game_summary['id']) < cursor_key
+                ]
+
+        if len(game_summaries) > page_size:
+            return game_summaries[:page_size], game_summaries[page_size - 1]['id']
+
+        return game_summaries, None
+
+    def get_user_data(self, user_id):
+        return self._read(f'users/{user_id}')
+
+    def set_user_data(self, user_id, user_data):
+        self._write(f'users/{user_id}', user_data)
+
+    def create_game_state(self, game_id, state_dict):
+        with self._transaction():
+            if self._read(f'game_states/{game_id}') is not None:
+                raise Exception(f'Game state {game_id} already exists!')
+
+            self._write(f'game_states/{game_id}', state_dict)
+
+    def get_game_state(self, game_id):
+        return self._read(f'game_states/{game_id}')
+
+    def update_game_state(self, game_id, update_dict):
+        with self._transaction():
+            state_dict = self._read_existing(f'game_states/{game_id}')
+
+            for field_path, value in update_dict.items():
+                _apply_field_update(state_dict, _split_field_path(field_path), value)
+
+            self._write(f'game_states/{game_id}', state_dict)
+
+    def get_player_tiles(self, game_id, player_id):
+        return self._read_existing(f'game_state_secrets/{game_id}/player_secrets/{player_id}')['tiles']
+
+    def initialize_player_tiles(self, game_id, tile_dicts_by_player_id):
+        with self._transaction():
+            for player_id, tile_dicts in tile_dicts_by_player_id.items():
+                self._write(f'game_state_secrets/{game_id}/player_secrets/{player_id}', {'tiles': tile_dicts})
+
+    def add_player_tile(self, game_id, player_id, tile_dict):
+        with self._transaction():
+            self._union_into_array(f'game_state_secrets/{game_id}/player_secrets/{player_id}', 'tiles', tile_dict)
+
+    def delete_player_tile(self, game_id, player_id, tile_dict):
+        with self._transaction():
+            self._remove_from_array(f'game_state_secrets/{game_id}/player_secrets/{player_id}', 'tiles', tile_dict)
+
+    def write_snapshot(self, game_id, version, snapshot):
+        self._write(f'game_state_secrets/{game_id}/snapshots/{version:010d}', snapshot)
+
+    def get_latest_snapshot(self, game_id, version):
+        snapshots = [
+            snapshot
+            for snapshot
+            in self._list(f'game_state_secrets/{game_id}/snapshots')
+            if version is None or snapshot['version'] <= version
+        ]
+
+        return snapshots[-1] if snapshots else None
+
+    def get_events(self, game_id, after_version, up_to_version):
+        return [
+            event_dict
+            for event_dict
+            in self._list(f'game_state_secrets/{game_id}/events')
+            if event_dict['version'] > after_version and (up_to_version is None or event_dict['version'] <= up_to_version)
+        ]
+
+    def load_action(self, game_id, player_id):
+        with self._transaction():
+            state_dict = self.get_game_state(game_id)
+            deck_dict = self._read(f'game_state_secrets/{game_id}')
+            player_secrets = None if player_id is None else self._read(f'game_state_secrets/{game_id}/player_secrets/{player_id}')
+
+        return state_dict, player_secrets['tiles'] if player_secrets else None, deck_dict, state_dict.get('version', 0)
+
+    def get_revision(self, game_id):
+        return self._read_existing(f'game_states/{game_id}').get('version', 0)
+
+    def commit_action(self, game_id, operations, revision):
+        # the revision is the version of the game state, which every action bumps
+        game_secrets_path = f'game_state_secrets/{game_id}'
+
+        def player_secrets_path(player_id):
+            return f'game_state_secrets/{game_id}/player_secrets/{player_id}'
+
+        with self._transaction():
+            if revision is not None and self._read_existing(f'game_states/{game_id}').get('version', 0) != revision:
+                raise StaleGameState(f'Game {game_id} was changed by another action!')
+
+            for operation, *args in operations:
+                if operation == 'update_game_state':
+                    (update_dict,) = args
+
+                    if update_dict:
+                        self.update_game_state(game_id, update_dict)
+                elif operation == 'initialize_deck':
+                    (deck_dict,) = args
+
+                    if self._read(game_secrets_path) is not None:
+                        raise Exception(f'The deck for {game_id} already exists!')
+
+                    self._write(game_secrets_path, deck_dict)
+                elif operation == 'set_deck_cursor':
+                    (cursor,) = args
+                    self._write(game_secrets_path, {**self._read_existing(game_secrets_path), 'cursor': cursor})
+                elif operation == 'remove_global_tiles':
+                    (tile_dicts,) = args
+                    for tile_dict in tile_dicts:
+                        self._remove_from_array(game_secrets_path, 'tiles', tile_dict)
+                elif operation == 'initialize_player_tiles':
+                    (tile_dicts_by_player_id,) = args
+                    self.initialize_player_tiles(game_id, tile_dicts_by_player_id)
+                elif operation == 'add_player_tile':
+                    player_id, tile_dict = args
+                    self._union_into_array(player_secrets_path(player_id), 'tiles', tile_dict)
+                elif operation == 'delete_player_tile':
+                    player_id, tile_dict = args
+                    self._remove_from_array(player_secrets_path(player_id), 'tiles', tile_dict)
+                elif operation == 'append_event':
+                    version, event = args
+                    event_path = f'game_state_secrets/{game_id}/events/{version:010d}'
+
+                    if self._read(event_path) is not None:
+                        raise StaleGameState(f'Event {version} of {game_id} already exists!')
+
+                    self._write(event_path, {'version': version, 'event': event})
+                elif operation == 'write_snapshot':
+                    version, snapshot = args
+                    self.write_snapshot(game_id, version, snapshot)
+                elif operation == 'set_game_summary':
+                    (game_summary,) = args
+                    self.set_game_summary(game_id, game_summary)
+                else:
+                    raise Exception(f'Unknown operation {operation}!')
+
+            return self._read_existing(f'game_states/{game_id}').get('version', 0)
+
+    def _read_existing(self, path):
+        document = self._read(path)
+
+        if document is None:
+            raise KeyError(f'No document at {path}!')
+
+        return document
+
+    def _remove_from_array(self, path, field, value):
+        document = self._read_existing(path)
+        document[field] = [element for element in document.get(field, []) if element != value]
+        self._write(path, document)
+
+    def _union_into_array(self, path, field, value):
+        document = self._read_existing(path)
+        elements = document.setdefault(field, [])
+
+        if value not in elements:
+            elements.append(value)
+
+        self._write(path, document)
+
+
+class InMemoryBackend(_DocumentBackend):
+    def __init__(self):
+        self._documents = {}
+        self._lock = threading.RLock()
+
+    def _read(self, path):
+        with self._lock:
+            return copy.deepcopy(self._documents.get(path))
+
+    def _write(self, path, document):
+        with self._lock:
+            self._documents[path] = copy.deepcopy(document)
+
+    def _list(self, collection_path):
+        prefix = f'{collection_path}/'
+
+        with self._lock:
+            return [
+                copy.deepcopy(self._documents[path])
+                for path
+                in sorted(self._documents)
+                if path.startswith(prefix) and '/' not in path[len(prefix):]
+            ]
+
+    def _transaction(self):
+        return self._lock
+
+
+class SqliteBackend(_DocumentBackend):
+    def __init__(self, database_path):
+        self._connection = sqlite3.connect(database_path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.RLock()
+        self._transaction_depth = 0
+        self._connection.execute('CREATE TABLE IF NOT EXISTS documents (path TEXT PRIMARY KEY, data TEXT NOT NULL)')
+
+    def _read(self, path):
+        with self._lock:
+            row = self._connection.execute('SELECT data FROM documents WHERE path = ?', (path,)).fetchone()
+
+        return None if row is None else json.loads(row[0])
+
+    def _write(self, path, document):
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO documents (path, data) VALUES (?, ?)', (path, json.dumps(document)))
+
+    def _list(self, collection_path):
+        prefix = f'{collection_path}/'
+
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT path, data FROM documents WHERE substr(path, 1, ?) = ? ORDER BY path', (len(prefix), prefix)).fetchall()
+
+        return [json.loads(data) for path, data in rows if '/' not in path[len(prefix):]]
+
+    def _transaction(self):
+        return _SqliteTransaction(self)
+
+
+class _SqliteTransaction:
+    def __init__(self, backend):
+        self._backend = backend
+
+    def __enter__(self):
+        backend = self._backend
+        backend._lock.acquire()
+
+        if backend._transaction_depth == 0:
+            backend._connection.execute('BEGIN IMMEDIATE')
+
+        backend._transaction_depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        backend = self._backend
+        backend._transaction_depth -= 1
+
+        try:
+            if backend._transaction_depth == 0:
+                backend._connection.execute('ROLLBACK' if exc_type else 'COMMIT')
+        finally:
+            backend._lock.release()
+
+        return False
+
+
+def _split_field_path(field_path):
+    # the inverse of the quoting in models: names are separated by dots, and names
+    # that are not simple identifiers are wrapped in backticks with escapes
+    names = []
+    name = []
+    index = 0
+    is_quoted = False
+
+    while index < len(field_path):
+        char = field_path[index]
+
+        if is_quoted and char == '\\':
+            index += 1
+            name.append(field_path[index])
+        elif char == '`':
+            is_quoted = not is_quoted
+        elif char == '.' and not is_quoted:
+            names.append(''.join(name))
+            name = []
+        else:
+            name.append(char)
+
+        index += 1
+
+    names.append(''.join(name))
+    return names
+
+
+def _apply_field_update(document, names, value):
+    *parent_names, last_name = names
+
+    for name in parent_names:
+        document = document.setdefault(name, {})
+
+    if value is models.DELETE_FIELD:
+        document.pop(last_name, None)
+    else:
+        document[last_name] = copy.deepcopy(value)
@@ -0,0 +1,112 @@
+import os
+import json
+import bisect
+import hashlib
+import http.client
+
+
+# A WSGI front for several app processes. Requests about a game are sent to the
+# process that game hashes to on a consistent hash ring, so each game's state stays
+# cached in one process and its actions are serialized by that process's game lock.
+# Requests that name no game are spread by path. ROUTER_WORKERS lists the
+# host:port of each app process.
+
+_VIRTUAL_NODE_COUNT = 64
+_HOP_BY_HOP_HEADERS = {
+    'connection',
+    'keep-alive',
+    'proxy-authenticate',
+    'proxy-authorization',
+    'te',
+    'trailers',
+    'transfer-encoding',
+    'upgrade',
+}
+
+
+def build_ring(workers):
+    return sorted(
+        (_hash(f'{worker}#{virtual_node}'), worker)
+        for worker
+        in workers
+        for virtual_node
+        in range(_VIRTUAL_NODE_COUNT)
+    )
+
+
+def find_worker(ring, key):
+    index = bisect.bisect(ring, (_hash(key),))
+    return ring[index % len(ring)][1]
+
+
+def find_game_id(path, body):
+    # game ids arrive in the JSON body of actions, or in the path of game streams
+    path_names = path.strip('/').split('/')
+
+    if len(path_names) >= 2 and path_names[0] == 'games':
+        return path_names[1]
+
+    if not body:
+        return None
+
+    try:
+        request_json = json.loads(body)
+    except ValueError:
+        return None
+
+    return request_json.get('game_id') if isinstance(request_json, dict) else None
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+_ring = build_ring(os.environ.get('ROUTER_WORKERS', '127.0.0.1:8081').split(','))
+
+
+def app(environ, start_response):
+    path = environ.get('PATH_INFO', '/')
+    content_length = int(environ.get('CONTENT_LENGTH') or 0)
+    body = environ['wsgi.input'].read(content_length) if content_length else b''
+
+    game_id = find_game_id(path, body)
+    host, port = find_worker(_ring, game_id or path).rsplit(':', 1)
+
+    query_string = environ.get('QUERY_STRING')
+    target = f'{path}?{query_string}' if query_string else path
+    headers = {
+        name[len('HTTP_'):].replace('_', '-').title(): value
+        for name, value
+        in environ.items()
+        if name.startswith('HTTP_') and name[len('HTTP_'):].replace('_', '-').lower() not in _HOP_BY_HOP_HEADERS
+    }
+
+    if environ.get('CONTENT_TYPE'):
+        headers['Content-Type'] = environ['CONTENT_TYPE']
+
+    connection = http.client.HTTPConnection(host, int(port))
+    connection.request(environ['REQUEST_METHOD'], target, body=body or None, headers=headers)
+    response = connection.getresponse()
+
+    start_response(f'{response.status} {response.reason}', [
+        (name, value)
+        for name, value
+        in response.getheaders()
+        if name.lower() not in _HOP_BY_HOP_HEADERS
+    ])
+
+    return _stream_response(connection, response)
+
+
+def _stream_response(connection, response):
+    # read1 returns whatever has arrived, so server-sent events are passed on as sent
+    try:
+        while True:
+            chunk = response.read1(65536)
+
+            if not chunk:
+                return
+
+            yield chunk
+    finally:
+        connection.close()
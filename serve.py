@@ -0,0 +1,44 @@
+import os
+import sys
+import time
+import subprocess
+
+
+# Starts WORKER_COUNT app processes (one per core by default) on local ports, and the
+# router in front of them on PORT. With a single worker the app serves PORT itself.
+
+def main():
+    port = int(os.environ.get('PORT', '8080'))
+    worker_count = int(os.environ.get('WORKER_COUNT') or os.cpu_count() or 1)
+    worker_threads = os.environ.get('WORKER_THREADS', '8')
+
+    if worker_count == 1:
+        os.execvp('gunicorn', ['gunicorn', '--bind', f'0.0.0.0:{port}', '--workers', '1', '--threads', worker_threads, '--timeout', '0', 'app:app'])
+
+    first_worker_port = int(os.environ.get('FIRST_WORKER_PORT', '8081'))
+    worker_addresses = [f'127.0.0.1:{first_worker_port + index}' for index in range(worker_count)]
+
+    processes = [
+        subprocess.Popen(['gunicorn', '--bind', address, '--workers', '1', '--threads', worker_threads, '--timeout', '0', 'app:app'])
+        for address
+        in worker_addresses
+    ]
+
+    processes.append(subprocess.Popen(
+        ['gunicorn', '--bind', f'0.0.0.0:{port}', '--workers', '1', '--threads', os.environ.get('ROUTER_THREADS', '64'), '--timeout', '0', 'router:app'],
+        env={**os.environ, 'ROUTER_WORKERS': ','.join(worker_addresses)}
+    ))
+
+    # games are pinned to workers, so if any process dies the container should restart
+    while all(process.poll() is None for process in processes):
+        time.sleep(1)
+
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
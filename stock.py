@@ -3,33 +3,47 @@ import collections
 
 import grid
 import models
+import ledger
 import action_display
 
 
-def buy_stock(state, player_id, brand, amount):
-    if amount < 0:
+def execute_purchase_order(state, player_id, purchase_order):
+    # Checks the whole order, priced from one snapshot of the chains, before changing
+    # anything, so a rejected order leaves the state as it was. An accepted order is
+    # then applied in one step and recorded as a single action.
+    if any(amount < 0 for amount in purchase_order.values()):
         raise models.RuleViolation('Cannot buy negative stock!')
 
-    if amount == 0:
+    if sum(purchase_order.values()) > state.ruleset.max_stock_purchase_amount:
+        raise models.RuleViolation('Too many stock in purchase order!')
+
+    amount_by_brand = {brand: amount for brand, amount in purchase_order.items() if amount > 0}
+
+    if not amount_by_brand:
         return state
-    
-    available_stock_count = state.stock_availability[brand]
-    player_cash_amount = state.money_by_player[player_id]
 
-    if amount > available_stock_count:
+    chain_by_brand = state.chain_by_brand
+
+    if any(brand not in chain_by_brand for brand in amount_by_brand):
+        raise models.RuleViolation('No chains of this brand found!')
+
+    price_by_brand = {brand: calculate_price_from_chain(chain_by_brand[brand]) for brand in amount_by_brand}
+
+    if any(amount > state.stock_availability[brand] for brand, amount in amount_by_brand.items()):
         raise models.RuleViolation('Insufficient stock available to fulfill this order!')
 
-    price_per_stock = _calculate_price_from_state_and_brand(state, brand)
-    total_price = price_per_stock * amount
+    total_price = sum(price_by_brand[brand] * amount for brand, amount in amount_by_brand.items())
 
-    if total_price > player_cash_amount:
+    if total_price > state.money_by_player[player_id]:
         raise models.RuleViolation('You cannot afford this order!')
 
-    state.stock_availability[brand] -= amount
+    for brand, amount in amount_by_brand.items():
+        _perform_availability_change(state, brand, -amount)
+        _perform_stock_change(state, player_id, brand, amount)
+
     _perform_money_change(state, player_id, -total_price)
-    state.stock_by_player[player_id][brand] += amount
 
-    action_display.record_buy_action(state, brand, amount, price_per_stock)
+    action_display.record_purchase_order(state, amount_by_brand, price_by_brand)
 
     return state
 
@@ -48,8 +62,8 @@ def sell_stock(state, player_id, brand, cost_per_stock, sell_count):
 
     total_price = cost_per_stock * sell_count
 
-    state.stock_by_player[player_id][brand] -= sell_count
-    state.stock_availability[brand] += sell_count
+    _perform_stock_change(state, player_id, brand, -sell_count)
+    _perform_availability_change(state, brand, sell_count)
     _perform_money_change(state, player_id, total_price)
 
     action_display.record_sell_action(state, player_id, brand, sell_count, cost_per_stock)
@@ -68,15 +82,15 @@ def trade_stock(state, player_id, brand_to_send, brand_to_receive, send_count):
         return state
 
     global_stock_to_receive_count = state.stock_availability[brand_to_receive]
-    receive_count = send_count / 2
+    receive_count = send_count // 2
 
     if receive_count > global_stock_to_receive_count:
         raise models.RuleViolation('Insufficient stock available to complete trade!')
 
-    state.stock_by_player[player_id][brand_to_send] -= send_count
-    state.stock_by_player[player_id][brand_to_receive] += receive_count
-    state.stock_availability[brand_to_send] += send_count
-    state.stock_availability[brand_to_receive] -= receive_count
+    _perform_stock_change(state, player_id, brand_to_send, -send_count)
+    _perform_stock_change(state, player_id, brand_to_receive, receive_count)
+    _perform_availability_change(state, brand_to_send, send_count)
+    _perform_availability_change(state, brand_to_receive, -receive_count)
 
     action_display.record_trade_action(
         state, brand_to_send, send_count, brand_to_receive, receive_count)
@@ -93,8 +107,8 @@ def award_founder_share(state, player_id, brand):
     if global_stock_count < 1:
         return state
 
-    state.stock_availability[brand] -= 1
-    state.stock_by_player[player_id][brand] += 1
+    _perform_availability_change(state, brand, -1)
+    _perform_stock_change(state, player_id, brand, 1)
 
     action_display.record_founders_share(state, brand)
     
@@ -102,6 +116,12 @@ def award_founder_share(state, player_id, brand):
 
 
 def apply_majority_bonuses(state, chains):
+    if chains and ledger.is_enabled():
+        dense_ledger = ledger.Ledger.from_state(state)
+        _apply_dense_majority_bonuses(state, dense_ledger, chains)
+        dense_ledger.write_to_state(state)
+        return state
+
     for chain in chains:
         _apply_chain_majority_bonuses(state, chain)
 
@@ -112,6 +132,13 @@ def handle_game_end(state):
     branded_chains = grid.get_branded_chains(state)
     players = state.player_order
 
+    if branded_chains and ledger.is_enabled():
+        dense_ledger = ledger.Ledger.from_state(state)
+        _apply_dense_majority_bonuses(state, dense_ledger, branded_chains)
+        _sell_all_dense_stock(state, dense_ledger, branded_chains)
+        dense_ledger.write_to_state(state)
+        return
+
     apply_majority_bonuses(state, branded_chains)
 
     for chain in branded_chains:
@@ -123,37 +150,43 @@ def handle_game_end(state):
 
 
 def calculate_price_from_chain(chain):
-    brand = chain.brand
+    (price, _, _) = _find_chain_pricing(chain)
+    return price
 
-    if not brand:
-        raise Exception('Chains without a brand have no price!')
 
-    size = len(chain.tiles)
-    value_tier = _calculate_effective_value_tier(brand, size)
-    return _calculate_price_from_value_tier(value_tier)
+def set_price_table(state):
+    # one pass over the active chains, each priced by indexing the ruleset's table
+    pricing_by_brand = state.ruleset.pricing_by_brand
+    chain_by_brand = state.chain_by_brand
 
+    if any(brand not in chain_by_brand for brand in state.active_brands):
+        raise models.RuleViolation('No chains of this brand found!')
 
-def set_price_table(state):    
-    price_table = {
-        brand: _calculate_price_from_state_and_brand(state, brand) 
-        for brand 
+    state.cost_by_brand = {
+        brand: pricing_by_brand[brand][chain_by_brand[brand].size][0]
+        for brand
         in state.active_brands
     }
 
-    state.cost_by_brand = price_table
-
     return state
 
 
 def _perform_money_change(state, player_id, amount):
-    state.money_by_player[player_id] += amount
+    state.set_item(state.money_by_player, player_id, state.money_by_player[player_id] + amount)
+
+
+def _perform_stock_change(state, player_id, brand, amount):
+    stock_by_brand = state.stock_by_player[player_id]
+    state.set_item(stock_by_brand, brand, stock_by_brand[brand] + amount)
+
+
+def _perform_availability_change(state, brand, amount):
+    state.set_item(state.stock_availability, brand, state.stock_availability[brand] + amount)
 
 
 def _apply_chain_majority_bonuses(state, chain):
-    value_tier = _calculate_effective_value_tier(chain.brand, len(chain.tiles))
-    first_bonus = _calculate_first_majority_holder_bonus(value_tier)
-    second_bonus = _calculate_second_majority_holder_bonus(value_tier)
-    
+    (_, first_bonus, second_bonus) = _find_chain_pricing(chain)
+
     brand = chain.brand
 
     players_by_stock_count = collections.defaultdict(list)
@@ -213,83 +246,87 @@ def _apply_chain_majority_bonuses(state, chain):
     return state
     
 
-def _calculate_price_from_state_and_brand(state, brand):
-    chain = grid.find_chain(state.grid, brand)
-
-    if not chain:
-        raise models.RuleViolation('No chains of this brand found!')
-
-    return calculate_price_from_chain(chain)
+def _apply_dense_majority_bonuses(state, dense_ledger, chains):
+    # The same rules as _apply_chain_majority_bonuses, with every chain settled at
+    # once: column k of each array below is about chains[k].
+    numpy = ledger.get_numpy()
+    pricings = numpy.array([_find_chain_pricing(chain) for chain in chains], dtype=numpy.int64)
+    first_bonuses = pricings[:, 1]
+    second_bonuses = pricings[:, 2]
 
+    holdings = dense_ledger.stock[:, [ledger.BRAND_COLUMNS[chain.brand] for chain in chains]]
+    top_holdings = holdings.max(axis=0, initial=0)
+    is_top_tier = (holdings == top_holdings) & (top_holdings > 0)
+    top_tier_counts = is_top_tier.sum(axis=0)
 
-def _calculate_price_from_value_tier(effective_value_tier):
-    if not 0 <= effective_value_tier <= 10:
-        raise Exception('Invalid value tier specified!')
+    below_top_holdings = numpy.where(is_top_tier, 0, holdings)
+    second_holdings = below_top_holdings.max(axis=0, initial=0)
+    is_second_tier = (below_top_holdings == second_holdings) & (second_holdings > 0) & (top_tier_counts == 1)
+    second_tier_counts = is_second_tier.sum(axis=0)
 
-    return 200 + (effective_value_tier * 100)
+    # a tie for first splits both bonuses, and a lone holder takes both
+    is_tied = top_tier_counts >= 2
+    top_tier_bonuses = numpy.where(
+        is_tied,
+        _round_up_split(first_bonuses + second_bonuses, top_tier_counts),
+        numpy.where(second_tier_counts == 0, first_bonuses + second_bonuses, first_bonuses)
+    )
+    second_tier_bonuses = _round_up_split(second_bonuses, second_tier_counts)
 
+    dense_ledger.cash += (is_top_tier * top_tier_bonuses).sum(axis=1) + (is_second_tier * second_tier_bonuses).sum(axis=1)
 
-def _calculate_first_majority_holder_bonus(effective_value_tier):
-    if not 0 <= effective_value_tier <= 10:
-        raise Exception('Invalid value tier specified!')
+    player_ids = dense_ledger.player_ids
 
-    return 2000 + (effective_value_tier * 1000)
+    for index, chain in enumerate(chains):
+        for row in numpy.flatnonzero(is_top_tier[:, index]).tolist():
+            if is_tied[index]:
+                action_display.record_majority_bonus(state, player_ids[row], chain.brand, int(top_tier_bonuses[index]), 1)
+                continue
 
+            action_display.record_majority_bonus(state, player_ids[row], chain.brand, int(first_bonuses[index]), 1)
 
-def _calculate_second_majority_holder_bonus(effective_value_tier):
-    if not 0 <= effective_value_tier <= 10:
-        raise Exception('Invalid value tier specified!')
+            if second_tier_counts[index] == 0:
+                action_display.record_majority_bonus(state, player_ids[row], chain.brand, int(second_bonuses[index]), 2)
 
-    return 1000 + (effective_value_tier * 500)
+        for row in numpy.flatnonzero(is_second_tier[:, index]).tolist():
+            action_display.record_majority_bonus(state, player_ids[row], chain.brand, int(second_tier_bonuses[index]), 2)
 
 
-def _calculate_effective_value_tier(brand, size):
-    raw_value_tier = _calculate_raw_chain_value_tier(size)
-    value_tier_bonus = _calculate_brand_tier_bonus(brand)
-    
-    return raw_value_tier + value_tier_bonus
-
-
-def _calculate_raw_chain_value_tier(chain_size):
-    if chain_size < 2:
-        raise Exception('Chain is too small to be branded. Something bad happened!')
+def _round_up_split(bonuses, player_counts):
+    # each player's share, rounded up to the nearest 100
+    numpy = ledger.get_numpy()
+    return -(-bonuses // (numpy.maximum(player_counts, 1) * 100)) * 100
 
-    if chain_size == 2:
-        return 0
 
-    if chain_size == 3:
-        return 1
+def _sell_all_dense_stock(state, dense_ledger, chains):
+    numpy = ledger.get_numpy()
+    prices = numpy.array([calculate_price_from_chain(chain) for chain in chains], dtype=numpy.int64)
+    brand_columns = [ledger.BRAND_COLUMNS[chain.brand] for chain in chains]
 
-    if chain_size == 4:
-        return 2
+    holdings = dense_ledger.stock[:, brand_columns]
+    dense_ledger.cash += holdings @ prices
+    dense_ledger.stock[:, brand_columns] = 0
 
-    if chain_size == 5:
-        return 3
+    for index, chain in enumerate(chains):
+        sold_count = int(holdings[:, index].sum())
 
-    if chain_size in range(6, 11):
-        return 4
+        if sold_count:
+            _perform_availability_change(state, chain.brand, sold_count)
 
-    if chain_size in range(11, 21):
-        return 5
+        for player_id in state.player_order:
+            stock_count = int(holdings[dense_ledger.row_by_player_id[player_id], index])
 
-    if chain_size in range(21, 31):
-        return 6
+            if stock_count:
+                action_display.record_sell_action(state, player_id, chain.brand, stock_count, int(prices[index]))
 
-    if chain_size in range(31, 41):
-        return 7
 
-    if chain_size >= 41:
-        return 8
-
-
-def _calculate_brand_tier_bonus(brand):
-    if brand in [models.Brand.TOWER, models.Brand.LUXOR]:
-        return 0
+def _find_chain_pricing(chain):
+    if not chain.brand:
+        raise Exception('Chains without a brand have no price!')
 
-    if brand in [models.Brand.WORLDWIDE, models.Brand.AMERICAN, models.Brand.FESTIVAL]:
-        return 1
+    pricing = chain.ruleset.pricing_by_brand[chain.brand][chain.size]
 
-    if brand in [models.Brand.IMPERIAL, models.Brand.CONTINENTAL]:
-        return 2
+    if pricing is None:
+        raise Exception('Chain is too small to be branded. Something bad happened!')
 
-    raise Exception('Unknown brand encountered!')
+    return pricing
@@ -0,0 +1,111 @@
+import threading
+
+import pytest
+
+import auth
+import grid
+import models
+import actions
+import persistance
+import app
+
+
+@pytest.fixture
+def client():
+    persistance.set_backend(persistance.InMemoryBackend())
+    persistance.create_game_state('game', models.GameState('game'))
+    yield app.app.test_client()
+    persistance.set_backend(None)
+
+
+@pytest.mark.parametrize('raw_actions', [
+    None,
+    'place_tile',
+    [None],
+    [{'x': 0, 'y': 0}],
+    [{'type': 'place_tile', 'x': 'a', 'y': 0}],
+    [{'type': 'place_tile', 'x': 0, 'y': 0, 'brand': 'nope'}],
+    [{'type': 'buy_stock', 'purchase_order': ['L']}],
+    [{'type': 'resolve_acquisition', 'sell_count': [1]}],
+    [{'type': 'join_game'}],
+])
+def test_malformed_turns_are_rejected(client, raw_actions):
+    response = client.post('/take_turn', json={'game_id': 'game', 'id_token': 'token', 'actions': raw_actions})
+
+    assert response.status_code == 400
+
+
+def test_streams_of_missing_games_are_not_found(client):
+    assert client.get('/games/missing/stream').status_code == 404
+
+
+def test_viewers_beyond_the_stream_limit_poll_for_updates(client, monkeypatch):
+    monkeypatch.setattr(app, '_stream_slots', threading.BoundedSemaphore(1))
+    monkeypatch.setenv('STREAM_POLL_SECONDS', '2')
+
+    response = client.get('/games/game/stream', buffered=False)
+
+    assert next(response.response).startswith(b'id: 0\nevent: state\n')
+
+    polled_events = client.get('/games/game/stream').get_data(as_text=True)
+
+    assert polled_events.startswith('retry: 2000\n\nid: 0\nevent: state\n')
+
+    unit_of_work = persistance.begin_action('game')
+    actions.join_game(unit_of_work.state, unit_of_work, 'a', {'display_name': 'a'})
+    unit_of_work.commit()
+
+    polled_events = client.get('/games/game/stream', headers={'Last-Event-ID': '0'}).get_data(as_text=True)
+
+    assert polled_events.startswith('retry: 2000\n\nid: 1\nevent: delta\n')
+    assert client.get('/games/game/stream', headers={'Last-Event-ID': '1'}).get_data(as_text=True) == 'retry: 2000\n\n'
+
+    response.close()
+
+    assert not next(client.get('/games/game/stream', buffered=False).response).startswith(b'retry:')
+
+
+@pytest.mark.parametrize('page_size', ['abc', '1.5', '\u00b2', ''])
+def test_malformed_page_sizes_are_rejected(client, page_size):
+    assert client.get('/games', query_string={'page_size': page_size}).status_code == 400
+
+
+def test_game_list_keeps_its_cache_header_when_refresh_is_forced(client, monkeypatch):
+    monkeypatch.setenv('FORCE_REFRESH', '1')
+    monkeypatch.setenv('GAME_LIST_CACHE_SECONDS', '5')
+
+    response = client.get('/games', query_string={'page_size': '5'})
+
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'private, max-age=5'
+    assert client.get('/').headers['Cache-Control'] == 'no-cache, no-store, must-revalidate'
+
+
+def test_actions_on_a_stale_cached_game_are_run_again(client, monkeypatch):
+    monkeypatch.setattr(auth, 'get_user_id', lambda id_token: id_token)
+
+    unit_of_work = persistance.begin_action('game')
+    actions.join_game(unit_of_work.state, unit_of_work, 'a', {'display_name': 'a'})
+    actions.join_game(unit_of_work.state, unit_of_work, 'b', {'display_name': 'b'})
+    actions.start_game(unit_of_work.state, unit_of_work, ['b', 'a'], 0)
+    unit_of_work.commit()
+
+    # another process takes b's turn while this one still has the game cached
+    stale_unit_of_work = persistance.begin_action('game')
+    other_unit_of_work = persistance.UnitOfWork(persistance.get_backend(), 'game', 'b')
+    actions.take_turn(other_unit_of_work.state, other_unit_of_work, 'b', [
+        {'type': 'place_tile', 'x': 2, 'y': 6, 'brand': 'L'},
+        {'type': 'buy_stock', 'purchase_order': {}},
+    ])
+    other_unit_of_work.commit()
+    persistance._cache_unit_of_work(stale_unit_of_work)
+
+    state = persistance.get_game_state('game')
+    move = grid.legal_moves(state, persistance.get_player_tiles('game', 'a'))[0]
+
+    response = client.post('/take_turn', json={'game_id': 'game', 'id_token': 'a', 'actions': [
+        {'type': 'place_tile', 'x': move.tile.x, 'y': move.tile.y, 'brand': move.brands[0] and move.brands[0].value},
+    ]})
+
+    assert response.status_code == 200
+    assert persistance.get_game_state('game').current_action_type == models.ActionType.BUY_STOCK
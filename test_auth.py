@@ -0,0 +1,182 @@
+import sys
+import time
+import types
+import datetime
+import threading
+
+import pytest
+import google.auth.jwt
+import google.auth.crypt
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import auth
+
+
+PROJECT_ID = 'acquire-test'
+
+
+def _generate_key(key_id):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'securetoken.system.gserviceaccount.com')])
+    now = datetime.datetime.utcnow()
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(private_key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(private_key, hashes.SHA256())
+    )
+
+    private_key_pem = private_key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    signer = google.auth.crypt.RSASigner.from_string(private_key_pem, key_id)
+    return signer, certificate.public_bytes(serialization.Encoding.PEM).decode('utf-8')
+
+
+@pytest.fixture(scope='module')
+def keys():
+    return dict(one=_generate_key('one'), two=_generate_key('two'))
+
+
+@pytest.fixture
+def certificates(keys):
+    return {key_id: certificate for key_id, (_, certificate) in keys.items()}
+
+
+@pytest.fixture
+def fetches(certificates, monkeypatch):
+    monkeypatch.setenv('FIREBASE_PROJECT_ID', PROJECT_ID)
+    fetches = []
+
+    def fetch_certificates():
+        fetches.append(time.time())
+        return dict(certificates), 3600
+
+    auth.set_certificate_fetcher(fetch_certificates)
+    yield fetches
+    auth.set_certificate_fetcher(None)
+
+
+def _mint_token(signer, uid, project_id=PROJECT_ID, lifetime=3600):
+    now = int(time.time())
+    return google.auth.jwt.encode(signer, {
+        'iss': f'https://securetoken.google.com/{project_id}',
+        'aud': project_id,
+        'sub': uid,
+        'iat': now,
+        'exp': now + lifetime,
+        'auth_time': now,
+    }).decode('utf-8')
+
+
+def test_verification_is_cached(keys, fetches):
+    token = _mint_token(keys['one'][0], 'player-a')
+
+    assert auth.get_user_id(token) == 'player-a'
+    assert auth.get_user_id(token) == 'player-a'
+    assert auth.get_user_id(_mint_token(keys['two'][0], 'player-b')) == 'player-b'
+    assert len(fetches) == 1
+
+
+def test_invalid_tokens_are_rejected(keys, fetches):
+    other_signer, _ = _generate_key('one')
+
+    with pytest.raises(auth.InvalidIdToken):
+        auth.get_user_id(_mint_token(other_signer, 'player-a'))
+
+    with pytest.raises(auth.InvalidIdToken):
+        auth.get_user_id(_mint_token(keys['one'][0], 'player-a', project_id='another-project'))
+
+    with pytest.raises(auth.InvalidIdToken):
+        auth.get_user_id(_mint_token(keys['one'][0], 'player-a', lifetime=-60))
+
+    with pytest.raises(auth.InvalidIdToken):
+        auth.get_user_id('not a token')
+
+
+def test_unknown_key_ids_refetch_certificates(keys, certificates, fetches, monkeypatch):
+    monkeypatch.setattr(auth, '_CERTIFICATE_MIN_REFRESH_INTERVAL', 0)
+    auth.get_user_id(_mint_token(keys['one'][0], 'player-a'))
+    rotated_signer, rotated_certificate = _generate_key('three')
+    certificates['three'] = rotated_certificate
+
+    assert auth.get_user_id(_mint_token(rotated_signer, 'player-a')) == 'player-a'
+    assert len(fetches) == 2
+
+
+def test_unknown_key_ids_are_rejected_while_certificates_are_recent(keys, fetches):
+    auth.get_user_id(_mint_token(keys['one'][0], 'player-a'))
+    unknown_signer, _ = _generate_key('three')
+
+    for _ in range(3):
+        with pytest.raises(auth.InvalidIdToken):
+            auth.get_user_id(_mint_token(unknown_signer, 'player-a'))
+
+    assert len(fetches) == 1
+
+
+def test_certificates_are_fetched_once_at_a_time(keys, certificates, monkeypatch):
+    monkeypatch.setenv('FIREBASE_PROJECT_ID', PROJECT_ID)
+    fetches = []
+
+    def fetch_certificates():
+        fetches.append(time.time())
+        time.sleep(0.1)
+        return dict(certificates), 0
+
+    auth.set_certificate_fetcher(fetch_certificates)
+
+    try:
+        tokens = [_mint_token(keys['one'][0], f'player-{index}') for index in range(4)]
+        threads = [threading.Thread(target=auth.get_user_id, args=(token,)) for token in tokens]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        assert auth.get_user_id(_mint_token(keys['two'][0], 'player-b')) == 'player-b'
+        assert len(fetches) == 1
+    finally:
+        auth.set_certificate_fetcher(None)
+
+
+def test_firebase_app_is_initialized_once(monkeypatch):
+    initialized_apps = []
+
+    def initialize_app():
+        time.sleep(0.05)
+
+        if initialized_apps:
+            raise ValueError('The default Firebase app already exists!')
+
+        initialized_apps.append(object())
+        return initialized_apps[0]
+
+    def get_app():
+        if not initialized_apps:
+            raise ValueError('The default Firebase app does not exist!')
+
+        return initialized_apps[0]
+
+    firebase_admin = types.SimpleNamespace(get_app=get_app, initialize_app=initialize_app)
+    monkeypatch.setitem(sys.modules, 'firebase_admin', firebase_admin)
+    monkeypatch.setattr(auth, '_firebase_app', None)
+    apps = []
+    threads = [threading.Thread(target=lambda: apps.append(auth.get_firebase_app())) for _ in range(4)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert len(initialized_apps) == 1
+    assert apps == initialized_apps * 4
@@ -1,9 +1,16 @@
 import os
+import copy
+import json
 
 import pytest
+import toolz
 
 import models
 import grid
+import stock
+import tiles
+import turns
+import ledger
 
 
 @pytest.fixture
@@ -216,7 +223,7 @@ def test_grow_locked_chain(state):
 
     grid.place_tile(state, models.Tile(2, 1))
 
-    assert len(state.grid[2][1].tiles) == 12
+    assert state.grid[2][1].size == 12
     assert state.grid[2][1].is_locked()
     assert state.grid[2][1].brand == models.Brand.FESTIVAL
 
@@ -319,3 +326,598 @@ def test_merge_locked_chains_and_unlocked_chain(state):
 
     with pytest.raises(models.RuleViolation):
         grid.place_tile(state, models.Tile(9, 2))
+
+
+def test_merge_unbranded_reports_new_brand(state):
+    grid.place_tile(state, models.Tile(11, 0))
+    grid.place_tile(state, models.Tile(11, 2))
+
+    result = grid.place_tile(state, models.Tile(11, 1), brand=models.Brand.AMERICAN)
+
+    assert result.new_brand == models.Brand.AMERICAN
+    assert result.acquired_chains == []
+    assert state.grid[11][1].size == 3
+
+
+def test_merge_keeps_acquired_chain_size(state):
+    grid.place_tile(state, models.Tile(8, 5))
+    grid.place_tile(state, models.Tile(8, 6), brand=models.Brand.TOWER)
+    grid.place_tile(state, models.Tile(8, 7))
+    grid.place_tile(state, models.Tile(6, 4))
+    grid.place_tile(state, models.Tile(6, 5), brand=models.Brand.AMERICAN)
+
+    result = grid.place_tile(state, models.Tile(7, 5))
+
+    (acquired_chain,) = result.acquired_chains
+    assert acquired_chain.brand == models.Brand.AMERICAN
+    assert acquired_chain.size == 2
+    assert result.acquirer == models.Brand.TOWER
+    assert state.grid[6][4].size == 6
+
+
+def test_from_dict_rebuilds_chains(state):
+    grid.place_tile(state, models.Tile(0, 0))
+    grid.place_tile(state, models.Tile(1, 0), brand=models.Brand.LUXOR)
+    grid.place_tile(state, models.Tile(5, 5))
+    grid.place_tile(state, models.Tile(7, 5))
+    grid.place_tile(state, models.Tile(6, 5))
+
+    loaded_state = models.GameState.from_dict(state.to_dict())
+
+    assert loaded_state.grid[0][0] == loaded_state.grid[1][0]
+    assert loaded_state.grid[0][0].brand == models.Brand.LUXOR
+    assert loaded_state.grid[0][0].size == 2
+    assert loaded_state.grid[5][5] == loaded_state.grid[7][5]
+    assert loaded_state.grid[5][5].brand is None
+    assert loaded_state.grid[5][5].size == 3
+    assert loaded_state.grid[3][3] is None
+    assert loaded_state.chain_by_brand == {models.Brand.LUXOR: loaded_state.grid[0][0]}
+
+
+def test_chain_by_brand_follows_founding_and_merges(state):
+    grid.place_tile(state, models.Tile(8, 5))
+    grid.place_tile(state, models.Tile(8, 6), brand=models.Brand.TOWER)
+    grid.place_tile(state, models.Tile(8, 7))
+    grid.place_tile(state, models.Tile(6, 4))
+    grid.place_tile(state, models.Tile(6, 5), brand=models.Brand.AMERICAN)
+
+    assert grid.find_chain(state, models.Brand.TOWER) == state.grid[8][5]
+    assert grid.find_chain(state, models.Brand.AMERICAN) == state.grid[6][4]
+
+    grid.place_tile(state, models.Tile(7, 5))
+
+    assert grid.find_chain(state, models.Brand.TOWER) == state.grid[6][4]
+    assert grid.find_chain(state, models.Brand.AMERICAN) is None
+    assert grid.get_branded_chains(state) == [state.grid[8][5]]
+
+
+def test_branded_chains_are_in_brand_order(state):
+    grid.place_tile(state, models.Tile(8, 0))
+    grid.place_tile(state, models.Tile(8, 1), brand=models.Brand.CONTINENTAL)
+    grid.place_tile(state, models.Tile(0, 0))
+    grid.place_tile(state, models.Tile(0, 1), brand=models.Brand.TOWER)
+
+    brands = [chain.brand for chain in grid.get_branded_chains(state)]
+    loaded_state = models.GameState.from_dict(state.to_dict())
+
+    assert brands == [models.Brand.TOWER, models.Brand.CONTINENTAL]
+    assert [chain.brand for chain in grid.get_branded_chains(loaded_state)] == brands
+
+
+def test_cannot_found_brand_already_in_use(state):
+    grid.place_tile(state, models.Tile(0, 0))
+    grid.place_tile(state, models.Tile(1, 0), brand=models.Brand.LUXOR)
+    grid.place_tile(state, models.Tile(5, 5))
+
+    with pytest.raises(models.RuleViolation):
+        grid.place_tile(state, models.Tile(5, 6), brand=models.Brand.LUXOR)
+
+
+def test_bitboard_tracks_occupancy_and_chains(state):
+    grid.place_tile(state, models.Tile(0, 8))
+    grid.place_tile(state, models.Tile(1, 8), brand=models.Brand.TOWER)
+    grid.place_tile(state, models.Tile(5, 0))
+
+    chain = state.grid[0][8]
+    chain_mask = state.grid.chain_mask(chain)
+
+    assert state.grid.occupied == chain_mask | state.grid.tiles_mask([models.Tile(5, 0)])
+    assert [(t.x, t.y) for t in state.grid.tiles_from_mask(chain_mask)] == [(0, 8), (1, 8)]
+    assert [(t.x, t.y) for t in state.grid.tiles_from_mask(state.grid.neighbor_mask(chain_mask))] == [(0, 7), (1, 7), (2, 8)]
+
+
+def test_tiles_touching_chain(state):
+    grid.place_tile(state, models.Tile(3, 3))
+    grid.place_tile(state, models.Tile(3, 4), brand=models.Brand.WORLDWIDE)
+
+    hand = [models.Tile(3, 2), models.Tile(4, 4), models.Tile(4, 2), models.Tile(3, 5), models.Tile(0, 0)]
+    touching = grid.get_tiles_touching_chain(state, hand, state.grid[3][3])
+
+    assert sorted((t.x, t.y) for t in touching) == [(3, 2), (3, 5), (4, 4)]
+    assert grid.get_tiles_touching_locked_chains(state, hand) == []
+
+
+def test_legal_moves_describe_each_placement(state):
+    grid.place_tile(state, models.Tile(8, 5))
+    grid.place_tile(state, models.Tile(8, 6), brand=models.Brand.TOWER)
+    grid.place_tile(state, models.Tile(6, 4))
+    grid.place_tile(state, models.Tile(6, 5), brand=models.Brand.AMERICAN)
+    grid.place_tile(state, models.Tile(0, 0))
+
+    hand = [models.Tile(3, 3), models.Tile(0, 1), models.Tile(8, 7), models.Tile(7, 5), models.Tile(8, 5)]
+    before = state.to_dict()
+
+    moves = grid.legal_moves(state, hand)
+
+    assert state.to_dict() == before
+    assert [(move.tile.x, move.tile.y) for move in moves] == [(3, 3), (0, 1), (8, 7), (7, 5)]
+
+    place, found, grow, merge = moves
+    assert place.placement_type == models.PlacementType.PLACE
+    assert place.brands == [None]
+    assert found.placement_type == models.PlacementType.FOUND
+    assert models.Brand.TOWER not in found.brands
+    assert models.Brand.LUXOR in found.brands
+    assert None not in found.brands
+    assert grow.placement_type == models.PlacementType.GROW
+    assert merge.placement_type == models.PlacementType.MERGE
+    assert merge.acquirers == [models.Brand.TOWER, models.Brand.AMERICAN]
+    assert merge.brands == [models.Brand.TOWER, models.Brand.AMERICAN]
+
+
+def test_legal_moves_skip_tiles_between_locked_chains(state):
+    for x in range(11):
+        grid.place_tile(state, models.Tile(x, 0), brand=models.Brand.FESTIVAL if x == 1 else None)
+        grid.place_tile(state, models.Tile(x, 2), brand=models.Brand.LUXOR if x == 1 else None)
+
+    assert grid.legal_moves(state, [models.Tile(2, 1)]) == []
+
+
+def test_undo_restores_state_after_merge(state):
+    grid.place_tile(state, models.Tile(8, 5))
+    grid.place_tile(state, models.Tile(8, 6), brand=models.Brand.TOWER)
+    grid.place_tile(state, models.Tile(8, 7))
+    grid.place_tile(state, models.Tile(6, 4))
+    grid.place_tile(state, models.Tile(6, 5), brand=models.Brand.AMERICAN)
+    tower_chain = state.grid[8][5]
+    american_chain = state.grid[6][4]
+    before = state.to_dict()
+
+    state.checkpoint()
+    grid.place_tile(state, models.Tile(7, 5))
+    grid.set_brand_lists(state)
+
+    state.checkpoint()
+    grid.place_tile(state, models.Tile(0, 0))
+
+    state.undo()
+    assert state.grid[0][0] is None
+    assert state.grid[6][4] is tower_chain
+
+    state.undo()
+    assert state.to_dict() == before
+    assert state.grid[8][5] is tower_chain
+    assert state.grid[6][4] is american_chain
+    assert tower_chain.size == 3
+    assert state.chain_by_brand == {models.Brand.TOWER: tower_chain, models.Brand.AMERICAN: american_chain}
+    assert state.grid.occupied == state.grid.chain_mask(tower_chain) | state.grid.chain_mask(american_chain)
+
+    with pytest.raises(Exception):
+        state.undo()
+
+
+def test_undo_restores_stock_and_turn_state(state):
+    for player_id in ['a', 'b']:
+        state.player_order.append(player_id)
+        state.money_by_player[player_id] = 6000
+        state.stock_by_player[player_id] = {brand: 0 for brand in models.Brand}
+        state.user_data_by_id[player_id] = {'display_name': player_id}
+
+    state.is_started = True
+    state.current_turn_player = 'a'
+    state.current_action_player = 'a'
+    grid.place_tile(state, models.Tile(0, 0))
+    grid.place_tile(state, models.Tile(1, 0), brand=models.Brand.LUXOR)
+    grid.set_brand_lists(state)
+    stock.set_price_table(state)
+    state.acquisition_resolution_queue = [
+        {'player_id': 'b', 'acquirer': models.Brand.LUXOR, 'acquiree': models.Brand.TOWER, 'acquiree_cost_at_acquisition_time': 300}
+    ]
+    before = state.to_dict()
+
+    state.checkpoint()
+    stock.execute_purchase_order(state, 'a', {models.Brand.LUXOR: 3})
+    stock.award_founder_share(state, 'a', models.Brand.LUXOR)
+    turns.transition_from_resolve(state, 'game')
+
+    assert state.money_by_player['a'] == 5400
+    assert state.current_action_player == 'b'
+
+    state.undo()
+
+    assert state.to_dict() == before
+
+
+def _settlement_state():
+    state = models.GameState('settled game')
+    holdings_by_player = {
+        'a': {models.Brand.LUXOR: 5, models.Brand.TOWER: 3, models.Brand.IMPERIAL: 4},
+        'b': {models.Brand.LUXOR: 5, models.Brand.TOWER: 2, models.Brand.AMERICAN: 1},
+        'c': {models.Brand.LUXOR: 1, models.Brand.TOWER: 2},
+        'd': {},
+    }
+
+    for player_id, holdings in holdings_by_player.items():
+        state.player_order.append(player_id)
+        state.money_by_player[player_id] = 6000
+        state.stock_by_player[player_id] = {brand: holdings.get(brand, 0) for brand in models.Brand}
+        state.user_data_by_id[player_id] = {'display_name': player_id}
+
+    for brand, tiles_in_chain in [
+        (models.Brand.LUXOR, [(0, 0), (0, 1)]),
+        (models.Brand.TOWER, [(3, 0), (3, 1), (3, 2)]),
+        (models.Brand.IMPERIAL, [(6, 0), (6, 1), (6, 2), (6, 3), (6, 4), (6, 5)]),
+        (models.Brand.AMERICAN, [(9, 0), (9, 1)]),
+    ]:
+        for index, (x, y) in enumerate(tiles_in_chain):
+            grid.place_tile(state, models.Tile(x, y), brand=brand if index == 1 else None)
+
+    grid.set_brand_lists(state)
+    return state
+
+
+def test_dense_ledger_settles_like_the_dicts(monkeypatch):
+    pytest.importorskip('numpy')
+
+    monkeypatch.setenv('DENSE_LEDGER', '0')
+    expected_bonus_state = _settlement_state()
+    stock.apply_majority_bonuses(expected_bonus_state, grid.get_branded_chains(expected_bonus_state))
+    expected_end_state = _settlement_state()
+    stock.handle_game_end(expected_end_state)
+
+    monkeypatch.setenv('DENSE_LEDGER', '1')
+    bonus_state = _settlement_state()
+    stock.apply_majority_bonuses(bonus_state, grid.get_branded_chains(bonus_state))
+    end_state = _settlement_state().checkpoint()
+    stock.handle_game_end(end_state)
+
+    assert bonus_state.to_dict() == expected_bonus_state.to_dict()
+    assert end_state.to_dict() == expected_end_state.to_dict()
+    assert all(type(money) is int for money in end_state.money_by_player.values())
+    assert end_state.stock_by_player['a'][models.Brand.LUXOR] == 0
+
+    end_state.undo()
+
+    assert end_state.to_dict() == _settlement_state().to_dict()
+
+
+def test_trades_receive_whole_stock(state):
+    state.player_order.append('a')
+    state.money_by_player['a'] = 6000
+    state.stock_by_player['a'] = {brand: 0 for brand in models.Brand}
+    state.stock_by_player['a'][models.Brand.TOWER] = 4
+    state.user_data_by_id['a'] = {'display_name': 'a'}
+    state.current_action_player = 'a'
+
+    stock.trade_stock(state, 'a', models.Brand.TOWER, models.Brand.LUXOR, 4)
+
+    assert state.stock_by_player['a'][models.Brand.LUXOR] == 2
+    assert type(state.stock_by_player['a'][models.Brand.LUXOR]) is int
+    assert type(state.stock_availability[models.Brand.LUXOR]) is int
+
+
+def test_purchase_orders_are_checked_before_they_are_applied():
+    state = _settlement_state()
+    state.current_action_player = 'd'
+    state.money_by_player['d'] = 1000
+    state.stock_availability[models.Brand.TOWER] = 1
+    before = state.to_dict()
+
+    for purchase_order in [
+        {models.Brand.LUXOR: 1, models.Brand.TOWER: 2},
+        {models.Brand.LUXOR: 2, models.Brand.IMPERIAL: 1},
+        {models.Brand.LUXOR: 3, models.Brand.TOWER: 1},
+        {models.Brand.LUXOR: 1, models.Brand.WORLDWIDE: 1},
+        {models.Brand.LUXOR: -1},
+    ]:
+        with pytest.raises(models.RuleViolation):
+            stock.execute_purchase_order(state, 'd', purchase_order)
+
+        assert state.to_dict() == before
+
+    stock.execute_purchase_order(state, 'd', {models.Brand.LUXOR: 2, models.Brand.TOWER: 1, models.Brand.AMERICAN: 0})
+
+    assert state.money_by_player['d'] == 300
+    assert state.stock_by_player['d'][models.Brand.LUXOR] == 2
+    assert state.stock_availability[models.Brand.TOWER] == 0
+    assert state.most_recent_actions == ['d bought 2 LUXOR @ $200 and 1 TOWER @ $300 each.']
+
+
+def test_tiles_are_interned():
+    tile = models.Tile(3, 4)
+
+    assert models.Tile(3, 4) is tile
+    assert models.Tile(x=3, y=4) is tile
+    assert copy.deepcopy(tile) is tile
+    assert models.Tile(4, 3) is not tile
+
+
+def test_off_board_tiles_are_not_interned(state):
+    interned_tile_count = len(models.Tile._tiles_by_position)
+
+    assert models.Tile(10 ** 9, 0) is not models.Tile(10 ** 9, 0)
+    assert models.Tile(-1, 3) is not models.Tile(-1, 3)
+    assert len(models.Tile._tiles_by_position) == interned_tile_count
+
+    with pytest.raises(models.RuleViolation):
+        grid.place_tile(state, models.Tile(10 ** 9, 0))
+
+
+def test_deepcopy_state(state):
+    grid.place_tile(state, models.Tile(0, 0))
+    grid.place_tile(state, models.Tile(1, 0), brand=models.Brand.LUXOR)
+
+    copied_state = copy.deepcopy(state)
+    grid.place_tile(copied_state, models.Tile(2, 0))
+
+    assert copied_state.grid[2][0].size == 3
+    assert state.grid[0][0].size == 2
+    assert state.grid[2][0] is None
+
+
+def test_update_dict_contains_only_changed_fields(state, monkeypatch):
+    monkeypatch.setenv('COMPACT_BOARD', '0')
+
+    for player_id in ['a', 'b']:
+        state.player_order.append(player_id)
+        state.money_by_player[player_id] = 6000
+        state.stock_by_player[player_id] = {brand: 0 for brand in models.Brand}
+        state.user_data_by_id[player_id] = {'display_name': player_id}
+
+    grid.place_tile(state, models.Tile(0, 0))
+    grid.place_tile(state, models.Tile(1, 0), brand=models.Brand.LUXOR)
+    grid.set_brand_lists(state)
+    stock.set_price_table(state)
+    state.current_action_player = 'a'
+
+    loaded_state = models.GameState.from_dict(state.to_dict())
+
+    assert loaded_state.to_update_dict() == {}
+
+    stock.execute_purchase_order(loaded_state, 'a', {models.Brand.LUXOR: 2})
+
+    update_dict = loaded_state.to_update_dict()
+    assert update_dict.pop('most_recent_actions')
+    assert update_dict == {
+        'stock_availability.L': 23,
+        'money_by_player.a': 5600,
+        'stock_by_player.a.L': 2,
+    }
+
+    grid.place_tile(loaded_state, models.Tile(3, 3))
+
+    assert loaded_state.to_update_dict()['grid.`3`'][3] == {'brand': None, 'is_locked': False, 'count': 1, 'chain_id': 30}
+    assert 'grid.`0`' not in loaded_state.to_update_dict()
+
+
+def test_from_dict_loads_grid_without_chain_ids(state, monkeypatch):
+    monkeypatch.setenv('COMPACT_BOARD', '0')
+
+    grid.place_tile(state, models.Tile(0, 0))
+    grid.place_tile(state, models.Tile(1, 0), brand=models.Brand.LUXOR)
+    grid.place_tile(state, models.Tile(5, 5))
+    grid.place_tile(state, models.Tile(7, 5))
+    grid.place_tile(state, models.Tile(6, 5))
+
+    state_dict = state.to_dict()
+    state_dict['grid'] = {
+        x: [toolz.dissoc(space, 'chain_id') if space else None for space in column]
+        for x, column in state_dict['grid'].items()
+    }
+
+    loaded_state = models.GameState.from_dict(state_dict)
+
+    assert loaded_state.grid[0][0] == loaded_state.grid[1][0]
+    assert loaded_state.grid[0][0].brand == models.Brand.LUXOR
+    assert loaded_state.grid[5][5] == loaded_state.grid[7][5]
+    assert loaded_state.grid[5][5].size == 3
+    assert loaded_state.grid[5][5] != loaded_state.grid[0][0]
+
+
+def test_compact_board_round_trip(state, monkeypatch):
+    monkeypatch.setenv('COMPACT_BOARD', '1')
+
+    grid.place_tile(state, models.Tile(0, 0))
+    grid.place_tile(state, models.Tile(0, 1), brand=models.Brand.LUXOR)
+    grid.place_tile(state, models.Tile(1, 2))
+
+    board = state.to_dict()['board']
+
+    assert board['chains'] == [
+        {'brand': 'L', 'is_locked': False, 'count': 2},
+        {'brand': None, 'is_locked': False, 'count': 1},
+    ]
+    assert board['cells'] == '00.......' + '..1......' + '.' * 90
+
+    loaded_state = models.GameState.from_dict(state.to_dict())
+
+    assert loaded_state.grid[0][0] == loaded_state.grid[0][1]
+    assert loaded_state.grid[0][0].brand == models.Brand.LUXOR
+    assert loaded_state.grid[1][2].size == 1
+    assert loaded_state.chain_by_brand == {models.Brand.LUXOR: loaded_state.grid[0][0]}
+
+
+def test_compact_board_replaces_grid_field(state, monkeypatch):
+    monkeypatch.setenv('COMPACT_BOARD', '0')
+    loaded_state = models.GameState.from_dict(state.to_dict())
+
+    monkeypatch.setenv('COMPACT_BOARD', '1')
+    update_dict = loaded_state.to_update_dict()
+
+    assert update_dict['grid'] is models.DELETE_FIELD
+    assert update_dict['board']['cells'] == '.' * 108
+
+
+def test_ruleset_variant_board():
+    ruleset = models.Ruleset.from_dict({
+        **models.default_ruleset().to_dict(),
+        'width': 4,
+        'height': 3,
+        'lock_minimum': 3,
+        'win_size': 12,
+        'player_count_max': 1,
+    })
+    small_state = models.GameState('tiny game', ruleset)
+
+    with pytest.raises(models.RuleViolation):
+        grid.place_tile(small_state, models.Tile(4, 0))
+
+    grid.place_tile(small_state, models.Tile(3, 2))
+    grid.place_tile(small_state, models.Tile(3, 1), brand=models.Brand.TOWER)
+    grid.place_tile(small_state, models.Tile(3, 0))
+
+    assert small_state.grid[3][0].is_locked()
+    assert models.GameState.from_dict(small_state.to_dict()).grid[3][2].is_locked()
+    assert models.Ruleset.from_dict(ruleset.to_dict()) is ruleset
+
+
+def test_ruleset_validation():
+    with pytest.raises(models.RuleViolation):
+        models.Ruleset.from_dict({**models.default_ruleset().to_dict(), 'player_count_min': 0})
+
+    with pytest.raises(models.RuleViolation):
+        models.Ruleset.from_dict({**models.default_ruleset().to_dict(), 'width': 'wide'})
+
+    with pytest.raises(models.RuleViolation):
+        models.Ruleset.from_dict({**models.default_ruleset().to_dict(), 'colors': 3})
+
+    for oversized_rules in [
+        {'width': 3000, 'height': 3000},
+        {'win_size': 10 ** 6},
+        {'tile_hand_size': 500},
+        {'player_count_max': 100},
+        {'recent_action_display_count': 10 ** 9},
+        {'width': 2, 'height': 2, 'lock_minimum': 2, 'win_size': 2},
+    ]:
+        with pytest.raises(models.RuleViolation):
+            models.Ruleset.from_dict({**models.default_ruleset().to_dict(), **oversized_rules})
+
+
+def test_ruleset_cache_is_bounded():
+    base_rules = models.default_ruleset().to_dict()
+
+    for recent_action_display_count in range(1, 200):
+        models.Ruleset.from_dict({**base_rules, 'recent_action_display_count': recent_action_display_count})
+
+    assert len(models.Ruleset._rulesets_by_settings) <= 64
+    assert models.Ruleset.from_dict(base_rules) is models.Ruleset.from_dict(base_rules)
+
+
+def test_pricing_table():
+    pricing_by_brand = models.default_ruleset().pricing_by_brand
+
+    assert pricing_by_brand[models.Brand.TOWER][1] is None
+    assert pricing_by_brand[models.Brand.TOWER][2] == (200, 2000, 1000)
+    assert pricing_by_brand[models.Brand.AMERICAN][5] == (600, 6000, 3000)
+    assert pricing_by_brand[models.Brand.CONTINENTAL][10] == (800, 8000, 4000)
+    assert pricing_by_brand[models.Brand.CONTINENTAL][11] == (900, 9000, 4500)
+    assert pricing_by_brand[models.Brand.IMPERIAL][108] == (1200, 12000, 6000)
+
+
+def test_loaded_price_schedule(tmp_path, monkeypatch):
+    price_schedules_path = tmp_path / 'price_schedules.json'
+    price_schedules_path.write_text(json.dumps({
+        'flat': {
+            'size_tiers': [2],
+            'brand_tiers': {brand.value: 0 for brand in models.Brand},
+            'prices': [500],
+            'first_bonuses': [5000],
+            'second_bonuses': [2500],
+        }
+    }))
+    monkeypatch.setenv('PRICE_SCHEDULES_PATH', str(price_schedules_path))
+    models._load_price_schedules.cache_clear()
+
+    try:
+        ruleset = models.Ruleset.from_dict({**models.default_ruleset().to_dict(), 'price_schedule': 'flat'})
+        flat_state = models.GameState('flat game', ruleset)
+        grid.place_tile(flat_state, models.Tile(0, 0))
+        grid.place_tile(flat_state, models.Tile(0, 1), brand=models.Brand.CONTINENTAL)
+        grid.set_brand_lists(flat_state)
+        stock.set_price_table(flat_state)
+
+        assert flat_state.cost_by_brand == {models.Brand.CONTINENTAL: 500}
+        assert models.GameState.from_dict(flat_state.to_dict()).ruleset is ruleset
+
+        with pytest.raises(models.RuleViolation):
+            models.Ruleset.from_dict({**models.default_ruleset().to_dict(), 'price_schedule': 'steep'})
+    finally:
+        models._load_price_schedules.cache_clear()
+
+
+def test_reloaded_grid_has_no_changes(state, monkeypatch):
+    monkeypatch.setenv('COMPACT_BOARD', '0')
+    grid.place_tile(state, models.Tile(5, 5))
+    grid.place_tile(state, models.Tile(4, 5), brand=models.Brand.TOWER)
+    grid.place_tile(state, models.Tile(9, 2))
+
+    state_dict = state.to_dict()
+
+    assert state_dict['grid']['4'][5]['chain_id'] == 4 * 9 + 5
+    assert models.GameState.from_dict(state_dict).to_update_dict() == {}
+
+
+def test_seeded_deck():
+    ruleset = models.default_ruleset()
+    deck = tiles.generate_initial_tiles(ruleset, 7)
+
+    assert sorted(deck.tiles, key=lambda t: (t.x, t.y)) == list(ruleset.tiles)
+    assert tiles.generate_initial_tiles(ruleset, 7).tiles == deck.tiles
+    assert tiles.generate_initial_tiles(ruleset, 8).tiles != deck.tiles
+
+    hand = tiles.draw_tiles(deck, 6)
+
+    assert hand == list(deck.tiles[:6])
+    assert tiles.draw_tile(deck) == deck.tiles[6]
+    assert deck.remaining() == 101
+
+    resumed_deck = tiles.generate_initial_tiles(ruleset, 7, deck.cursor)
+
+    assert tiles.draw_tile(resumed_deck) == deck.tiles[7]
+
+
+def test_delta_dict(state, monkeypatch):
+    monkeypatch.setenv('COMPACT_BOARD', '1')
+    state.player_order.append('a')
+    state.money_by_player['a'] = 6000
+    state.stock_by_player['a'] = {brand: 0 for brand in models.Brand}
+    state.most_recent_actions = ['one', 'two']
+
+    loaded_state = models.GameState.from_dict(state.to_dict())
+    grid.place_tile(loaded_state, models.Tile(0, 1))
+    loaded_state.most_recent_actions = ['two', 'three', 'four']
+    loaded_state.money_by_player['a'] = 5000
+    loaded_state.version = 1
+
+    delta = loaded_state.to_delta_dict()
+
+    assert delta == {
+        'from_version': 0,
+        'version': 1,
+        'fields': {'board.chains': [{'brand': None, 'is_locked': False, 'count': 1}], 'money_by_player.a': 5000, 'version': 1},
+        'deleted_fields': [],
+        'cells': {'1': '0'},
+        'actions': {'dropped_count': 1, 'added': ['three', 'four']},
+    }
+
+
+def test_dense_ledger_without_numpy_is_an_error(monkeypatch):
+    monkeypatch.setattr(ledger, 'get_numpy', lambda: None)
+    monkeypatch.setenv('DENSE_LEDGER', '1')
+
+    with pytest.raises(Exception):
+        ledger.is_enabled()
+
+    monkeypatch.setenv('DENSE_LEDGER', '0')
+
+    assert not ledger.is_enabled()
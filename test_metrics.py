@@ -0,0 +1,76 @@
+import pytest
+
+import models
+import metrics
+import persistance
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def test_phases_are_reported_and_aggregated():
+    metrics.begin_request('place_tile')
+
+    with metrics.phase('read'):
+        metrics.count_firestore_call('batch_get')
+
+    with metrics.phase('rules'):
+        pass
+
+    with metrics.phase('read'):
+        pass
+
+    server_timing = metrics.end_request(200)
+
+    assert [entry.split(';')[0] for entry in server_timing.split(', ')] == ['read', 'rules', 'total']
+
+    rendered = metrics.render_prometheus()
+
+    assert 'acquire_requests_total{endpoint="place_tile",status="200"} 1' in rendered
+    assert 'acquire_request_phase_seconds_count{endpoint="place_tile",phase="read"} 1' in rendered
+    assert 'acquire_request_phase_seconds_bucket{endpoint="place_tile",phase="total",le="+Inf"} 1' in rendered
+    assert 'acquire_firestore_calls_total{endpoint="place_tile",operation="batch_get"} 1' in rendered
+
+
+def test_phases_outside_a_request_are_ignored():
+    with metrics.phase('read'):
+        pass
+
+    assert metrics.end_request(200) is None
+    assert 'phase="read"' not in metrics.render_prometheus()
+
+
+def test_sampled_requests_are_profiled(monkeypatch, capsys):
+    monkeypatch.setenv('PROFILE_SAMPLE_RATE', '1')
+
+    metrics.begin_request('legal_moves')
+    sorted(range(1000), key=lambda number: -number)
+    metrics.end_request(200)
+
+    assert 'Profile of a request to legal_moves' in capsys.readouterr().err
+
+
+def test_app_sends_server_timing_and_serves_metrics():
+    import app
+
+    persistance.set_backend(persistance.InMemoryBackend())
+
+    try:
+        persistance.create_game_state('game', models.GameState('game'))
+        client = app.app.test_client()
+
+        response = client.post('/join_game', json={'game_id': 'game', 'user_id': 'a'})
+
+        assert response.status_code == 200
+        assert 'rules;dur=' in response.headers['Server-Timing']
+        assert 'read;dur=' in response.headers['Server-Timing']
+
+        rendered = client.get('/metrics').get_data(as_text=True)
+
+        assert 'acquire_request_phase_seconds_count{endpoint="join_game",phase="write"} 1' in rendered
+    finally:
+        persistance.set_backend(None)
@@ -0,0 +1,379 @@
+import pytest
+
+import models
+import grid
+import stock
+import tiles
+import deltas
+import actions
+import persistance
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request, tmp_path):
+    if request.param == 'memory':
+        backend = persistance.InMemoryBackend()
+    else:
+        backend = persistance.SqliteBackend(str(tmp_path / 'acquire.sqlite3'))
+
+    persistance.set_backend(backend)
+    yield backend
+    persistance.set_backend(None)
+
+
+def test_game_state_round_trip(backend):
+    state = models.GameState('super fun game')
+    state.player_order.append('a')
+    state.money_by_player['a'] = 6000
+    state.stock_by_player['a'] = {brand: 0 for brand in models.Brand}
+    state.user_data_by_id['a'] = {'display_name': 'a'}
+    state.current_action_player = 'a'
+    grid.place_tile(state, models.Tile(0, 0))
+    grid.place_tile(state, models.Tile(0, 1), brand=models.Brand.LUXOR)
+    grid.set_brand_lists(state)
+    stock.set_price_table(state)
+
+    persistance.create_game_state('game', state)
+
+    loaded_state = persistance.get_game_state('game')
+    stock.execute_purchase_order(loaded_state, 'a', {models.Brand.LUXOR: 1})
+    persistance.update_game_state('game', loaded_state.to_update_dict())
+
+    reloaded_state = persistance.get_game_state('game')
+    assert reloaded_state.to_dict() == loaded_state.to_dict()
+    assert reloaded_state.money_by_player['a'] == 5800
+    assert reloaded_state.grid[0][0].brand == models.Brand.LUXOR
+
+
+def test_update_applies_field_paths(backend):
+    backend.create_game_state('game', {'grid': {'3': [None]}, 'money_by_player': {'a': 1, 'b-c': 2}})
+
+    backend.update_game_state('game', {
+        'grid': models.DELETE_FIELD,
+        'money_by_player.`b-c`': 5,
+        'stock_by_player.a.L': 1,
+    })
+
+    assert backend.get_game_state('game') == {
+        'money_by_player': {'a': 1, 'b-c': 5},
+        'stock_by_player': {'a': {'L': 1}},
+    }
+
+
+def test_adding_and_deleting_tiles(backend):
+    persistance.initialize_player_tiles('game', {'a': [models.Tile(2, 2)]})
+
+    persistance.add_player_tile('game', 'a', models.Tile(1, 1))
+    persistance.add_player_tile('game', 'a', models.Tile(1, 1))
+
+    assert persistance.get_player_tiles('game', 'a') == [models.Tile(2, 2), models.Tile(1, 1)]
+
+    persistance.delete_player_tile('game', 'a', models.Tile(2, 2))
+
+    assert persistance.get_player_tiles('game', 'a') == [models.Tile(1, 1)]
+
+
+def test_games_and_users(backend):
+    game_id = persistance.create_game('super fun game')
+    persistance.set_user_data('a', {'display_name': 'Ada'})
+
+    assert game_id
+    assert persistance.get_user_data('a') == {'display_name': 'Ada'}
+    assert persistance.get_user_data('b') is None
+
+
+def test_unit_of_work_commits_buffered_writes(backend):
+    persistance.create_game_state('game', models.GameState('super fun game'))
+    persistance.initialize_player_tiles('game', {'a': [models.Tile(2, 2)]})
+
+    unit_of_work = persistance.begin_action('game', 'a')
+
+    assert unit_of_work.player_tiles == [models.Tile(2, 2)]
+    assert unit_of_work.deck is None
+
+    deck = tiles.generate_initial_tiles(unit_of_work.state.ruleset, 42)
+    unit_of_work.initialize_deck(deck)
+    unit_of_work.deal_tile_to_player('a', tiles.draw_tile(deck))
+    unit_of_work.delete_player_tile('a', models.Tile(2, 2))
+    unit_of_work.state.tiles_remaining = deck.remaining()
+
+    assert persistance.get_player_tiles('game', 'a') == [models.Tile(2, 2)]
+
+    unit_of_work.commit()
+
+    assert persistance.get_player_tiles('game', 'a') == [deck.tiles[0]]
+    assert persistance.get_game_state('game').tiles_remaining == 107
+
+    unit_of_work = persistance.begin_action('game', 'a')
+
+    assert unit_of_work.deck.cursor == 1
+    assert unit_of_work.deck.tiles == deck.tiles
+
+
+def test_legacy_tile_array_is_drawn_from_the_end(backend):
+    persistance.create_game_state('game', models.GameState('super fun game'))
+    backend._write('game_state_secrets/game', {'tiles': [models.Tile(0, 0).to_dict(), models.Tile(1, 1).to_dict()]})
+
+    unit_of_work = persistance.begin_action('game')
+
+    assert tiles.draw_tile(unit_of_work.deck) == models.Tile(1, 1)
+
+    unit_of_work.commit()
+    unit_of_work = persistance.begin_action('game')
+
+    assert unit_of_work.deck.remaining() == 1
+    assert tiles.draw_tile(unit_of_work.deck) == models.Tile(0, 0)
+    assert tiles.draw_tile(unit_of_work.deck) is None
+
+
+def test_game_history_replays_to_the_live_state(backend, monkeypatch):
+    monkeypatch.setenv('SNAPSHOT_INTERVAL', '4')
+    persistance.create_game_state('game', models.GameState('super fun game'))
+
+    for player_id in ['a', 'b']:
+        unit_of_work = persistance.begin_action('game')
+        actions.join_game(unit_of_work.state, unit_of_work, player_id, {'display_name': player_id})
+        unit_of_work.commit()
+
+    unit_of_work = persistance.begin_action('game')
+    actions.start_game(unit_of_work.state, unit_of_work, ['b', 'a'], 11)
+    unit_of_work.commit()
+
+    for _ in range(6):
+        state = persistance.get_game_state('game')
+        player_id = state.current_action_player
+        unit_of_work = persistance.begin_action('game', player_id)
+
+        if state.current_action_type == models.ActionType.PLACE_TILE:
+            move = grid.legal_moves(unit_of_work.state, unit_of_work.player_tiles)[0]
+            brand = move.brands[0] if move.placement_type == models.PlacementType.FOUND else None
+            actions.place_tile(unit_of_work.state, unit_of_work, player_id, move.tile, brand)
+        elif state.current_action_type == models.ActionType.RESOLVE_ACQUISITION:
+            actions.resolve_acquisition(unit_of_work.state, unit_of_work, player_id, 0, 0)
+        else:
+            actions.buy_stock(unit_of_work.state, unit_of_work, player_id, {})
+
+        unit_of_work.commit()
+
+    live_state = persistance.get_game_state('game')
+
+    assert live_state.version == 9
+    assert len(persistance.get_game_events('game', 6)) == 3
+    assert persistance.get_game_events('game', 0, 3)[2] == {'type': 'start_game', 'player_order': ['b', 'a'], 'deck_seed': 11}
+    assert persistance.load_game_state_from_history('game').to_dict() == live_state.to_dict()
+    assert persistance.load_game_state_from_history('game', 2).player_order == ['a', 'b']
+    assert not persistance.load_game_state_from_history('game', 2).is_started
+
+
+@pytest.mark.parametrize('deck_seed', [13, 18, 20, 25])
+def test_finished_game_history_replays_to_the_live_state(backend, monkeypatch, deck_seed):
+    monkeypatch.setenv('SNAPSHOT_INTERVAL', '50')
+    persistance.create_game_state('game', models.GameState('super fun game'))
+
+    for player_id in ['a', 'b', 'c']:
+        unit_of_work = persistance.begin_action('game')
+        actions.join_game(unit_of_work.state, unit_of_work, player_id, {'display_name': player_id})
+        unit_of_work.commit()
+
+    unit_of_work = persistance.begin_action('game')
+    actions.start_game(unit_of_work.state, unit_of_work, ['a', 'b', 'c'], deck_seed)
+    unit_of_work.commit()
+
+    while persistance.get_game_state('game').current_action_type != models.ActionType.GAME_OVER:
+        state = persistance.get_game_state('game')
+        player_id = state.current_action_player
+        unit_of_work = persistance.begin_action('game', player_id)
+        state = unit_of_work.state
+
+        if state.current_action_type == models.ActionType.PLACE_TILE:
+            moves = grid.legal_moves(state, unit_of_work.player_tiles)
+
+            # there is no passing, so play stops once a player has no tile they can place
+            if not moves:
+                unit_of_work.release()
+                break
+
+            move = moves[0]
+            actions.place_tile(state, unit_of_work, player_id, move.tile, move.brands[0] if move.brands else None)
+        elif state.current_action_type == models.ActionType.RESOLVE_ACQUISITION:
+            acquiree = models.Brand(state.current_action_details['acquiree'])
+            actions.resolve_acquisition(state, unit_of_work, player_id, state.stock_by_player[player_id][acquiree], 0)
+        else:
+            affordable_brands = [
+                brand
+                for brand
+                in state.active_brands
+                if state.cost_by_brand[brand] <= state.money_by_player[player_id] and state.stock_availability[brand]
+            ]
+            purchase_order = {affordable_brands[0].value: 1} if affordable_brands else {}
+            actions.buy_stock(state, unit_of_work, player_id, purchase_order)
+
+        unit_of_work.commit()
+
+    live_state = persistance.get_game_state('game')
+    replayed_state = persistance.load_game_state_from_history('game')
+
+    assert replayed_state.most_recent_actions == live_state.most_recent_actions
+    assert replayed_state.money_by_player == live_state.money_by_player
+    assert replayed_state.to_dict() == live_state.to_dict()
+
+
+def test_committed_units_of_work_are_reused(backend):
+    persistance.create_game_state('game', models.GameState('super fun game'))
+
+    unit_of_work = persistance.begin_action('game')
+    actions.join_game(unit_of_work.state, unit_of_work, 'a', {'display_name': 'a'})
+    unit_of_work.commit()
+
+    assert persistance.begin_action('game') is unit_of_work
+
+    unit_of_work.state.title = 'less fun game'
+    unit_of_work.commit()
+
+    assert persistance.get_game_state('game').title == 'less fun game'
+    assert persistance.begin_action('game', 'a') is not unit_of_work
+
+
+def test_read_only_actions_do_not_use_a_stale_cached_game(backend):
+    persistance.create_game_state('game', models.GameState('super fun game'))
+
+    unit_of_work = persistance.begin_action('game')
+    actions.join_game(unit_of_work.state, unit_of_work, 'a', {'display_name': 'a'})
+    unit_of_work.commit()
+
+    stale_unit_of_work = persistance.begin_action('game', 'a')
+    other_unit_of_work = persistance.UnitOfWork(backend, 'game')
+    actions.join_game(other_unit_of_work.state, other_unit_of_work, 'b', {'display_name': 'b'})
+    other_unit_of_work.commit()
+    stale_unit_of_work.release()
+
+    assert persistance.begin_action('game', 'a', is_read_only=True).state.player_order == ['a', 'b']
+
+
+def test_stale_units_of_work_are_not_committed(backend):
+    persistance.create_game_state('game', models.GameState('super fun game'))
+
+    unit_of_work = persistance.begin_action('game')
+    persistance.evict_cached_game('game')
+    other_unit_of_work = persistance.begin_action('game')
+
+    actions.join_game(other_unit_of_work.state, other_unit_of_work, 'b', {'display_name': 'b'})
+    other_unit_of_work.commit()
+    actions.join_game(unit_of_work.state, unit_of_work, 'a', {'display_name': 'a'})
+
+    with pytest.raises(persistance.StaleGameState):
+        unit_of_work.commit()
+
+    unit_of_work = persistance.begin_action('game')
+
+    assert unit_of_work.state.player_order == ['b']
+
+
+def test_take_turn_applies_actions_until_another_player_must_act(backend):
+    persistance.create_game_state('game', models.GameState('super fun game'))
+    unit_of_work = persistance.begin_action('game')
+    actions.join_game(unit_of_work.state, unit_of_work, 'a', {'display_name': 'a'})
+    actions.join_game(unit_of_work.state, unit_of_work, 'b', {'display_name': 'b'})
+    actions.start_game(unit_of_work.state, unit_of_work, ['b', 'a'], 0)
+    unit_of_work.commit()
+
+    unit_of_work = persistance.begin_action('game', 'b')
+    applied_action_count = actions.take_turn(unit_of_work.state, unit_of_work, 'b', [
+        {'type': 'place_tile', 'x': 2, 'y': 6, 'brand': 'L'},
+        {'type': 'buy_stock', 'purchase_order': {'L': 2}},
+        {'type': 'place_tile', 'x': 0, 'y': 0, 'brand': None},
+    ])
+    unit_of_work.commit()
+
+    state = persistance.get_game_state('game')
+
+    assert applied_action_count == 2
+    assert state.version == 5
+    assert state.stock_by_player['b'][models.Brand.LUXOR] == 3
+    assert state.current_action_player == 'a'
+    assert models.Tile(2, 6) not in persistance.get_player_tiles('game', 'b')
+
+    unit_of_work = persistance.begin_action('game', 'b')
+
+    with pytest.raises(models.RuleViolation):
+        actions.take_turn(unit_of_work.state, unit_of_work, 'b', [{'type': 'buy_stock', 'purchase_order': {}}])
+
+
+def test_take_turn_stops_at_the_first_action_out_of_order(backend):
+    persistance.create_game_state('game', models.GameState('super fun game'))
+    unit_of_work = persistance.begin_action('game')
+    actions.join_game(unit_of_work.state, unit_of_work, 'a', {'display_name': 'a'})
+    actions.join_game(unit_of_work.state, unit_of_work, 'b', {'display_name': 'b'})
+    actions.start_game(unit_of_work.state, unit_of_work, ['b', 'a'], 0)
+    unit_of_work.commit()
+
+    unit_of_work = persistance.begin_action('game', 'b')
+    applied_action_count = actions.take_turn(unit_of_work.state, unit_of_work, 'b', [
+        {'type': 'place_tile', 'x': 2, 'y': 6, 'brand': 'L'},
+        {'type': 'place_tile', 'x': 0, 'y': 0, 'brand': None},
+        {'type': 'buy_stock', 'purchase_order': {'L': 2}},
+    ])
+    unit_of_work.commit()
+
+    state = persistance.get_game_state('game')
+
+    assert applied_action_count == 1
+    assert state.current_action_player == 'b'
+    assert state.current_action_type == models.ActionType.BUY_STOCK
+
+
+def test_commits_publish_deltas(backend):
+    persistance.create_game_state('game', models.GameState('super fun game'))
+
+    for player_id in ['a', 'b']:
+        unit_of_work = persistance.begin_action('game')
+        actions.join_game(unit_of_work.state, unit_of_work, player_id, {'display_name': player_id})
+        unit_of_work.commit()
+
+    first_delta, second_delta = deltas.get_deltas_since('game', 0)
+
+    assert (first_delta['from_version'], first_delta['version']) == (0, 1)
+    assert second_delta['fields']['money_by_player.b'] == 6000
+    assert deltas.get_deltas_since('game', 1) == [second_delta]
+    assert deltas.get_deltas_since('game', 2) == []
+    assert deltas.wait_for_deltas('game', 2, 0) == []
+
+
+def test_lobby_lists_game_summaries(backend, monkeypatch):
+    monkeypatch.setenv('GAME_LIST_CACHE_SECONDS', '60')
+
+    for game_id in ['first', 'second', 'third']:
+        persistance.create_game_state(game_id, models.GameState(f'{game_id} game'))
+
+    unit_of_work = persistance.begin_action('second')
+    actions.join_game(unit_of_work.state, unit_of_work, 'a', {'display_name': 'a'})
+    actions.join_game(unit_of_work.state, unit_of_work, 'b', {'display_name': 'b'})
+    actions.start_game(unit_of_work.state, unit_of_work, ['a', 'b'], 0)
+    unit_of_work.commit()
+
+    (in_progress_game,), next_cursor = persistance.list_games('in_progress')
+
+    assert next_cursor is None
+    assert in_progress_game['id'] == 'second'
+    assert in_progress_game['title'] == 'second game'
+    assert in_progress_game['player_count'] == 2
+
+    first_page, next_cursor = persistance.list_games('open', page_size=1)
+    second_page, last_cursor = persistance.list_games('open', page_size=1, cursor=next_cursor)
+
+    assert [game['id'] for game in first_page + second_page] == ['third', 'first']
+    assert last_cursor is None
+
+    backend.set_game_summary('first', {'title': 'renamed'})
+
+    assert persistance.list_games('open', page_size=1, cursor=next_cursor)[0] == second_page
+
+    with pytest.raises(models.RuleViolation):
+        persistance.list_games('abandoned')
+
+
+def test_game_locks_are_shared_per_game():
+    game_lock = persistance.lock_game('game')
+
+    assert persistance.lock_game('game') is game_lock
+    assert persistance.lock_game('other game') is not game_lock
@@ -0,0 +1,28 @@
+import collections
+
+import router
+
+
+def test_games_spread_across_workers_and_mostly_stay_put():
+    workers = [f'127.0.0.1:{port}' for port in range(8081, 8085)]
+    ring = router.build_ring(workers)
+    game_ids = [f'game-{index}' for index in range(2000)]
+
+    worker_by_game_id = {game_id: router.find_worker(ring, game_id) for game_id in game_ids}
+    game_counts = collections.Counter(worker_by_game_id.values())
+
+    assert set(game_counts) == set(workers)
+    assert min(game_counts.values()) > 300
+
+    smaller_ring = router.build_ring(workers[:-1])
+    moved_game_ids = [game_id for game_id in game_ids if router.find_worker(smaller_ring, game_id) != worker_by_game_id[game_id]]
+
+    assert all(worker_by_game_id[game_id] == workers[-1] for game_id in moved_game_ids)
+
+
+def test_find_game_id():
+    assert router.find_game_id('/games/abc/stream', b'') == 'abc'
+    assert router.find_game_id('/buy_stock', b'{"game_id": "abc", "purchase_order": {}}') == 'abc'
+    assert router.find_game_id('/create_game', b'{"title": "fun"}') is None
+    assert router.find_game_id('/place_tile', b'not json') is None
+    assert router.find_game_id('/', b'') is None
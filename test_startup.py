@@ -0,0 +1,17 @@
+import os
+import sys
+import subprocess
+
+
+def test_importing_the_app_leaves_the_sdks_for_first_use():
+    loaded_modules = subprocess.run(
+        [sys.executable, '-c', 'import sys, app; print(" ".join(sorted(sys.modules)))'],
+        env={**os.environ, 'WARM_UP_ON_START': '0'},
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout.decode('utf-8').split()
+
+    assert 'firebase_admin' not in loaded_modules
+    assert 'google.cloud.firestore' not in loaded_modules
+    assert 'google.auth.jwt' not in loaded_modules
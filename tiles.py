@@ -1,31 +1,38 @@
-import os
 import random
+import functools
 
 import models
 
 
-def draw_tile(tiles):
-    if not tiles:
+def draw_tile(deck):
+    if not deck.remaining():
         return None
-    return tiles.pop()
 
+    tile = deck.tiles[deck.cursor]
+    deck.cursor += 1
+    return tile
 
-def draw_tiles(tiles, requested_tile_count):
-    remaining_tile_count = len(tiles)
-    tile_count = min(remaining_tile_count, requested_tile_count)
-    return [tiles.pop() for _ in range(tile_count)]
-    
 
-def generate_initial_tiles():
-    height = int(os.environ['HEIGHT'])
-    width = int(os.environ['WIDTH'])
+def draw_tiles(deck, requested_tile_count):
+    tile_count = min(deck.remaining(), requested_tile_count)
+    drawn_tiles = list(deck.tiles[deck.cursor:deck.cursor + tile_count])
+    deck.cursor += tile_count
+    return drawn_tiles
 
-    tiles = []
 
-    for x in range(width):
-        for y in range(height):
-            tiles.append(models.Tile(x, y))
+def generate_deck_seed():
+    # firestore integers are signed 64 bit
+    return random.SystemRandom().getrandbits(63)
 
-    random.shuffle(tiles)
 
-    return tiles
+def generate_initial_tiles(ruleset, seed, cursor=0):
+    return models.Deck(_shuffle_tiles(ruleset, seed), cursor, seed)
+
+
+@functools.lru_cache(maxsize=1024)
+def _shuffle_tiles(ruleset, seed):
+    tiles = list(ruleset.tiles)
+
+    random.Random(seed).shuffle(tiles)
+
+    return tuple(tiles)
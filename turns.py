@@ -1,22 +1,19 @@
-import os
-
 import toolz
 
 import models
 import stock
 import grid
 import tiles
-import persistance
 
 
-def transition_from_place(game_state, place_tile_result, game_id):
+def transition_from_place(game_state, place_tile_result, unit_of_work):
     acquirer = place_tile_result.acquirer
     acquired_chains = place_tile_result.acquired_chains
 
     if acquired_chains and not acquirer:
         raise Exception('If there are acquired chains, the acquirer must be specified!')
 
-    sorted_chains = sorted(acquired_chains, key=lambda c: len(c.tiles), reverse=True)
+    sorted_chains = sorted(acquired_chains, key=lambda c: c.size, reverse=True)
     resolution_queue = []
 
     for chain in sorted_chains:
@@ -34,20 +31,21 @@ def transition_from_place(game_state, place_tile_result, game_id):
     game_state.acquisition_resolution_queue = resolution_queue[::-1]
     game_state.most_recently_placed_tile = place_tile_result.tile
     
-    return transition_from_resolve(game_state, game_id)
+    return transition_from_resolve(game_state, unit_of_work)
 
 
-def transition_from_resolve(game_state, game_id):
+def transition_from_resolve(game_state, unit_of_work):
     if not game_state.acquisition_resolution_queue:
         if not game_state.active_brands:
-            return transition_from_buy(game_state, game_id)
+            return transition_from_buy(game_state, unit_of_work)
             
         game_state.current_action_player = game_state.current_turn_player
         game_state.current_action_type = models.ActionType.BUY_STOCK
         game_state.current_action_details = None
         return game_state
 
-    resolution_details = game_state.acquisition_resolution_queue.pop()
+    resolution_details = game_state.acquisition_resolution_queue[-1]
+    game_state.acquisition_resolution_queue = game_state.acquisition_resolution_queue[:-1]
     game_state.current_action_player = resolution_details['player_id']
     game_state.current_action_type = models.ActionType.RESOLVE_ACQUISITION
 
@@ -60,7 +58,7 @@ def transition_from_resolve(game_state, game_id):
     return game_state
 
 
-def transition_from_buy(game_state, game_id):
+def transition_from_buy(game_state, unit_of_work):
     if _is_game_over(game_state):
         stock.handle_game_end(game_state)
         game_state.current_action_type = models.ActionType.GAME_OVER
@@ -69,12 +67,11 @@ def transition_from_buy(game_state, game_id):
         game_state.current_action_details = list(toolz.map(toolz.first, sorted(game_state.money_by_player.items(), key=toolz.second, reverse=True)))
         return game_state
 
-    global_tiles = persistance.get_global_tiles(game_id)
-    new_tile = tiles.draw_tile(global_tiles)
-    game_state.tiles_remaining = len(global_tiles)
+    new_tile = tiles.draw_tile(unit_of_work.deck)
+    game_state.tiles_remaining = unit_of_work.deck.remaining()
     
     if new_tile:
-        persistance.deal_tile_to_player(game_id, game_state.current_turn_player, new_tile)
+        unit_of_work.deal_tile_to_player(game_state.current_turn_player, new_tile)
 
     next_player = _get_next_player(game_state)
     game_state.current_turn_player = next_player
@@ -85,8 +82,8 @@ def transition_from_buy(game_state, game_id):
 
 def _is_game_over(state):
     branded_chains = grid.get_branded_chains(state)
-    win_size = int(os.environ['WIN_SIZE'])
-    chain_of_sufficient_size_exists = any(len(chain.tiles) >= win_size for chain in branded_chains)
+    win_size = state.ruleset.win_size
+    chain_of_sufficient_size_exists = any(chain.size >= win_size for chain in branded_chains)
     all_chains_are_locked = branded_chains and all(chain.is_locked() for chain in branded_chains) 
     return chain_of_sufficient_size_exists or all_chains_are_locked
 
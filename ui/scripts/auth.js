@@ -2,14 +2,11 @@
 auth.onAuthStateChanged(user => {
   setupUI(user);
   if (user) {
-    db.collection('games').onSnapshot(
-      snapshot => {
-        setupGameList(user, snapshot.docs);
-      }, 
-      err => console.log(err.message)
-    );
+    loadGameList(user);
   } else {
-    setupGameList([]);
+    stopGameListRefresh();
+    unsubscribeFromGameState();
+    setupGameList(null, []);
   }
 });
 
@@ -17,14 +14,16 @@ auth.onAuthStateChanged(user => {
 const createForm = document.querySelector('#create-form');
 createForm.addEventListener('submit', (e) => {
   e.preventDefault();
-  axios.post(
+  auth.currentUser.getIdToken().then(idToken => {
+    return axios.post(
       '/create_game',
-      { title: createForm.title.value })
-    .then(() => {
+      { title: createForm.title.value, id_token: idToken });
+  }).then(() => {
       // close the create modal & reset form
       const modal = document.querySelector('#modal-create');
       M.Modal.getInstance(modal).close();
       createForm.reset();
+      loadGameList(auth.currentUser);
   }).catch(err => {
     console.log(err.message);
   });
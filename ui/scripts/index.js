@@ -18,22 +18,133 @@ const setupUI = (user) => {
 
 // initialize game board
 const initGameboard = (game, user) => {
+  stopGameListRefresh();
   gameList.style.display = 'none';
   gameBoard.style.display = 'block';
 
-  db.collection('game_states').doc(game.id).onSnapshot(
-    gameStateDoc => {
-      const gameState = gameStateDoc.data();
-      if (gameState.is_started) {
-        db.doc(`game_state_secrets/${gameStateDoc.id}/player_secrets/${user.uid}`).get().then(secretDoc => {
-          const tiles = secretDoc.data().tiles;
-          setupGameboard(gameStateDoc, user, tiles);
-        });
+  subscribeToGameState(game.id, gameState => {
+    const gameStateDoc = { id: game.id, data: () => Object.assign({}, gameState) };
+    if (gameState.is_started) {
+      db.doc(`game_state_secrets/${game.id}/player_secrets/${user.uid}`).get().then(secretDoc => {
+        const tiles = secretDoc.data().tiles;
+        setupGameboard(gameStateDoc, user, tiles);
+      });
+    }
+    setupGameboard(gameStateDoc, user, []);
+  });
+};
+
+// follow a game through the server's event stream: the whole state once, then
+// deltas, resuming from the last version seen when the connection drops. Only one
+// game is followed at a time, since each stream holds a server thread.
+let gameStateSource = null;
+let gameStateRetryTimer = null;
+
+const subscribeToGameState = (gameId, onGameState) => {
+  let gameState = null;
+  let version = null;
+  let retryDelay = 1000;
+  unsubscribeFromGameState();
+
+  const connect = () => {
+    const query = version === null ? '' : `?version=${version}`;
+    const source = gameStateSource = new EventSource(`/games/${gameId}/stream${query}`);
+
+    source.addEventListener('state', e => {
+      gameState = JSON.parse(e.data);
+      version = e.lastEventId;
+      retryDelay = 1000;
+      onGameState(gameState);
+    });
+
+    source.addEventListener('delta', e => {
+      if (!gameState) {
+        return;
       }
-      setupGameboard(gameStateDoc, user, []);
-    }, 
-    err => console.log(err.message)
-  );
+      applyDelta(gameState, JSON.parse(e.data));
+      version = e.lastEventId;
+      retryDelay = 1000;
+      onGameState(gameState);
+    });
+
+    // the browser reconnects by itself unless the server answered with an error, in
+    // which case the source is closed for good and a new one is opened after a delay
+    source.onerror = e => {
+      if (source.readyState !== EventSource.CLOSED) {
+        console.log('game stream interrupted, reconnecting');
+        return;
+      }
+      console.log(`game stream closed, reconnecting in ${retryDelay / 1000}s`);
+      gameStateRetryTimer = setTimeout(connect, retryDelay);
+      retryDelay = Math.min(retryDelay * 2, 30000);
+    };
+  };
+
+  connect();
+};
+
+const unsubscribeFromGameState = () => {
+  clearTimeout(gameStateRetryTimer);
+  gameStateRetryTimer = null;
+  if (gameStateSource) {
+    gameStateSource.close();
+  }
+  gameStateSource = null;
+};
+
+const applyDelta = (gameState, delta) => {
+  for (const [fieldPath, value] of Object.entries(delta.fields)) {
+    const names = splitFieldPath(fieldPath);
+    const parent = names.slice(0, -1).reduce((map, name) => map[name] = map[name] || {}, gameState);
+    parent[names[names.length - 1]] = value;
+  }
+
+  for (const fieldPath of delta.deleted_fields) {
+    const names = splitFieldPath(fieldPath);
+    const parent = names.slice(0, -1).reduce((map, name) => map && map[name], gameState);
+    if (parent) {
+      delete parent[names[names.length - 1]];
+    }
+  }
+
+  if (delta.cells) {
+    const cells = gameState.board.cells.split('');
+    for (const [index, cell] of Object.entries(delta.cells)) {
+      cells[index] = cell;
+    }
+    gameState.board.cells = cells.join('');
+  }
+
+  if (delta.actions) {
+    gameState.most_recent_actions = gameState.most_recent_actions
+      .slice(delta.actions.dropped_count)
+      .concat(delta.actions.added);
+  }
+};
+
+// field paths are dot separated, with backticks around names that are not identifiers
+const splitFieldPath = (fieldPath) => {
+  const names = [];
+  let name = '';
+  let isQuoted = false;
+
+  for (let index = 0; index < fieldPath.length; index++) {
+    const char = fieldPath[index];
+    if (isQuoted && char === '\\') {
+      index++;
+      name += fieldPath[index];
+    } else if (char === '`') {
+      isQuoted = !isQuoted;
+    } else if (char === '.' && !isQuoted) {
+      names.push(name);
+      name = '';
+    } else {
+      name += char;
+    }
+  }
+
+  names.push(name);
+  return names;
 };
 
 const setupGameInfo = (gameState) => {
@@ -310,6 +421,25 @@ const logoByBrand = {
   'C': "img/continental.png"
 }
 
+// the compact board encoding: one chain table plus one character per space
+const EMPTY_CELL_CODE = '.'.charCodeAt(0);
+const FIRST_CHAIN_CODE = 0x30;
+
+// expand a compact board into the same columns of spaces as the grid map
+const decodeBoard = (board) => {
+  const grid = {};
+
+  for (let x = 0; x < board.width; x++) {
+    grid[x] = [];
+    for (let y = 0; y < board.height; y++) {
+      const code = board.cells.charCodeAt(x * board.height + y);
+      grid[x].push(code === EMPTY_CELL_CODE ? null : board.chains[code - FIRST_CHAIN_CODE]);
+    }
+  }
+
+  return grid;
+};
+
 // setup grid
 const setupGrid = (gameState, user, playerTiles) => {
   var html = '';
@@ -392,13 +522,14 @@ const setupGrid = (gameState, user, playerTiles) => {
   }
 
   html  += '<table>';
-  const height = gameState.grid[0].length;
-  const width = Object.keys(gameState.grid).length;  
+  const grid = gameState.board ? decodeBoard(gameState.board) : gameState.grid;
+  const height = grid[0].length;
+  const width = Object.keys(grid).length;  
 
   for (y = 0; y < height; y++) {
     html += '<tr>';
     for (x = 0; x < width; x++) {
-      space = gameState.grid[x][y];
+      space = grid[x][y];
       html += '<td height="50px" width="50px" style="text-align:center;border:thin solid black;padding:5;" ';
       playerHasTile = playerTiles.some(tile => tile['x'] == x && tile['y'] == y);
       if (space) {
@@ -426,19 +557,52 @@ const setupGrid = (gameState, user, playerTiles) => {
 };
 
 // setup game list
-const setupGameList = (user, docs) => {
+// the lobby shows pages of game summaries from the server, refreshing the first
+// page while it is open, rather than listening to every game document
+const gameListStatuses = [['open', 'open'], ['in_progress', 'in progress'], ['finished', 'finished'], ['', 'all']];
+let gameListStatus = 'open';
+let gameListRefreshTimer = null;
+
+const loadGameList = (user, cursor = null, games = []) => {
+  stopGameListRefresh();
+  const params = { status: gameListStatus || undefined, cursor: cursor || undefined };
+  axios.get('/games', { params }).then(response => {
+    setupGameList(user, games.concat(response.data.games), response.data.next_cursor);
+    if (!cursor) {
+      gameListRefreshTimer = setTimeout(() => loadGameList(user), 15000);
+    }
+  }).catch(err => {
+    console.log(err.message);
+  });
+};
+
+const stopGameListRefresh = () => {
+  clearTimeout(gameListRefreshTimer);
+  gameListRefreshTimer = null;
+};
+
+const setupGameList = (user, games, nextCursor) => {
   let html = '';
-  docs.forEach(doc => {
-    const game = doc.data();
+  if (user) {
+    html += '<div style="padding:6px 0px;">';
+    gameListStatuses.forEach(([status, label]) => {
+      const color = status === gameListStatus ? '' : 'grey';
+      html += `<a id="status-${status || 'all'}" class="waves-effect waves-light btn-small ${color}" style="margin-right:6px;">${label}</a>`;
+    });
+    html += '</div>';
+  }
+  games.forEach(game => {
+    const lastActivity = new Date(game.last_activity * 1000).toLocaleString();
     const li = `
     <div class="card grey darken">
       <div style="padding:6px 15px;" class="card-content white-text">
         <div class="row" style="margin:0px;">
           <div class="col">
             <span class="card-title">${game.title}</span>
+            <span>${game.player_count}/${game.player_count_max} players, ${game.status.replace('_', ' ')}, last active ${lastActivity}</span>
           </div>
           <div class="col right">
-            <a id="enter-${doc.id}" class="waves-effect waves-light btn">enter</a>
+            <a id="enter-${game.id}" class="waves-effect waves-light btn">enter</a>
           </div>
         </div>
       </div>
@@ -446,14 +610,31 @@ const setupGameList = (user, docs) => {
     `;
     html += li;
   });
+  if (nextCursor) {
+    html += '<a id="more-games" class="waves-effect waves-light btn grey">more</a>';
+  }
   gameList.innerHTML = html
-  docs.forEach(doc => {
-    const game = doc.data();
-    game.id = doc.id;
+  if (!user) {
+    return;
+  }
+  gameListStatuses.forEach(([status]) => {
+    document
+      .querySelector(`#status-${status || 'all'}`)
+      .addEventListener('click', e => {
+        gameListStatus = status;
+        loadGameList(user);
+      });
+  });
+  games.forEach(game => {
     document
       .querySelector(`#enter-${game.id}`)
       .addEventListener('click', e => initGameboard(game, user));
   });
+  if (nextCursor) {
+    document
+      .querySelector('#more-games')
+      .addEventListener('click', e => loadGameList(user, nextCursor, games));
+  }
 };
 
 // setup materialize components